@@ -110,6 +110,7 @@ num_inf=    # Number of inferences output by the model
             # Note that if it is not specified, it will be the same as num_ref. Otherwise, it will be overwritten.
             # In MixIT, number of outputs is larger than that of references.
 sot_asr=false   # Whether to use Serialized Output Training (SOT)
+asr_feats_cache_dir= # Directory to cache the frozen S3PRL frontend features (empty disables caching).
 
 # Upload model related
 hf_repo=
@@ -241,6 +242,7 @@ Options:
     --num_inf    # Number of inference audio generated by the model (default="${num_inf}")
                  # Note that if it is not specified, it will be the same as num_ref. Otherwise, it will be overwritten.
     --sot_asr    # Whether to use Serialized Output Training (SOT) (default="${sot_asr}")
+    --asr_feats_cache_dir # Directory to cache the frozen S3PRL frontend features (default="${asr_feats_cache_dir}").
 
     # Decoding related
     --inference_tag       # Suffix to the result dir for decoding (default="${inference_tag}").
@@ -1388,6 +1390,48 @@ if [ ${stage} -le 11 ] && [ ${stop_stage} -ge 11 ] && ! [[ " ${skip_stages} " =~
         _opts+="--valid_shape_file ${asr_stats_dir}/valid/${ref_text_names[$i]}_shape.${token_type} "
     done
 
+    if [ -n "${asr_feats_cache_dir}" ]; then
+        _opts+="--frontend_conf cache_dir=${asr_feats_cache_dir} "
+
+        if ${gpu_inference}; then
+            _cmd="${cuda_cmd}"
+            _ngpu=1
+        else
+            _cmd="${decode_cmd}"
+            _ngpu=0
+        fi
+
+        _logdir="${asr_feats_cache_dir}/logdir"
+        mkdir -p "${_logdir}"
+        _nj=$(min "${inference_nj}" "$(<${_asr_train_dir}/${_scp} wc -l)" "$(<${_asr_valid_dir}/${_scp} wc -l)")
+
+        for dset in train valid; do
+            if [ "${dset}" = train ]; then
+                key_file="${_asr_train_dir}/${_scp}"
+            else
+                key_file="${_asr_valid_dir}/${_scp}"
+            fi
+            split_scps=""
+            for n in $(seq "${_nj}"); do
+                split_scps+=" ${_logdir}/${dset}.${n}.scp"
+            done
+            # shellcheck disable=SC2086
+            utils/split_scp.pl "${key_file}" ${split_scps}
+
+            # Utterances already in the cache are skipped, so this step is cheap
+            # when resuming the training
+            log "Frontend feature caching started... log: '${_logdir}/cache_feats.${dset}.*.log'"
+            # shellcheck disable=SC2046,SC2086
+            ${_cmd} --gpu "${_ngpu}" JOB=1:"${_nj}" "${_logdir}"/cache_feats.${dset}.JOB.log \
+                ${python} -m espnet2.bin.s3prl_cache_feats \
+                    --ngpu "${_ngpu}" \
+                    --data_path_and_name_and_type "${_logdir}/${dset}.JOB.scp,speech,${_type}" \
+                    --asr_train_config "${asr_config}" \
+                    --cache_dir "${asr_feats_cache_dir}" \
+                    --shard "${dset}.JOB" || { cat $(grep -l -i error "${_logdir}"/cache_feats.${dset}.*.log) ; exit 1; }
+        done
+    fi
+
     log "Generate '${asr_exp}/run.sh'. You can resume the process from stage 11 using this script"
     mkdir -p "${asr_exp}"; echo "${run_args} --stage 11 \"\$@\"; exit \$?" > "${asr_exp}/run.sh"; chmod +x "${asr_exp}/run.sh"
 
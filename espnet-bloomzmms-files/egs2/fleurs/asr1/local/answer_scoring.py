@@ -0,0 +1,71 @@
+import torch
+
+from espnet.nets.pytorch_backend.nets_utils import make_non_pad_mask, pad_list
+
+
+def score_options(model, inputs_embeds, options_ids, attention_mask=None):
+    """Compute the log-likelihoods of the answer options following the prompts.
+
+    The prompts are forwarded once. The options are then forwarded together as
+    one batch on top of the keys and values of the prompts.
+
+    Args:
+        model: Hugging Face causal LM with a fused batch and head dimension
+            in the keys and values, e.g. BLOOM
+        inputs_embeds: embeddings of the left-padded prompts (batch, length, dim)
+        options_ids: token ids of every answer option
+        attention_mask: mask of the prompts (batch, length), no padding if None
+    Returns:
+        sum of the token log-probabilities of every option
+            (batch, num_options)
+    """
+    batch_size, prompt_length = inputs_embeds.shape[:2]
+    num_options = len(options_ids)
+    if attention_mask is None:
+        attention_mask = torch.ones(
+            (batch_size, prompt_length), dtype=torch.long, device=inputs_embeds.device
+        )
+
+    with torch.no_grad():
+        prompt = model(
+            inputs_embeds=inputs_embeds, attention_mask=attention_mask, use_cache=True
+        )
+        first_logp = prompt.logits[:, -1].float().log_softmax(dim=-1)
+        device = first_logp.device
+
+        ids = pad_list([torch.tensor(x) for x in options_ids], 0).to(device)
+        lengths = torch.tensor([len(x) for x in options_ids], device=device)
+        scores = first_logp[:, ids[:, 0]]
+        if ids.size(1) == 1:
+            return scores
+
+        # Every prompt is followed by every option: (batch * num_options, ...)
+        mask = make_non_pad_mask(lengths).to(device).repeat(batch_size, 1)
+        ids = ids.repeat(batch_size, 1)
+        attention_mask = torch.cat(
+            [attention_mask.to(device).repeat_interleave(num_options, 0), mask.long()],
+            dim=1,
+        )
+        past_key_values = tuple(
+            (
+                k.view(batch_size, -1, *k.shape[1:])
+                .repeat_interleave(num_options, 0)
+                .flatten(0, 1),
+                v.view(batch_size, -1, *v.shape[1:])
+                .repeat_interleave(num_options, 0)
+                .flatten(0, 1),
+            )
+            for k, v in prompt.past_key_values
+        )
+        # The last token of the options does not predict anything
+        logits = model(
+            input_ids=ids[:, :-1],
+            attention_mask=attention_mask[:, :-1],
+            past_key_values=past_key_values,
+        ).logits
+        logp = logits.float().log_softmax(dim=-1)
+        logp = logp.gather(2, ids[:, 1:].unsqueeze(2)).squeeze(2)
+        logp = logp.masked_fill(~mask[:, 1:], 0.0).sum(1)
+        scores = scores + logp.view(batch_size, num_options)
+
+    return scores
@@ -0,0 +1,92 @@
+import hashlib
+import os
+
+import soundfile
+import torch
+
+from espnet.nets.pytorch_backend.nets_utils import pad_list
+from espnet2.fileio.feats_cache import FeatsCache
+from espnet2.torch_utils.device_funcs import to_device
+
+
+def checkpoint_hash(*files):
+    """SHA-1 of the contents of the model files, e.g. config and weights."""
+    sha1 = hashlib.sha1()
+    for path in files:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 24), b""):
+                sha1.update(block)
+    return sha1.hexdigest()
+
+
+def cache_key(wav_file):
+    """Cache key of an audio file, the SHA-1 of its real path."""
+    return hashlib.sha1(os.path.realpath(wav_file).encode("utf-8")).hexdigest()
+
+
+def open_encoder_cache(cache_dir, asr_train_config, asr_model_file):
+    """Open the encoder output store of a checkpoint.
+
+    The outputs of different checkpoints are stored in different
+    subdirectories of cache_dir, named by the checkpoint hash.
+    """
+    if cache_dir is None:
+        return None
+    model_hash = checkpoint_hash(asr_train_config, asr_model_file)
+    print(f"Encoder output cache: {cache_dir}/{model_hash}")
+    return FeatsCache(os.path.join(cache_dir, model_hash), dtype="float16")
+
+
+def encode_files(
+    wav_files, asr_model, linear_in, device, dtype, cache=None, speech=None
+):
+    """Encode the audio files and project them to the LLM embedding space.
+
+    The outputs of the frontend, the encoder and linear_in are read from the
+    cache if they are there, the rest of the files are encoded as one batch
+    and added to the cache as float16 arrays. The cache is a FeatsCache or
+    any other mapping, e.g. a dict.
+
+    Args:
+        speech: already read waveforms of the files, None for the files
+            which have to be read
+    Returns:
+        list of (length, embedding dim) tensors, one for every file
+    """
+    keys = [cache_key(f) for f in wav_files]
+    encoded = [None] * len(wav_files)
+    if cache is not None:
+        for i, key in enumerate(keys):
+            if key in cache:
+                encoded[i] = torch.tensor(
+                    cache[key], dtype=getattr(torch, dtype), device=device
+                )
+
+    missing = [i for i, e in enumerate(encoded) if e is None]
+    if len(missing) == 0:
+        return encoded
+
+    wavs = []
+    for i in missing:
+        if speech is not None and speech[i] is not None:
+            wav = speech[i]
+        else:
+            wav, rate = soundfile.read(wav_files[i])
+        wav = torch.tensor(wav)
+        wav = wav.to(getattr(torch, dtype))
+        wavs.append(wav)
+
+    lengths = torch.tensor([w.size(0) for w in wavs], dtype=torch.long)
+    batch = {"speech": pad_list(wavs, 0.0), "speech_lengths": lengths}
+    batch = to_device(batch, device=device)
+
+    with torch.no_grad():
+        enc, enc_olens = asr_model.encode(**batch)
+        enc = linear_in(enc[0] if isinstance(enc, tuple) else enc)
+
+    for j, i in enumerate(missing):
+        encoded[i] = enc[j, : enc_olens[j]]
+        if cache is not None:
+            cache[keys[i]] = encoded[i].half().cpu().numpy()
+
+    return encoded
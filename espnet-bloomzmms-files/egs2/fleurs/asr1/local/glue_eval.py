@@ -0,0 +1,266 @@
+import soundfile
+import torch
+
+from local.answer_scoring import score_options
+from local.encoder_cache import cache_key, encode_files
+
+
+class AudioDataset(torch.utils.data.Dataset):
+    """Waveforms of the examples, read in the DataLoader workers.
+
+    Every example has one audio file per speech field. The files whose
+    encoder outputs are in the cache are not read.
+    """
+
+    def __init__(self, wav_files, cache=None):
+        self.wav_files = wav_files
+        self.cache = cache
+
+    def __len__(self):
+        return len(self.wav_files)
+
+    def __getitem__(self, i):
+        speech = []
+        for wav_file in self.wav_files[i]:
+            if self.cache is not None and cache_key(wav_file) in self.cache:
+                speech.append(None)
+            else:
+                wav, rate = soundfile.read(wav_file)
+                speech.append(wav)
+        return i, speech
+
+
+def encode_unique(
+    wav_files,
+    asr_model,
+    linear_in,
+    device,
+    dtype,
+    cache,
+    batch_size=16,
+    num_workers=2,
+):
+    """Encode every distinct audio file once and put the outputs in the cache.
+
+    Args:
+        wav_files: audio files of every example
+        cache: encoder output store, e.g. a dict
+    """
+    unique_files = sorted(set(f for files in wav_files for f in files))
+    print(
+        f"Encoding {len(unique_files)} unique audio files "
+        f"of {sum(len(files) for files in wav_files)} speech fields"
+    )
+    loader = torch.utils.data.DataLoader(
+        AudioDataset([[f] for f in unique_files], cache),
+        batch_size=batch_size,
+        num_workers=num_workers,
+        collate_fn=list,
+    )
+    for batch in loader:
+        encode_files(
+            [unique_files[i] for i, _ in batch],
+            asr_model,
+            linear_in,
+            device,
+            dtype,
+            cache,
+            speech=[speech[0] for _, speech in batch],
+        )
+
+
+def compile_template(segments, word_embeddings, hf_tokenizer, device, dtype):
+    """Embed the text segments of a prompt template once.
+
+    Args:
+        segments: task2list entry, "%<field>" for the speech segments
+    Returns:
+        list of speech field names and (length, dim) text embeddings on
+        device in dtype
+    """
+    template = []
+
+    with torch.no_grad():
+        for text in segments:
+            if text.startswith("%"):
+                template.append(text[1:])
+            else:
+                input_ids = hf_tokenizer(text, return_tensors="pt")["input_ids"]
+                template.append(
+                    word_embeddings(input_ids.to(word_embeddings.weight.device))
+                    .squeeze(0)
+                    .to(device=device, dtype=dtype)
+                )
+
+    return template
+
+
+def build_inputs_embeds(template, encoded_speech, dtype):
+    """Concatenate the text and speech segments of a prompt.
+
+    Args:
+        template: compile_template output
+        encoded_speech: speech field -> (length, dim) tensor
+        dtype: dtype of the template embeddings
+    Returns:
+        (length, dim) tensor
+    """
+    inputs_list = []
+
+    for segment in template:
+        if isinstance(segment, str):
+            inputs_list.append(encoded_speech[segment].detach().to(dtype))
+        else:
+            inputs_list.append(segment)
+
+    return torch.cat(inputs_list)
+
+
+def pad_left(inputs_embeds):
+    """Left-pad the prompts, the padding side of the BLOOM tokenizer.
+
+    Returns:
+        (batch, length, dim) tensor and (batch, length) attention mask
+    """
+    max_length = max(x.size(0) for x in inputs_embeds)
+    padded = inputs_embeds[0].new_zeros(
+        (len(inputs_embeds), max_length, inputs_embeds[0].size(1))
+    )
+    attention_mask = torch.zeros(
+        (len(inputs_embeds), max_length), dtype=torch.long, device=padded.device
+    )
+    for i, x in enumerate(inputs_embeds):
+        padded[i, max_length - x.size(0) :] = x
+        attention_mask[i, max_length - x.size(0) :] = 1
+    return padded, attention_mask
+
+
+def evaluate(
+    wav_files,
+    text_fields,
+    segments,
+    asr_model,
+    linear_in,
+    hugging_face_model,
+    hf_tokenizer,
+    answer_options,
+    answer_ids,
+    device,
+    dtype,
+    load_in_8bit,
+    cache=None,
+    scoring="generate",
+    batch_size=8,
+    num_workers=2,
+    unique_audio=False,
+    name="",
+):
+    """Answer the spoken examples in batches.
+
+    The audio is read in DataLoader workers, the speech fields of batch_size
+    examples are encoded in one forward, and the LLM answers the batch of
+    left-padded prompts. With unique_audio, the distinct audio files are
+    encoded in a first pass, so that the files shared by several examples are
+    encoded only once.
+
+    Args:
+        wav_files: audio files of every example, in the order of text_fields
+        segments: task2list entry of the task
+        answer_options: answer texts
+        answer_ids: token ids of the answer options
+        scoring: "generate" for constrained beam search, "likelihood" for
+            the argmax of the option log-likelihoods
+        unique_audio: encode the distinct audio files in a first pass
+    Returns:
+        hypotheses and, with the likelihood scoring, the option scores of
+        every example
+    """
+    if unique_audio:
+        if cache is None:
+            # Keep the encoder outputs in memory as float16 arrays
+            cache = {}
+        encode_unique(
+            wav_files,
+            asr_model,
+            linear_in,
+            device,
+            dtype,
+            cache,
+            batch_size=batch_size * len(text_fields),
+            num_workers=num_workers,
+        )
+
+    # The 8-bit model takes float16 embeddings
+    embeds_dtype = torch.float16 if load_in_8bit else getattr(torch, dtype)
+    template = compile_template(
+        segments,
+        hugging_face_model.transformer.word_embeddings,
+        hf_tokenizer,
+        device,
+        embeds_dtype,
+    )
+    max_answer_length = max([len(x) for x in answer_ids])
+    loader = torch.utils.data.DataLoader(
+        AudioDataset(wav_files, cache),
+        batch_size=batch_size,
+        # All audio is encoded already, do not copy the cache to the workers
+        num_workers=0 if unique_audio else num_workers,
+        collate_fn=list,
+    )
+
+    hyps = []
+    scores = []
+
+    for batch in loader:
+        print(f"Processing {name} sample {batch[0][0]}")
+
+        enc = encode_files(
+            [f for i, _ in batch for f in wav_files[i]],
+            asr_model,
+            linear_in,
+            device,
+            dtype,
+            cache,
+            speech=[wav for _, speech in batch for wav in speech],
+        )
+
+        inputs_embeds = []
+        for j in range(len(batch)):
+            encoded_speech = dict(
+                zip(text_fields, enc[j * len(text_fields) : (j + 1) * len(text_fields)])
+            )
+            inputs_embeds.append(
+                build_inputs_embeds(template, encoded_speech, embeds_dtype)
+            )
+
+        inputs_embeds, attention_mask = pad_left(inputs_embeds)
+
+        if scoring == "likelihood":
+            for option_scores in score_options(
+                hugging_face_model, inputs_embeds, answer_ids, attention_mask
+            ).tolist():
+                hyps.append(answer_options[option_scores.index(max(option_scores))])
+                scores.append(dict(zip(answer_options, option_scores)))
+            continue
+
+        input_ids = torch.ones(attention_mask.shape, dtype=int, device=device)
+
+        with torch.no_grad():
+            outputs = hugging_face_model.generate(
+                input_ids,
+                inputs_embeds=inputs_embeds,
+                attention_mask=attention_mask,
+                num_beams=len(answer_options),
+                force_words_ids=answer_ids,
+                max_new_tokens=max_answer_length,
+                renormalize_logits=True,
+            )
+
+        hyps.extend(
+            x.strip()
+            for x in hf_tokenizer.batch_decode(
+                outputs[:, input_ids.shape[1] :], skip_special_tokens=True
+            )
+        )
+
+    return hyps, scores
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+
+from local.speech_tasks import (
+    load_models,
+    run_task,
+    speechglue_task,
+    speechxnli_task,
+)
+
+parser = argparse.ArgumentParser(
+    description="Run SpeechGLUE tasks and SpeechXNLI languages with models "
+    "loaded once"
+)
+parser.add_argument("asr_expdir")
+parser.add_argument("output")
+parser.add_argument("--glue_path", default=None)
+parser.add_argument("--glue_tasks", nargs="*", default=[])
+parser.add_argument("--xnli_dir", default=None)
+parser.add_argument("--xnli_langs", nargs="*", default=[])
+parser.add_argument(
+    "--cache_dir", default=None, help="Directory of the encoder output cache"
+)
+parser.add_argument(
+    "--scoring",
+    default="generate",
+    choices=["generate", "likelihood"],
+    help="Constrained beam search or argmax of the answer log-likelihoods",
+)
+parser.add_argument("--batch_size", type=int, default=8)
+parser.add_argument("--num_workers", type=int, default=2)
+parser.add_argument(
+    "--unique_audio",
+    action="store_true",
+    help="Encode every distinct sentence audio of XNLI once before answering",
+)
+args = parser.parse_args()
+
+if len(args.glue_tasks) > 0 and args.glue_path is None:
+    parser.error("--glue_tasks requires --glue_path")
+if len(args.xnli_langs) > 0 and args.xnli_dir is None:
+    parser.error("--xnli_langs requires --xnli_dir")
+
+os.makedirs(args.output, exist_ok=True)
+
+models = load_models(args.asr_expdir, args.cache_dir)
+
+jobs = [
+    (
+        glue_task,
+        lambda glue_task=glue_task: speechglue_task(args.glue_path, glue_task),
+        f"{args.output}/speechglue_{glue_task}.json",
+        False,
+    )
+    for glue_task in args.glue_tasks
+] + [
+    (
+        f"XNLI {lang}",
+        lambda lang=lang: speechxnli_task(args.xnli_dir, lang),
+        f"{args.output}/xnli_{lang}.json",
+        args.unique_audio,
+    )
+    for lang in args.xnli_langs
+]
+
+throughput = {}
+
+for name, read_task, output_file, unique_audio in jobs:
+    num_examples, seconds = run_task(
+        models,
+        read_task(),
+        output_file,
+        name,
+        scoring=args.scoring,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        unique_audio=unique_audio,
+    )
+    throughput[name] = {
+        "examples": num_examples,
+        "seconds": seconds,
+        "examples_per_second": num_examples / seconds,
+    }
+    print(
+        f"{name}: {num_examples} examples in {seconds:.1f} s, "
+        f"{num_examples / seconds:.2f} examples/s"
+    )
+
+json.dump(throughput, open(f"{args.output}/throughput.json", "w"), indent=2)
+
+for name, t in throughput.items():
+    print(f"{name:20s} {t['examples']:6d} {t['examples_per_second']:8.2f} examples/s")
+
+print("Done")
@@ -0,0 +1,235 @@
+import csv
+import json
+import time
+from types import SimpleNamespace
+
+import torch
+from datasets import load_dataset
+from promptsource.templates import DatasetTemplates
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+from espnet2.tasks.asr import ASRTask
+from local.encoder_cache import open_encoder_cache
+from local.glue_eval import evaluate
+from local.mms_glue import task2list
+
+task2text = {
+    "cola": ["sentence"],
+    "mnli_matched": ["premise", "hypothesis"],
+    "mnli_mismatched": ["premise", "hypothesis"],
+    "mrpc": ["sentence1", "sentence2"],
+    "qnli": ["question", "sentence"],
+    "qqp": ["question1", "question2"],
+    "rte": ["sentence1", "sentence2"],
+    "sst2": ["sentence"],
+    "stsb": ["sentence1", "sentence2"],
+    "wnli": ["sentence1", "sentence2"],
+}
+
+task2template = {
+    "mnli_matched": "f3ebe1ac-194b-41e7-b008-36eafdbfbe25",
+    "mnli_mismatched": "770aa883-efec-4258-9e1e-1a96d0c20ed5",
+    "cola": "39a701ff-bb4b-48ac-8c0a-8c61bf0d4b8d",
+    "sst2": "63c6b2be-8ecd-42ad-88c7-0d1dc1a8323a",
+    "mrpc": "adf659af-4e2d-4e7e-ab89-b33cfc0b5a50",
+    "qqp": "8e711799-a57c-4941-833b-466bedfb80ad",
+    "stsb": "ca75788d-4974-440a-a7b7-c42bae814d59",
+    "qnli": "c626350d-6c0e-47be-b09e-c9ba1446b027",
+    "rte": "4ee6ff27-de63-4e7b-a9d4-82a17eba407a",
+    "wnli": "10c354ee-6f4e-4b04-91e1-29e999a8f3e7",
+}
+
+xnli_template = "172b73dc-d045-491c-9dc2-76bf6566c8ee"
+
+
+def load_models(asr_expdir, cache_dir=None):
+    """Load the ASR model and the 8-bit Hugging Face LLM of an experiment."""
+    asr_train_config = f"{asr_expdir}/config.yaml"
+    asr_model_file = f"{asr_expdir}/valid.acc.ave.pth"
+    ngpu = 1
+    dtype = "float32"
+
+    if ngpu >= 1:
+        device = "cuda:0"
+    else:
+        device = "cpu"
+
+    asr_model, asr_train_args = ASRTask.build_model_from_file(
+        asr_train_config, asr_model_file, device
+    )
+
+    asr_model.to(dtype=getattr(torch, dtype)).eval()
+
+    model_name_or_path = asr_train_args.decoder_conf["model_name_or_path"]
+    load_in_8bit = True
+
+    if torch.cuda.device_count() > 1:
+        device_map = "balanced_low_0"
+    else:
+        device_map = "auto"
+
+    hugging_face_model = AutoModelForCausalLM.from_pretrained(
+        model_name_or_path,
+        load_in_8bit=load_in_8bit,
+        device_map=device_map,
+    )
+
+    return SimpleNamespace(
+        asr_model=asr_model,
+        linear_in=asr_model.decoder.linear_in,
+        hugging_face_model=hugging_face_model,
+        hf_tokenizer=AutoTokenizer.from_pretrained(asr_train_args.bpemodel),
+        encoder_cache=open_encoder_cache(cache_dir, asr_train_config, asr_model_file),
+        device=device,
+        dtype=dtype,
+        load_in_8bit=load_in_8bit,
+    )
+
+
+def speechglue_task(glue_path, glue_task):
+    """Read the validation examples of a SpeechGLUE task.
+
+    Returns:
+        references, audio files of every example, speech fields,
+        prompt segments and answer options
+    """
+    if glue_task == "mnli_matched":
+        dataset = load_dataset("glue", "mnli", split="validation_matched")
+    elif glue_task == "mnli_mismatched":
+        dataset = load_dataset("glue", "mnli", split="validation_mismatched")
+    else:
+        dataset = load_dataset("glue", glue_task, split="validation")
+
+    speechglue_data = {}
+    data = open(f"{glue_path}/{glue_task}/validation/data.csv")
+
+    for l in csv.DictReader(data):
+        speechglue_data[l["idx"]] = l
+
+    data.close()
+
+    prompts = DatasetTemplates(f"glue/{glue_task}")
+    template = prompts.templates[task2template[glue_task]]
+
+    answer_options = set()
+
+    for e in dataset:
+        example = template.apply(e)
+        speechglue_data[str(e["idx"])]["label"] = example[1]
+        answer_options.add(example[1])
+
+    refs = []
+    wav_files = []
+    text_fields = task2text[glue_task]
+
+    for l in speechglue_data.values():
+        refs.append(l["label"])
+        wav_files.append(
+            [
+                l[f"file_{text_field}"]
+                .replace(".wav", ".flac")
+                .replace("arbeitsdaten45/projekte/asr-4", "arbeitsdaten/asr-3")
+                for text_field in text_fields
+            ]
+        )
+
+    return refs, wav_files, text_fields, task2list[glue_task], list(answer_options)
+
+
+def speechxnli_task(xnli_dir, lang):
+    """Read the validation examples of a SpeechXNLI language.
+
+    Returns:
+        references, audio files of every example, speech fields,
+        prompt segments and answer options
+    """
+    sentence2wav = {}
+    with open(f"{xnli_dir}/sentences_{lang}.txt", encoding="utf-8") as f:
+        i = 0
+        for l in f:
+            sentence2wav[
+                l.strip("\n")
+            ] = f"{xnli_dir}/audios/{lang}/xnli_validation_{i:04d}.flac"
+            i += 1
+
+    dataset = load_dataset("xnli", lang, split="validation")
+
+    prompts = DatasetTemplates("xnli/en")
+    template = prompts.templates[xnli_template]
+
+    answer_options = set()
+
+    for e in dataset:
+        example = template.apply(e)
+        answer_options.add(example[1])
+
+    refs = []
+    wav_files = []
+    text_fields = ["premise", "hypothesis"]
+
+    for l in dataset:
+        refs.append(l["label"])
+        wav_files.append([sentence2wav[l[text_field]] for text_field in text_fields])
+
+    return (
+        refs,
+        wav_files,
+        text_fields,
+        task2list["mnli_matched"],
+        list(answer_options),
+    )
+
+
+def run_task(
+    models,
+    task,
+    output_file,
+    name,
+    scoring="generate",
+    batch_size=8,
+    num_workers=2,
+    unique_audio=False,
+):
+    """Answer the examples of a task and write the refs/hyps JSON file.
+
+    Args:
+        models: load_models output
+        task: speechglue_task or speechxnli_task output
+    Returns:
+        number of examples and elapsed seconds
+    """
+    start = time.perf_counter()
+    refs, wav_files, text_fields, segments, answer_options = task
+
+    print(f"Answer options: {answer_options}")
+    force_words_ids = models.hf_tokenizer.batch_encode_plus(
+        answer_options, return_attention_mask=False
+    )["input_ids"]
+
+    hyps, scores = evaluate(
+        wav_files,
+        text_fields,
+        segments,
+        models.asr_model,
+        models.linear_in,
+        models.hugging_face_model,
+        models.hf_tokenizer,
+        answer_options,
+        force_words_ids,
+        models.device,
+        models.dtype,
+        models.load_in_8bit,
+        cache=models.encoder_cache,
+        scoring=scoring,
+        batch_size=batch_size,
+        num_workers=num_workers,
+        unique_audio=unique_audio,
+        name=name,
+    )
+
+    results = {"refs": refs, "hyps": hyps}
+    if scoring == "likelihood":
+        results["scores"] = scores
+    json.dump(results, open(output_file, "w"))
+
+    return len(refs), time.perf_counter() - start
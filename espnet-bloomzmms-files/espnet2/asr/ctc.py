@@ -1,5 +1,9 @@
+import math
+from typing import Sequence
+
 import torch
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from typeguard import check_argument_types
 
 
@@ -14,6 +18,11 @@ class CTC(torch.nn.Module):
         reduce: reduce the CTC loss into a scalar
         ignore_nan_grad: Same as zero_infinity (keeping for backward compatiblity)
         zero_infinity:  Whether to zero infinite losses and the associated gradients.
+        loss_chunk_size: If positive, the loss only uses the logits of the blank
+            and of the target tokens of the batch, and the logits of the other
+            tokens are reduced to one logsumexp column computed for
+            loss_chunk_size frames at a time and recomputed in the backward.
+            The loss and its gradient are the same as with the whole vocabulary.
     """
 
     def __init__(
@@ -28,6 +37,7 @@ class CTC(torch.nn.Module):
         bias: bool = True,
         length_adaptor_n_layers: int = 0,
         hidden_size: int = 0,
+        loss_chunk_size: int = 0,
     ):
         assert check_argument_types()
         super().__init__()
@@ -55,6 +65,9 @@ class CTC(torch.nn.Module):
             self.hidden_layer = torch.nn.Identity()
 
         self.ctc_lo = torch.nn.Linear(eprojs, odim, bias)
+        self.odim = odim
+        # The token ids of the outputs of a pruned ctc_lo
+        self.register_buffer("vocab_ids", None, persistent=False)
         self.ctc_type = ctc_type
         if ignore_nan_grad is not None:
             zero_infinity = ignore_nan_grad
@@ -71,6 +84,10 @@ class CTC(torch.nn.Module):
         else:
             raise ValueError(f'ctc_type must be "builtin" or "gtnctc": {self.ctc_type}')
 
+        if loss_chunk_size > 0 and self.ctc_type != "builtin":
+            raise ValueError("loss_chunk_size requires the builtin ctc_type")
+        self.loss_chunk_size = loss_chunk_size
+
         self.reduce = reduce
 
     def loss_fn(self, th_pred, th_target, th_ilen, th_olen) -> torch.Tensor:
@@ -102,6 +119,86 @@ class CTC(torch.nn.Module):
 
         return hs_pad
 
+    def prune_vocabulary(self, token_ids: Sequence[int]):
+        """Keep only the given tokens in the output layer, for inference.
+
+        ctc_lo is replaced by the rows of the kept tokens and the softmax is
+        normalized over them. softmax, log_softmax and argmax still return
+        the ids and columns of the whole vocabulary, the others having a zero
+        probability. The blank (0) is always kept.
+
+        Args:
+            token_ids: ids of the kept tokens in the whole vocabulary
+        """
+        if self.vocab_ids is not None:
+            raise RuntimeError("The output layer is already pruned")
+        weight = self.ctc_lo.weight
+        vocab_ids = torch.tensor(
+            sorted(set(token_ids) | {0}), dtype=torch.long, device=weight.device
+        )
+        ctc_lo = torch.nn.Linear(
+            weight.size(1),
+            len(vocab_ids),
+            self.ctc_lo.bias is not None,
+            device=weight.device,
+            dtype=weight.dtype,
+        )
+        with torch.no_grad():
+            ctc_lo.weight.copy_(weight[vocab_ids])
+            if self.ctc_lo.bias is not None:
+                ctc_lo.bias.copy_(self.ctc_lo.bias[vocab_ids])
+        self.ctc_lo = ctc_lo
+        self.vocab_ids = vocab_ids
+
+    def full_ids(self, ids: torch.Tensor) -> torch.Tensor:
+        """Map output indices of ctc_lo to ids of the whole vocabulary."""
+        if self.vocab_ids is None:
+            return ids
+        return self.vocab_ids[ids]
+
+    def _scatter_vocab(self, x: torch.Tensor, fill: float) -> torch.Tensor:
+        if self.vocab_ids is None:
+            return x
+        full = x.new_full(x.shape[:-1] + (self.odim,), fill)
+        full[..., self.vocab_ids] = x
+        return full
+
+    def _rest_logits(self, hs: torch.Tensor, columns: torch.Tensor) -> torch.Tensor:
+        logits = self.ctc_lo(hs)
+        return logits.index_fill(-1, columns, -math.inf).logsumexp(dim=-1)
+
+    def _reduced_ys_hat(self, hs_pad: torch.Tensor, ys_true: torch.Tensor):
+        """Logits of the blank, of the target tokens and of the other tokens.
+
+        The blank (0) and the target tokens keep their own columns, in the order
+        of their ids, and the last column is the logsumexp of the logits of the
+        other tokens. The log_softmax of the result is thus the log_softmax of
+        the whole vocabulary for the kept tokens.
+
+        Args:
+            hs_pad: (B, L, eprojs)
+            ys_true: concatenated target ids (sum(ys_lens),)
+        Returns:
+            ys_hat: (B, L, num_kept + 1) and the targets remapped to the kept
+                columns (sum(ys_lens),)
+        """
+        columns, inverse = torch.unique(
+            torch.cat([ys_true.new_zeros(1), ys_true]), return_inverse=True
+        )
+        bias = self.ctc_lo.bias[columns] if self.ctc_lo.bias is not None else None
+        kept = F.linear(hs_pad, self.ctc_lo.weight[columns], bias)
+
+        rest = []
+        for start in range(0, hs_pad.size(1), self.loss_chunk_size):
+            args = (hs_pad[:, start : start + self.loss_chunk_size], columns)
+            if torch.is_grad_enabled() and hs_pad.requires_grad:
+                rest.append(checkpoint(self._rest_logits, *args))
+            else:
+                rest.append(self._rest_logits(*args))
+
+        ys_hat = torch.cat([kept, torch.cat(rest, dim=1).unsqueeze(2)], dim=2)
+        return ys_hat, inverse[1:]
+
     def forward(self, hs_pad, hlens, ys_pad, ys_lens):
         """Calculate CTC loss.
 
@@ -111,9 +208,22 @@ class CTC(torch.nn.Module):
             ys_pad: batch of padded character id sequence tensor (B, Lmax)
             ys_lens: batch of lengths of character sequence (B)
         """
+        if self.vocab_ids is not None:
+            raise RuntimeError("The CTC loss needs the whole output layer")
         hs_pad = self._map_hs(hs_pad)
         hlens = hlens.float().div(self.length_adaptor_ratio).floor().long()
 
+        if self.loss_chunk_size > 0:
+            ys_true = torch.cat([ys_pad[i, :l] for i, l in enumerate(ys_lens)])
+            # hs_pad: (B, L, NProj) -> ys_hat: (L, B, num_kept + 1)
+            ys_hat, ys_true = self._reduced_ys_hat(
+                F.dropout(hs_pad, p=self.dropout_rate), ys_true
+            )
+            ys_hat = ys_hat.transpose(0, 1)
+            return self.loss_fn(ys_hat, ys_true, hlens, ys_lens).to(
+                device=hs_pad.device, dtype=hs_pad.dtype
+            )
+
         # hs_pad: (B, L, NProj) -> ys_hat: (B, L, Nvocab)
         ys_hat = self.ctc_lo(F.dropout(hs_pad, p=self.dropout_rate))
 
@@ -146,6 +256,8 @@ class CTC(torch.nn.Module):
 
         if self.hidden_size != 0:
             result = torch.matmul(result, self.ctc_lo.weight)
+        else:
+            result = self._scatter_vocab(result, 0.0)
 
         if result.shape[1] != hlen:
             result = F.interpolate(result.permute(0, 2, 1), (hlen)).permute(0, 2, 1)
@@ -161,7 +273,9 @@ class CTC(torch.nn.Module):
             torch.Tensor: log softmax applied 3d tensor (B, Tmax, odim)
         """
         hs_pad = self._map_hs(hs_pad)
-        return F.log_softmax(self.ctc_lo(hs_pad), dim=2)
+        return self._scatter_vocab(
+            F.log_softmax(self.ctc_lo(hs_pad), dim=2), -math.inf
+        )
 
     def argmax(self, hs_pad):
         """argmax of frame activations
@@ -172,4 +286,4 @@ class CTC(torch.nn.Module):
             torch.Tensor: argmax applied 2d tensor (B, Tmax)
         """
         hs_pad = self._map_hs(hs_pad)
-        return torch.argmax(self.ctc_lo(hs_pad), dim=2)
+        return self.full_ids(torch.argmax(self.ctc_lo(hs_pad), dim=2))
@@ -0,0 +1,118 @@
+"""Compression of encoder outputs guided by the CTC posteriors."""
+
+import math
+from typing import Tuple
+
+import torch
+from typeguard import check_argument_types
+
+from espnet2.asr.ctc import CTC
+from espnet.nets.pytorch_backend.nets_utils import make_non_pad_mask
+
+
+class CTCCompressor:
+    """Shorten encoder outputs by removing the frames where CTC predicts a blank.
+
+    The frames whose blank probability exceeds blank_threshold are dropped. In
+    the merge mode, the remaining runs of adjacent frames having the same CTC
+    argmax are also averaged into a single frame. Every utterance keeps at
+    least its least blank frame.
+
+    The CTC posteriors are computed without gradient, for chunk_size frames at
+    a time, and the compressed frames stay differentiable with respect to the
+    encoder outputs.
+
+    Args:
+        mode: "drop" or "merge"
+        blank_threshold: Frames with a larger blank probability are dropped
+        chunk_size: The number of frames projected to the vocabulary at a time
+
+    Examples:
+        >>> compressor = CTCCompressor(mode="merge")
+        >>> hs_pad, hlens = compressor(hs_pad, hlens, ctc)
+
+    """
+
+    def __init__(
+        self,
+        mode: str = "drop",
+        blank_threshold: float = 0.95,
+        chunk_size: int = 256,
+    ):
+        assert check_argument_types()
+        if mode not in ("drop", "merge"):
+            raise ValueError(f'mode must be "drop" or "merge": {mode}')
+        self.mode = mode
+        self.log_blank_threshold = math.log(blank_threshold)
+        self.chunk_size = chunk_size
+
+    @torch.no_grad()
+    def frame_labels(
+        self, hs_pad: torch.Tensor, ctc: CTC
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """CTC blank log probability and argmax of every frame.
+
+        Args:
+            hs_pad: (Batch, Length, Dim)
+            ctc: CTC module
+        Returns:
+            blank log probabilities (Batch, Length) and token ids (Batch, Length)
+        """
+        hs = ctc._map_hs(hs_pad)
+        blank_lp, ids = [], []
+        for start in range(0, hs.size(1), self.chunk_size):
+            logits = ctc.ctc_lo(hs[:, start : start + self.chunk_size]).float()
+            # The CTC blank is index 0, also in a pruned output layer
+            blank_lp.append(logits[:, :, 0] - logits.logsumexp(dim=2))
+            ids.append(ctc.full_ids(logits.argmax(dim=2)))
+        blank_lp, ids = torch.cat(blank_lp, dim=1), torch.cat(ids, dim=1)
+
+        if blank_lp.size(1) != hs_pad.size(1):
+            # Every CTC frame covers length_adaptor_ratio input frames
+            index = torch.arange(hs_pad.size(1), device=hs_pad.device)
+            index = torch.div(
+                index, ctc.length_adaptor_ratio, rounding_mode="floor"
+            ).clamp(max=blank_lp.size(1) - 1)
+            blank_lp, ids = blank_lp[:, index], ids[:, index]
+        return blank_lp, ids
+
+    def __call__(
+        self, hs_pad: torch.Tensor, hlens: torch.Tensor, ctc: CTC
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Compress a batch of encoder outputs.
+
+        Args:
+            hs_pad: (Batch, Length, Dim)
+            hlens: (Batch,)
+            ctc: CTC module
+        Returns:
+            compressed hs_pad (Batch, Length2, Dim) and its lengths (Batch,)
+        """
+        batch_size, _, dim = hs_pad.shape
+        blank_lp, ids = self.frame_labels(hs_pad, ctc)
+
+        valid = make_non_pad_mask(hlens, blank_lp, 1)
+        keep = valid & (blank_lp <= self.log_blank_threshold)
+        empty = ~keep.any(dim=1)
+        if bool(empty.any()):
+            least_blank = blank_lp.masked_fill(~valid, math.inf).argmin(dim=1)
+            keep[empty, least_blank[empty]] = True
+
+        # The kept frames starting a new output frame
+        start = keep.clone()
+        if self.mode == "merge":
+            start[:, 1:] &= ~(keep[:, :-1] & (ids[:, 1:] == ids[:, :-1]))
+
+        olens = start.sum(dim=1)
+        max_olen = int(olens.max())
+        group = start.cumsum(dim=1) - 1
+        offset = torch.arange(batch_size, device=hs_pad.device)[:, None] * max_olen
+        index = (offset + group)[keep]
+
+        kept = hs_pad[keep]
+        out = kept.new_zeros(batch_size * max_olen, dim).index_add(0, index, kept)
+        counts = kept.new_zeros(batch_size * max_olen).index_add(
+            0, index, kept.new_ones(kept.size(0))
+        )
+        out = out / counts.clamp(min=1).unsqueeze(1)
+        return out.view(batch_size, max_olen, dim), olens.to(hlens.dtype)
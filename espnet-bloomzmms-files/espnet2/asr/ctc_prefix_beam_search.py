@@ -0,0 +1,228 @@
+"""Batched CTC prefix beam search for large vocabularies."""
+
+import math
+from typing import List, Tuple
+
+import torch
+from typeguard import check_argument_types
+
+# Modulus and base of the rolling hash of the prefixes
+_HASH_MOD = 2**31 - 1
+_HASH_BASE = 1000003
+
+
+class CTCPrefixBeamSearch:
+    """CTC prefix beam search with the beams of a batch kept in tensors.
+
+    Only the topk most probable non-blank tokens of every frame are
+    considered, so that the cost of a frame does not depend on the vocabulary
+    size after the pruning. Frames whose blank probability exceeds
+    blank_threshold are skipped: the prefixes are only updated with the blank
+    and the repetition of their last token, without extensions.
+
+    The prefixes are identified by a rolling hash together with their length
+    and last token, and the hypotheses of the same prefix are merged.
+
+    Args:
+        beam_size: The number of prefixes kept after every frame
+        topk: The number of non-blank tokens considered per frame,
+            beam_size if 0
+        blank_id: The id of the blank
+        blank_threshold: Frames with a larger blank probability are skipped,
+            1.0 disables the skipping
+
+    Examples:
+        >>> search = CTCPrefixBeamSearch(beam_size=10)
+        >>> nbest = search(ctc.log_softmax(enc), enc_lens)
+        >>> token_ids, score = nbest[0][0]
+
+    """
+
+    def __init__(
+        self,
+        beam_size: int = 10,
+        topk: int = 0,
+        blank_id: int = 0,
+        blank_threshold: float = 0.999,
+    ):
+        assert check_argument_types()
+        self.beam_size = beam_size
+        self.topk = topk if topk > 0 else beam_size
+        self.blank_id = blank_id
+        self.log_blank_threshold = (
+            math.log(blank_threshold) if blank_threshold < 1.0 else math.inf
+        )
+
+    def prune(
+        self, log_probs: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Keep the blank and the topk non-blank tokens of every frame.
+
+        The log probabilities can be pruned in chunks of frames, so that those
+        of the whole vocabulary are never stored for all frames.
+
+        Args:
+            log_probs: (Batch, Length, Vocab)
+        Returns:
+            blank log probabilities (Batch, Length),
+            token log probabilities (Batch, Length, topk) and
+            token ids (Batch, Length, topk)
+        """
+        blank_lp = log_probs[:, :, self.blank_id]
+        log_probs = log_probs.clone()
+        log_probs[:, :, self.blank_id] = -math.inf
+        token_lp, token_ids = log_probs.topk(self.topk, dim=2)
+        return blank_lp, token_lp, token_ids
+
+    def __call__(
+        self, log_probs: torch.Tensor, lengths: torch.Tensor
+    ) -> List[List[Tuple[List[int], float]]]:
+        """Search the most probable label sequences.
+
+        Args:
+            log_probs: CTC log probabilities (Batch, Length, Vocab)
+            lengths: (Batch,)
+        Returns:
+            (token ids, log probability) of the beam_size best sequences of
+                every utterance, best first
+        """
+        return self.search(*self.prune(log_probs), lengths)
+
+    def search(
+        self,
+        blank_lp: torch.Tensor,
+        token_lp: torch.Tensor,
+        token_ids: torch.Tensor,
+        lengths: torch.Tensor,
+    ) -> List[List[Tuple[List[int], float]]]:
+        """Search the most probable label sequences from the pruned frames.
+
+        Args:
+            blank_lp: (Batch, Length)
+            token_lp: (Batch, Length, topk)
+            token_ids: (Batch, Length, topk)
+            lengths: (Batch,)
+        Returns:
+            (token ids, log probability) of the beam_size best sequences of
+                every utterance, best first
+        """
+        batch_size, max_length, topk = token_ids.shape
+        beam = self.beam_size
+        device = token_ids.device
+        blank_lp = blank_lp.float()
+        token_lp = token_lp.float()
+        lengths = lengths.to(device)
+        neg_inf = torch.tensor(-math.inf, device=device)
+
+        # Only the empty prefix is alive at the start
+        logp_b = torch.full((batch_size, beam), -math.inf, device=device)
+        logp_b[:, 0] = 0.0
+        logp_nb = torch.full((batch_size, beam), -math.inf, device=device)
+        prefix_hash = torch.zeros((batch_size, beam), dtype=torch.long, device=device)
+        prefix_len = torch.zeros((batch_size, beam), dtype=torch.long, device=device)
+        last = torch.full((batch_size, beam), -1, dtype=torch.long, device=device)
+        yseq = torch.zeros(
+            (batch_size, beam, max_length), dtype=torch.long, device=device
+        )
+
+        skip = blank_lp > self.log_blank_threshold
+        valid = torch.arange(max_length, device=device)[None, :] < lengths[:, None]
+        skip |= ~valid
+
+        for t in range(max_length):
+            # Padding frames keep the prefix probabilities
+            lp_blank = torch.where(valid[:, t], blank_lp[:, t], blank_lp.new_zeros(()))
+            # (Batch, beam, topk): the tokens of the frame equal to the last ones
+            is_last = token_ids[:, t, None, :] == last[:, :, None]
+            lp_last = torch.where(is_last, token_lp[:, t, None, :], neg_inf).amax(2)
+            lp_last = torch.where(valid[:, t, None], lp_last, neg_inf)
+
+            logp_total = torch.logaddexp(logp_b, logp_nb)
+            same_b = logp_total + lp_blank[:, None]
+            same_nb = logp_nb + lp_last
+
+            if bool(skip[:, t].all()):
+                logp_b, logp_nb = same_b, same_nb
+                continue
+
+            # Extensions of every prefix by every token of the frame. After
+            # the same token, only the paths ending with a blank extend it.
+            ext_nb = (
+                torch.where(is_last, logp_b[:, :, None], logp_total[:, :, None])
+                + token_lp[:, t, None, :]
+            )
+            ext_nb = torch.where(skip[:, t, None, None], neg_inf, ext_nb)
+
+            # Candidates: the prefixes themselves, then their extensions
+            ids = token_ids[:, t, None, :].expand(-1, beam, -1).flatten(1)
+            cand_b = torch.cat([same_b, neg_inf.expand(batch_size, beam * topk)], 1)
+            cand_nb = torch.cat([same_nb, ext_nb.flatten(1)], 1)
+            cand_hash = torch.cat(
+                [
+                    prefix_hash,
+                    (
+                        prefix_hash.repeat_interleave(topk, dim=1) * _HASH_BASE
+                        + ids
+                        + 1
+                    )
+                    % _HASH_MOD,
+                ],
+                1,
+            )
+            cand_len = torch.cat(
+                [prefix_len, prefix_len.repeat_interleave(topk, dim=1) + 1], 1
+            )
+            cand_last = torch.cat([last, ids], 1)
+            cand_token = torch.cat([torch.full_like(last, -1), ids], 1)
+            cand_parent = torch.cat(
+                [
+                    torch.arange(beam, device=device),
+                    torch.arange(beam, device=device).repeat_interleave(topk),
+                ]
+            )
+
+            # Merge the candidates of the same prefix into the first of them
+            same = (
+                (cand_hash[:, :, None] == cand_hash[:, None, :])
+                & (cand_len[:, :, None] == cand_len[:, None, :])
+                & (cand_last[:, :, None] == cand_last[:, None, :])
+            )
+            merged_b = torch.where(same, cand_b[:, None, :], neg_inf).logsumexp(2)
+            merged_nb = torch.where(same, cand_nb[:, None, :], neg_inf).logsumexp(2)
+            num_cands = cand_hash.size(1)
+            earlier = torch.ones(
+                (num_cands, num_cands), dtype=torch.bool, device=device
+            ).tril(-1)
+            first = ~(same & earlier).any(2)
+            score = torch.where(first, torch.logaddexp(merged_b, merged_nb), neg_inf)
+            score, best = score.topk(beam, dim=1)
+
+            # The beams without a probable prefix must not duplicate others
+            alive = torch.isfinite(score)
+            logp_b = torch.where(alive, merged_b.gather(1, best), neg_inf)
+            logp_nb = torch.where(alive, merged_nb.gather(1, best), neg_inf)
+            prefix_hash = cand_hash.gather(1, best)
+            prefix_len = cand_len.gather(1, best)
+            last = cand_last.gather(1, best)
+
+            token = cand_token.gather(1, best)
+            yseq = yseq.gather(1, cand_parent[best][:, :, None].expand_as(yseq))
+            pos = (prefix_len - 1).clamp(min=0)[:, :, None]
+            token = torch.where(token >= 0, token, yseq.gather(2, pos).squeeze(2))
+            yseq.scatter_(2, pos, token[:, :, None])
+
+        score, order = torch.logaddexp(logp_b, logp_nb).sort(dim=1, descending=True)
+        yseq = yseq.gather(1, order[:, :, None].expand_as(yseq)).cpu()
+        prefix_len = prefix_len.gather(1, order).tolist()
+        score = score.tolist()
+
+        results = []
+        for b in range(batch_size):
+            results.append(
+                [
+                    (yseq[b, w, : prefix_len[b][w]].tolist(), score[b][w])
+                    for w in range(beam)
+                    if score[b][w] > -math.inf
+                ]
+            )
+        return results
@@ -4,12 +4,12 @@
 
 """Hugging Face Transformers Decoder."""
 
+import contextlib
 import copy
 import logging
-from typing import Tuple
+from typing import List, Optional, Tuple
 
 import torch
-import torch.nn.functional as F
 from typeguard import check_argument_types
 
 from espnet2.asr.decoder.abs_decoder import AbsDecoder
@@ -39,6 +39,13 @@ class HuggingFaceTransformersDecoder(AbsDecoder):
     Args:
         encoder_output_size: dimension of encoder attention
         model_name_or_path: Hugging Face Transformers model name
+        cache_prefix: reuse the keys and values of the constant prefix of a causal
+            LM, computed once per device, instead of recomputing them for every
+            sequence. The decoder must be frozen, which is checked in training.
+        pack_sequences: concatenate several sequences into one row of a causal LM
+            in the forward instead of padding every sequence to the longest one.
+            Every sequence gets its own positions and only attends to itself
+            (and to the cached prefix). Only supported for BLOOM.
     """
 
     def __init__(
@@ -54,6 +61,8 @@ class HuggingFaceTransformersDecoder(AbsDecoder):
         prefix_tuning_template_text: str = "",
         load_in_8bit: bool = False,
         torch_compile: bool = False,
+        cache_prefix: bool = False,
+        pack_sequences: bool = False,
     ):
         assert check_argument_types()
         super().__init__()
@@ -123,10 +132,14 @@ class HuggingFaceTransformersDecoder(AbsDecoder):
             )
 
             self.prefix_tuning = True
+            self.cache_prefix = False
+            self.pack_sequences = False
         else:
             self.prefix_tuning = False
 
             self.causal_lm = causal_lm
+            self.cache_prefix = cache_prefix
+            self.pack_sequences = pack_sequences
 
             self._init_args = {
                 "vocab_size": vocab_size,
@@ -142,6 +155,9 @@ class HuggingFaceTransformersDecoder(AbsDecoder):
             self.linear_in = torch.nn.Identity()
             # self.linear_in = torch.nn.Linear(1024, 4096)
 
+            # device -> keys and values of self.prefix
+            self._prefix_past_key_values = {}
+
             if load_in_8bit:
                 # self._init()
                 self.decoder = None
@@ -154,6 +170,7 @@ class HuggingFaceTransformersDecoder(AbsDecoder):
         hlens: torch.Tensor,
         ys_in_pad: torch.Tensor,
         ys_in_lens: torch.Tensor,
+        return_hidden: bool = False,
         **kwargs,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """Forward decoder.
@@ -163,6 +180,8 @@ class HuggingFaceTransformersDecoder(AbsDecoder):
             hlens: (batch)
             ys_in_pad: input tensor (batch, maxlen_out, #mels)
             ys_in_lens: (batch)
+            return_hidden: return the hidden states before lm_head instead of
+                the token scores, e.g. for a loss fused with lm_head
         Returns:
             (tuple): tuple containing:
 
@@ -176,6 +195,14 @@ class HuggingFaceTransformersDecoder(AbsDecoder):
 
         enc_out = self.linear_in(hs_pad)
 
+        if (
+            self.cache_prefix
+            and self.training
+            and any(p.requires_grad for p in self.decoder.parameters())
+        ):
+            # The cached keys and values get no gradient and would go stale
+            raise RuntimeError("cache_prefix requires a frozen decoder in training")
+
         if self.causal_lm:
             prefix, prefix_lengths, postfix, postfix_lengths = None, None, None, None
 
@@ -187,7 +214,7 @@ class HuggingFaceTransformersDecoder(AbsDecoder):
                 postfix = kwargs["postfix"]
                 postfix_lengths = kwargs["postfix_lengths"]
 
-            args, no_loss_lengths = self.add_prefix_postfix(
+            args, output_start = self.add_prefix_postfix(
                 enc_out,
                 hlens,
                 ys_in_pad,
@@ -196,6 +223,7 @@ class HuggingFaceTransformersDecoder(AbsDecoder):
                 prefix_lengths,
                 postfix,
                 postfix_lengths,
+                pack=self.pack_sequences,
             )
         else:
             args = {"return_dict": True}
@@ -213,36 +241,24 @@ class HuggingFaceTransformersDecoder(AbsDecoder):
 
         if self.prefix_tuning:
             x = self.decoder.prompt_model(args).logits
+        elif "packing" in args:
+            with self._packed_attention(*args.pop("packing")):
+                x = self.decoder(**args).last_hidden_state
         else:
             x = self.decoder(**args).last_hidden_state
 
         if self.causal_lm:
-            if self.tokenizer_padding_side == "left":
-                x = torch.vstack(
-                    [
-                        F.pad(
-                            x[i, -ys_in_lens[i] :, :],
-                            (0, 0, 0, ys_in_lens.max() - ys_in_lens[i]),
-                        ).unsqueeze(0)
-                        for i in range(x.shape[0])
-                    ]
-                )
-            else:
-                x = torch.vstack(
-                    [
-                        F.pad(
-                            x[
-                                i,
-                                no_loss_lengths[i] : no_loss_lengths[i] + ys_in_lens[i],
-                                :,
-                            ],
-                            (0, 0, 0, ys_in_lens.max() - ys_in_lens[i]),
-                        ).unsqueeze(0)
-                        for i in range(x.shape[0])
-                    ]
-                )
+            # Gather the outputs for ys_in_pad, which end every sequence
+            positions = torch.arange(int(ys_in_lens.max()), device=x.device)
+            index = (output_start.unsqueeze(1) + positions).clamp(
+                max=x.shape[0] * x.shape[1] - 1
+            )
+            x = x.reshape(-1, x.shape[2])[index]
+            x = x.masked_fill(make_pad_mask(ys_in_lens, x, 1), 0.0)
 
-        if not self.prefix_tuning:
+        if return_hidden:
+            assert not self.prefix_tuning, "prefix tuning only returns token scores"
+        elif not self.prefix_tuning:
             x = self.lm_head(x)
 
         return x, ys_in_lens
@@ -253,8 +269,15 @@ class HuggingFaceTransformersDecoder(AbsDecoder):
         # if self.lm_head_pretrained_params is not None:
         #    self.lm_head.load_state_dict(self.lm_head_pretrained_params)
 
+        self._prefix_past_key_values = {}
         logging.info("Pretrained Transformers model parameters reloaded!")
 
+    def _load_from_state_dict(self, *args, **kwargs):
+        # Also called by load_state_dict of a parent module. The keys and values of
+        # the prefix depend on the loaded parameters.
+        self._prefix_past_key_values = {}
+        super()._load_from_state_dict(*args, **kwargs)
+
     def _init(self):
         vocab_size = self._init_args["vocab_size"]
         model_name_or_path = self._init_args["model_name_or_path"]
@@ -329,6 +352,220 @@ class HuggingFaceTransformersDecoder(AbsDecoder):
         if self._init_args["torch_compile"]:
             self.decoder = torch.compile(self.decoder)
 
+    def causal_lm_for_generation(self) -> torch.nn.Module:
+        """Wrap the decoder and lm_head into a causal LM, e.g. for generate.
+
+        The wrapper is built without weights and then given the modules of this
+        decoder, so no second copy of the model is loaded.
+
+        Returns:
+            AutoModelForCausalLM sharing the decoder and lm_head
+        """
+        from accelerate import init_empty_weights
+
+        assert self.causal_lm and not self.prefix_tuning
+        decoder = getattr(self.decoder, "_orig_mod", self.decoder)
+        with init_empty_weights():
+            model = AutoModelForCausalLM.from_config(decoder.config)
+        model.transformer = decoder
+        model.lm_head = self.lm_head
+        model.is_loaded_in_8bit = self._init_args["load_in_8bit"]
+        return model
+
+    def prefix_past_key_values(self, batch_size: int) -> Tuple:
+        """Get the keys and values of the constant prefix for a batch.
+
+        They are computed once per device and repeated batch_size times.
+
+        Args:
+            batch_size: number of sequences
+        Returns:
+            past_key_values of self.prefix in the format of the decoder
+        """
+        device = self.prefix.device
+        past_key_values = self._prefix_past_key_values.get(device)
+        if past_key_values is None:
+            prefix = self.prefix
+            if self._init_args["load_in_8bit"]:
+                prefix = prefix.to(torch.half)
+            # Gradient checkpointing disables the cache in training mode
+            training = self.decoder.training
+            self.decoder.eval()
+            with torch.no_grad():
+                past_key_values = self.decoder(
+                    inputs_embeds=prefix, use_cache=True, return_dict=True
+                ).past_key_values
+            self.decoder.train(training)
+            self._prefix_past_key_values[device] = past_key_values
+
+        # The batch is the leading dimension of the keys and values
+        return tuple(
+            tuple(t.repeat(batch_size, *[1] * (t.dim() - 1)) for t in layer)
+            for layer in past_key_values
+        )
+
+    def _placement(
+        self, lengths: torch.Tensor, pack: bool
+    ) -> Tuple[torch.Tensor, torch.Tensor, int, int]:
+        """Place the sequences in the rows of the decoder input.
+
+        Without packing, every sequence has its own row and is padded on the side
+        given by the tokenizer. With packing, the sequences are assigned to rows
+        of the same length by first-fit decreasing.
+
+        Args:
+            lengths: (batch,)
+            pack: whether several sequences may share a row
+        Returns:
+            row index of every sequence (batch,)
+            start position of every sequence in its row (batch,)
+            number of rows
+            row length
+        """
+        max_length = int(lengths.max())
+        if pack:
+            fill = []
+            rows = [0] * len(lengths)
+            starts = [0] * len(lengths)
+            for i, length in sorted(
+                enumerate(lengths.tolist()), key=lambda x: x[1], reverse=True
+            ):
+                row = next(
+                    (r for r, f in enumerate(fill) if f + length <= max_length),
+                    len(fill),
+                )
+                if row == len(fill):
+                    fill.append(0)
+                rows[i], starts[i] = row, fill[row]
+                fill[row] += length
+            return (
+                torch.tensor(rows, device=lengths.device),
+                torch.tensor(starts, device=lengths.device),
+                len(fill),
+                max_length,
+            )
+
+        rows = torch.arange(len(lengths), device=lengths.device)
+        if self.tokenizer_padding_side == "left":
+            starts = max_length - lengths
+        else:
+            starts = torch.zeros_like(lengths)
+        return rows, starts, len(lengths), max_length
+
+    def _assemble(
+        self,
+        segments: List[torch.Tensor],
+        segment_lengths: torch.Tensor,
+        first: torch.Tensor,
+        num_rows: int,
+        max_length: int,
+    ) -> torch.Tensor:
+        """Concatenate the valid parts of the segments of every sequence.
+
+        All the frames are written into a pad embedding filled output by a single
+        scatter. The invalid frames of the segments are sent to an extra frame,
+        which is dropped.
+
+        Args:
+            segments: list of (batch, maxlen_k, hidden) embeddings
+            segment_lengths: (batch, len(segments))
+            first: flat output position of the first frame of every sequence
+                (batch,)
+            num_rows: number of output rows
+            max_length: length of the output rows
+        Returns:
+            inputs embeddings (num_rows, max_length, hidden)
+        """
+        src = torch.cat(segments, dim=1)
+        device = src.device
+        total, hidden = src.shape[1:]
+
+        # Segment index and position inside the segment of every column of src
+        segment_sizes = torch.tensor([x.shape[1] for x in segments], device=device)
+        segment_ids = torch.repeat_interleave(
+            torch.arange(len(segments), device=device), segment_sizes
+        )
+        local = torch.arange(total, device=device) - (
+            torch.cumsum(segment_sizes, 0) - segment_sizes
+        )[segment_ids]
+
+        # Flat output position of every column of src
+        offsets = torch.cumsum(segment_lengths, 1) - segment_lengths
+        index = first.unsqueeze(1) + offsets[:, segment_ids] + local
+        index = index.masked_fill(
+            local >= segment_lengths[:, segment_ids], num_rows * max_length
+        )
+
+        padding = self.decoder.word_embeddings(
+            torch.tensor([self.decoder_pad_token_id], device=device)
+        ).to(src.dtype)
+        out = padding.repeat(num_rows * max_length + 1, 1)
+        out = out.scatter(
+            0, index.view(-1, 1).expand(-1, hidden), src.reshape(-1, hidden)
+        )
+        return out[:-1].view(num_rows, max_length, hidden)
+
+    @contextlib.contextmanager
+    def _packed_attention(self, sequence_ids: torch.Tensor, positions: torch.Tensor):
+        """Make BLOOM attend within the packed sequences only.
+
+        The ALiBi biases and the causal mask, which BLOOM derives from the
+        attention mask, are replaced for the duration of the context.
+
+        Args:
+            sequence_ids: sequence of every input frame, 0 for padding
+                (num_rows, max_length)
+            positions: position of every key frame in its sequence, after the
+                past keys (num_rows, past_length + max_length)
+        """
+        import transformers
+        from transformers.models.bloom.modeling_bloom import build_alibi_tensor
+
+        model = getattr(self.decoder, "_orig_mod", self.decoder)
+        # Without these hooks of BloomModel.forward the patch would do nothing and
+        # the packed sequences would attend to each other
+        if type(model).__name__ != "BloomModel" or not all(
+            hasattr(type(model), name)
+            for name in ("build_alibi_tensor", "_prepare_attn_mask")
+        ):
+            raise RuntimeError(
+                "pack_sequences requires a BloomModel with build_alibi_tensor and "
+                f"_prepare_attn_mask, got {type(model).__name__} of transformers "
+                f"{transformers.__version__}"
+            )
+
+        def packed_alibi_tensor(attention_mask, num_heads, dtype):
+            # The bias of every head is its slope times the key position
+            slopes = build_alibi_tensor(
+                attention_mask.new_ones(1, 2), num_heads, torch.float32
+            )[:, 0, 1]
+            alibi = slopes.view(1, -1, 1) * positions.unsqueeze(1)
+            return alibi.reshape(-1, 1, positions.shape[1]).to(dtype)
+
+        def packed_attn_mask(attention_mask, input_shape, past_key_values_length):
+            # True for the keys which are not attended
+            length = sequence_ids.shape[1]
+            causal = torch.ones(
+                length, length, dtype=torch.bool, device=sequence_ids.device
+            ).tril()
+            attend = causal & (
+                sequence_ids.unsqueeze(2) == sequence_ids.unsqueeze(1)
+            )
+            # The past keys are shared by all the sequences
+            attend = torch.cat(
+                [attend.new_ones(*attend.shape[:2], past_key_values_length), attend],
+                dim=2,
+            )
+            return ~attend.unsqueeze(1)
+
+        model.build_alibi_tensor = packed_alibi_tensor
+        model._prepare_attn_mask = packed_attn_mask
+        try:
+            yield
+        finally:
+            del model.build_alibi_tensor
+            del model._prepare_attn_mask
+
     def add_prefix_postfix(
         self,
         enc_out,
@@ -339,11 +576,34 @@ class HuggingFaceTransformersDecoder(AbsDecoder):
         prefix_lengths=None,
         postfix=None,
         postfix_lengths=None,
+        cache_prefix: Optional[bool] = None,
+        pack: bool = False,
     ):
+        """Assemble the causal LM inputs.
+
+        Every sequence consists of the prefix, the encoder output, the postfix
+        and ys_in_pad without <sos>.
+
+        Returns:
+            keyword arguments of the decoder, which contain "packing" if pack is
+                True (to be popped and given to _packed_attention)
+            flat position of the first output for ys_in_pad in the decoder
+                output of every sequence (batch,)
+        """
         args = {}
 
+        if cache_prefix is None:
+            cache_prefix = self.cache_prefix
+
         if prefix is not None:
             ys_prefixes = self.decoder.word_embeddings(prefix.long())
+            cache_prefix = False
+        elif cache_prefix:
+            # The sequences start after the prefix, whose keys and values are reused
+            ys_prefixes = self.prefix[:, :0].expand(ys_in_pad.shape[0], -1, -1)
+            prefix_lengths = torch.zeros(
+                ys_in_pad.shape[0], dtype=torch.long, device=enc_out.device
+            )
         else:
             ys_prefixes = self.prefix.repeat(ys_in_pad.shape[0], 1, 1)
             prefix_lengths = (
@@ -367,50 +627,73 @@ class HuggingFaceTransformersDecoder(AbsDecoder):
         )  # the last element of postfix should predict ys_in_lens[1]
         inputs_lengths = no_loss_lengths + ys_in_lens  # ys_in_lens[0] is <sos>
 
-        enc_out_list = []
-
-        for i in range(len(hlens)):
-            enc_out_element = [
-                ys_prefixes[i : i + 1, : prefix_lengths[i]],
-                enc_out[i : i + 1, : hlens[i], :],
-                ys_postfixes[i : i + 1, : postfix_lengths[i]],
-                self.decoder.word_embeddings(ys_in_pad[i : i + 1, 1 : ys_in_lens[i]]),
-            ]
-
-            padding = self.decoder.word_embeddings(
-                torch.tensor([[self.decoder_pad_token_id]]).to(enc_out.device)
-            ).expand(
-                -1,
-                inputs_lengths.max()
-                - (
-                    prefix_lengths[i]
-                    + hlens[i]
-                    + postfix_lengths[i]
-                    + ys_in_lens[i]
-                    - 1
-                ),
-                -1,
-            )
-
-            if self.tokenizer_padding_side == "left":
-                enc_out_element.insert(0, padding)
-            else:
-                enc_out_element.insert(len(enc_out_element), padding)
-
-            enc_out_list.append(torch.cat(enc_out_element, dim=1))
+        segments = [
+            ys_prefixes,
+            enc_out,
+            ys_postfixes,
+            self.decoder.word_embeddings(ys_in_pad[:, 1:]),
+        ]
+        # (Batch, NSegments)
+        segment_lengths = torch.stack(
+            [prefix_lengths, hlens, postfix_lengths, ys_in_lens - 1], dim=1
+        ).to(enc_out.device)
+        rows, starts, num_rows, max_length = self._placement(inputs_lengths, pack)
+        first = rows * max_length + starts
+        inputs_embeds = self._assemble(
+            segments, segment_lengths, first, num_rows, max_length
+        )
 
-        args["inputs_embeds"] = torch.vstack(enc_out_list)
+        args["inputs_embeds"] = inputs_embeds
         if self._init_args["load_in_8bit"]:
             args["inputs_embeds"] = args["inputs_embeds"].to(torch.half)
 
-        hs_mask = (~make_pad_mask(inputs_lengths)).to(enc_out.device).float()
-
-        if self.tokenizer_padding_side == "left":
-            args["attention_mask"] = hs_mask.flip([1])
+        if pack:
+            # Sequence index (from 1) and position of every frame of the rows
+            local = torch.arange(
+                int(inputs_lengths.sum()), device=enc_out.device
+            ) - torch.repeat_interleave(
+                torch.cumsum(inputs_lengths, 0) - inputs_lengths, inputs_lengths
+            )
+            flat = torch.repeat_interleave(first, inputs_lengths) + local
+            sequence_ids = torch.zeros(
+                num_rows * max_length, dtype=torch.long, device=enc_out.device
+            )
+            sequence_ids[flat] = torch.repeat_interleave(
+                torch.arange(1, len(inputs_lengths) + 1, device=enc_out.device),
+                inputs_lengths,
+            )
+            positions = torch.zeros_like(sequence_ids)
+            positions[flat] = local
+            sequence_ids = sequence_ids.view(num_rows, max_length)
+            positions = positions.view(num_rows, max_length)
+            hs_mask = (sequence_ids > 0).float()
         else:
-            args["attention_mask"] = hs_mask
+            hs_mask = (~make_pad_mask(inputs_lengths)).to(enc_out.device).float()
+            if self.tokenizer_padding_side == "left":
+                hs_mask = hs_mask.flip([1])
+        args["attention_mask"] = hs_mask
+
+        if cache_prefix:
+            args["past_key_values"] = self.prefix_past_key_values(num_rows)
+            args["attention_mask"] = torch.cat(
+                [hs_mask.new_ones(num_rows, self.prefix.shape[1]), hs_mask],
+                dim=1,
+            )
+
+        if pack:
+            past_length = args["attention_mask"].shape[1] - max_length
+            positions = torch.cat(
+                [
+                    torch.arange(past_length, device=enc_out.device).expand(
+                        num_rows, -1
+                    ),
+                    positions + past_length,
+                ],
+                dim=1,
+            )
+            args["packing"] = (sequence_ids, positions)
 
         if not self.prefix_tuning:
             args["return_dict"] = True
 
-        return args, no_loss_lengths
+        return args, first + no_loss_lengths
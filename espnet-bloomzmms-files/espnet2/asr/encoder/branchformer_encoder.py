@@ -12,7 +12,7 @@ Reference:
 """
 
 import logging
-from typing import List, Optional, Tuple, Union
+from typing import Dict, List, Optional, Tuple, Union
 
 import numpy
 import torch
@@ -45,6 +45,15 @@ from espnet.nets.pytorch_backend.transformer.subsampling import (
     check_short_utt,
 )
 
+# Receptive field and stride of the subsampling layers, in input frames
+SUBSAMPLING_WINDOWS = {
+    Conv2dSubsampling: (7, 4),
+    Conv2dSubsampling1: (5, 1),
+    Conv2dSubsampling2: (7, 2),
+    Conv2dSubsampling6: (11, 6),
+    Conv2dSubsampling8: (15, 8),
+}
+
 
 class BranchformerEncoderLayer(torch.nn.Module):
     """Branchformer encoder layer module.
@@ -143,21 +152,27 @@ class BranchformerEncoderLayer(torch.nn.Module):
                 - w/ pos emb: Tuple of tensors [(#batch, time, size), (1, time, size)].
                 - w/o pos emb: Tensor (#batch, time, size).
             mask (torch.Tensor): Mask tensor for the input (#batch, 1, time).
-            cache (torch.Tensor): Cache tensor of the input (#batch, time - 1, size).
+            cache (torch.Tensor): Inputs of the previous frames
+                (#batch, cache_time, size), the left context of the attention and
+                of the cgMLP convolution. The mask and pos emb then cover the
+                cache_time + time frames and only the outputs of the time new
+                frames are returned.
 
         Returns:
             torch.Tensor: Output tensor (#batch, time, size).
             torch.Tensor: Mask tensor (#batch, time).
         """
 
-        if cache is not None:
-            raise NotImplementedError("cache is not None, which is not tested")
-
         if isinstance(x_input, tuple):
             x, pos_emb = x_input[0], x_input[1]
         else:
             x, pos_emb = x_input, None
 
+        num_cached = 0
+        if cache is not None:
+            num_cached = cache.size(1)
+            x = torch.cat([cache, x], dim=1)
+
         skip_layer = False
         # with stochastic depth, residual connection `x + f(x)` becomes
         # `x <- x + 1 / (1 - p) * f(x)` at training time.
@@ -167,8 +182,9 @@ class BranchformerEncoderLayer(torch.nn.Module):
             stoch_layer_coeff = 1.0 / (1 - self.stochastic_depth_rate)
 
         if skip_layer:
-            if cache is not None:
-                x = torch.cat([cache, x], dim=1)
+            x = x[:, num_cached:]
+            if mask is not None:
+                mask = mask[:, :, num_cached:]
             if pos_emb is not None:
                 return (x, pos_emb), mask
             return x, mask
@@ -285,7 +301,9 @@ class BranchformerEncoderLayer(torch.nn.Module):
                 # This should not happen
                 raise RuntimeError("Both branches are not None, which is unexpected.")
 
-        x = self.norm_final(x)
+        x = self.norm_final(x[:, num_cached:])
+        if mask is not None:
+            mask = mask[:, :, num_cached:]
 
         if pos_emb is not None:
             return (x, pos_emb), mask
@@ -559,3 +577,130 @@ class BranchformerEncoder(AbsEncoder):
         xs_pad = self.after_norm(xs_pad)
         olens = masks.squeeze(1).sum(1)
         return xs_pad, olens, None
+
+    def _encoder_layers(self) -> torch.nn.Module:
+        # The layers of a compiled module are those of the original one
+        return getattr(self.encoders, "_orig_mod", self.encoders)
+
+    def _streaming_embed(self, xs: torch.Tensor) -> torch.Tensor:
+        if type(self.embed) in SUBSAMPLING_WINDOWS:
+            xs, _ = self.embed(xs, None)
+        else:
+            xs = self.embed(xs)
+        if isinstance(xs, tuple):
+            xs = xs[0]
+        return xs
+
+    def _streaming_pos_emb(self, length: int, xs: torch.Tensor) -> torch.Tensor:
+        if isinstance(self.embed, torch.nn.Sequential):
+            pos_enc = self.embed[-1]
+        else:
+            pos_enc = self.embed.out[-1]
+        relative = (RelPositionalEncoding, LegacyRelPositionalEncoding)
+        if not isinstance(pos_enc, relative):
+            raise NotImplementedError(
+                "Streaming needs a relative positional encoding: "
+                f"{type(pos_enc).__name__}"
+            )
+        return pos_enc(xs.new_zeros(1, length, self._output_size))[1]
+
+    def _forward_block(
+        self,
+        xs: torch.Tensor,
+        caches: List[torch.Tensor],
+        num_frames: int,
+        left_context: int,
+    ) -> torch.Tensor:
+        """Encode a block whose first num_frames frames are output.
+
+        The frames after them are the look-ahead, only used as right context.
+        The caches of every layer are updated with the inputs of the output
+        frames.
+        """
+        for i, layer in enumerate(self._encoder_layers()):
+            cache = caches[i]
+            length = cache.size(1) + xs.size(1)
+            pos_emb = self._streaming_pos_emb(length, xs)
+            masks = xs.new_ones((xs.size(0), 1, length), dtype=torch.bool)
+            caches[i] = torch.cat([cache, xs[:, :num_frames]], dim=1)[
+                :, max(cache.size(1) + num_frames - left_context, 0) :
+            ]
+            (xs, _), _ = layer((xs, pos_emb), masks, cache)
+        return self.after_norm(xs[:, :num_frames])
+
+    def forward_streaming(
+        self,
+        xs_pad: torch.Tensor,
+        prev_states: Optional[Dict] = None,
+        is_final: bool = False,
+        chunk_size: int = 16,
+        left_context: int = 64,
+        lookahead: int = 4,
+    ) -> Tuple[torch.Tensor, Dict]:
+        """Encode the next input frames of a stream block by block.
+
+        The subsampled frames are encoded in blocks of chunk_size frames,
+        followed by lookahead frames of right context, which are encoded again
+        in the next block. Every layer attends and convolves over the inputs
+        of its left_context previous frames, kept in the states.
+
+        Args:
+            xs_pad (torch.Tensor): Next input frames (#batch, L, input_size).
+            prev_states (dict): States returned by the previous call, or None at
+                the start of the stream.
+            is_final (bool): Encode all the remaining frames, without waiting for
+                the look-ahead of the last block.
+            chunk_size (int): The number of output frames of every block.
+            left_context (int): The number of cached frames of every layer.
+            lookahead (int): The number of right context frames of every block.
+
+        Returns:
+            torch.Tensor: Output of the completed blocks (#batch, L', output_size).
+            dict: States of the stream.
+
+        """
+        if prev_states is None:
+            prev_states = {
+                "input_buffer": xs_pad[:, :0],
+                "embed_buffer": xs_pad.new_zeros(xs_pad.size(0), 0, self._output_size),
+                "caches": [
+                    xs_pad.new_zeros(xs_pad.size(0), 0, self._output_size)
+                    for _ in self._encoder_layers()
+                ],
+            }
+
+        # 1. Subsample the input frames whose receptive field is complete
+        window, stride = SUBSAMPLING_WINDOWS.get(type(self.embed), (1, 1))
+        xs = torch.cat([prev_states["input_buffer"], xs_pad], dim=1)
+        num_subsampled = max((xs.size(1) - window) // stride + 1, 0)
+        embed_buffer = prev_states["embed_buffer"]
+        if num_subsampled > 0:
+            embedded = self._streaming_embed(
+                xs[:, : (num_subsampled - 1) * stride + window]
+            )
+            embed_buffer = torch.cat([embed_buffer, embedded], dim=1)
+        input_buffer = xs[:, num_subsampled * stride :]
+
+        # 2. Encode the blocks having their look-ahead
+        caches = list(prev_states["caches"])
+        outputs = [embed_buffer[:, :0]]
+        while embed_buffer.size(1) >= chunk_size + lookahead or (
+            is_final and embed_buffer.size(1) > 0
+        ):
+            num_frames = min(chunk_size, embed_buffer.size(1))
+            outputs.append(
+                self._forward_block(
+                    embed_buffer[:, : num_frames + lookahead],
+                    caches,
+                    num_frames,
+                    left_context,
+                )
+            )
+            embed_buffer = embed_buffer[:, num_frames:]
+
+        states = {
+            "input_buffer": input_buffer,
+            "embed_buffer": embed_buffer,
+            "caches": caches,
+        }
+        return torch.cat(outputs, dim=1), states
@@ -1,3 +1,4 @@
+import inspect
 import logging
 from contextlib import contextmanager
 from typing import Dict, List, Optional, Tuple, Union
@@ -7,6 +8,7 @@ from packaging.version import parse as V
 from typeguard import check_argument_types
 
 from espnet2.asr.ctc import CTC
+from espnet2.asr.ctc_compressor import CTCCompressor
 from espnet2.asr.decoder.abs_decoder import AbsDecoder
 from espnet2.asr.encoder.abs_encoder import AbsEncoder
 from espnet2.asr.frontend.abs_frontend import AbsFrontend
@@ -16,6 +18,7 @@ from espnet2.asr.specaug.abs_specaug import AbsSpecAug
 from espnet2.asr.transducer.error_calculator import ErrorCalculatorTransducer
 from espnet2.asr_transducer.utils import get_transducer_task_io
 from espnet2.layers.abs_normalize import AbsNormalize
+from espnet2.layers.chunked_label_smoothing_loss import ChunkedLabelSmoothingLoss
 from espnet2.torch_utils.device_funcs import force_gatherable
 from espnet2.train.abs_espnet_model import AbsESPnetModel
 from espnet.nets.e2e_asr_common import ErrorCalculator
@@ -68,6 +71,9 @@ class ESPnetASRModel(AbsESPnetModel):
         sym_eos: str = "<sos/eos>",
         extract_feats_in_collect_stats: bool = True,
         lang_token_id: int = -1,
+        att_loss_chunk_size: int = 0,
+        ctc_compress: Optional[str] = None,
+        ctc_compress_blank_threshold: float = 0.95,
     ):
         assert check_argument_types()
         assert 0.0 <= ctc_weight <= 1.0, ctc_weight
@@ -93,6 +99,7 @@ class ESPnetASRModel(AbsESPnetModel):
         self.ctc_weight = ctc_weight
         self.interctc_weight = interctc_weight
         self.aux_ctc = aux_ctc
+        self.att_loss_chunk_size = att_loss_chunk_size
         self.token_list = token_list.copy()
 
         self.frontend = frontend
@@ -184,23 +191,56 @@ class ESPnetASRModel(AbsESPnetModel):
 
             self.decoder = decoder
 
-            self.criterion_att = LabelSmoothingLoss(
-                size=vocab_size,
-                padding_idx=ignore_id,
-                smoothing=lsm_weight,
-                normalize_length=length_normalized_loss,
-            )
+            if att_loss_chunk_size > 0:
+                if decoder is not None and not self._has_hidden_output(decoder):
+                    raise ValueError(
+                        "att_loss_chunk_size requires a decoder having lm_head and "
+                        "the return_hidden argument of forward, e.g. "
+                        f"hugging_face_transformers: {type(decoder).__name__}"
+                    )
+                # The lm_head of the decoder is applied chunk by chunk in the loss
+                self.criterion_att = ChunkedLabelSmoothingLoss(
+                    size=vocab_size,
+                    padding_idx=ignore_id,
+                    smoothing=lsm_weight,
+                    normalize_length=length_normalized_loss,
+                    chunk_size=att_loss_chunk_size,
+                )
+            else:
+                self.criterion_att = LabelSmoothingLoss(
+                    size=vocab_size,
+                    padding_idx=ignore_id,
+                    smoothing=lsm_weight,
+                    normalize_length=length_normalized_loss,
+                )
 
             if report_cer or report_wer:
                 self.error_calculator = ErrorCalculator(
                     token_list, sym_space, sym_blank, report_cer, report_wer
                 )
 
-        if ctc_weight == 0.0:
+        # The CTC compression of the decoder inputs needs the CTC even without
+        # the CTC loss
+        if ctc_weight == 0.0 and ctc_compress is None:
             self.ctc = None
         else:
             self.ctc = ctc
 
+        if ctc_compress is not None:
+            if ctc_weight == 0.0:
+                # The compression runs without gradient, so the CTC is not trained
+                logging.warning(
+                    "ctc_compress with ctc_weight=0.0: the CTC, which selects the "
+                    "decoder input frames, is not trained and must be loaded from "
+                    "a CTC-pretrained model with --init_param, otherwise the "
+                    "compression is random"
+                )
+            self.ctc_compressor = CTCCompressor(
+                mode=ctc_compress, blank_threshold=ctc_compress_blank_threshold
+            )
+        else:
+            self.ctc_compressor = None
+
         self.extract_feats_in_collect_stats = extract_feats_in_collect_stats
 
         self.is_encoder_whisper = "Whisper" in type(self.encoder).__name__
@@ -215,6 +255,19 @@ class ESPnetASRModel(AbsESPnetModel):
         else:
             self.lang_token_id = None
 
+    @staticmethod
+    def _has_hidden_output(decoder: AbsDecoder) -> bool:
+        # Whether the decoder can return the hidden states before its lm_head.
+        # A decoder loaded in 8 bit builds its lm_head in the first forward.
+        has_lm_head = hasattr(decoder, "lm_head") or (
+            getattr(decoder, "decoder", 0) is None
+        )
+        return (
+            has_lm_head
+            and not getattr(decoder, "prefix_tuning", False)
+            and "return_hidden" in inspect.signature(decoder.forward).parameters
+        )
+
     def forward(
         self,
         speech: torch.Tensor,
@@ -250,7 +303,9 @@ class ESPnetASRModel(AbsESPnetModel):
         text = text[:, : text_lengths.max()]
 
         # 1. Encoder
-        encoder_out, encoder_out_lens = self.encode(speech, speech_lengths)
+        encoder_out, encoder_out_lens = self.encode(
+            speech, speech_lengths, utt_id=kwargs.get("utt_id", None)
+        )
         intermediate_outs = None
         if isinstance(encoder_out, tuple):
             intermediate_outs = encoder_out[1]
@@ -369,8 +424,15 @@ class ESPnetASRModel(AbsESPnetModel):
         else:
             # 2b. Attention decoder branch
             if self.ctc_weight != 1.0:
+                att_in, att_in_lens = self.compress_encoder_out(
+                    encoder_out, encoder_out_lens
+                )
+                if self.ctc_compressor is not None:
+                    stats["ctc_compress_ratio"] = (
+                        encoder_out_lens.sum() / att_in_lens.sum()
+                    ).detach()
                 loss_att, acc_att, cer_att, wer_att = self._calc_att_loss(
-                    encoder_out, encoder_out_lens, text, text_lengths, kwargs
+                    att_in, att_in_lens, text, text_lengths, kwargs
                 )
 
             # 3. CTC-Att loss definition
@@ -406,17 +468,23 @@ class ESPnetASRModel(AbsESPnetModel):
         return {"feats": feats, "feats_lengths": feats_lengths}
 
     def encode(
-        self, speech: torch.Tensor, speech_lengths: torch.Tensor
+        self,
+        speech: torch.Tensor,
+        speech_lengths: torch.Tensor,
+        utt_id: Optional[List[str]] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """Frontend + Encoder. Note that this method is used by asr_inference.py
 
         Args:
             speech: (Batch, Length, ...)
             speech_lengths: (Batch, )
+            utt_id: Utterance ids, used by frontends having a feature cache
         """
         with autocast(False):
             # 1. Extract feats
-            feats, feats_lengths = self._extract_feats(speech, speech_lengths)
+            feats, feats_lengths = self._extract_feats(
+                speech, speech_lengths, utt_id=utt_id
+            )
 
             # 2. Data augmentation
             if self.specaug is not None and self.training:
@@ -468,8 +536,26 @@ class ESPnetASRModel(AbsESPnetModel):
 
         return encoder_out, encoder_out_lens
 
+    def compress_encoder_out(
+        self, encoder_out: torch.Tensor, encoder_out_lens: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Shorten the decoder inputs with the CTC compression, if enabled.
+
+        Note that this method is used by asr_inference.py
+
+        Args:
+            encoder_out: (Batch, Length, Dim)
+            encoder_out_lens: (Batch,)
+        """
+        if self.ctc_compressor is None:
+            return encoder_out, encoder_out_lens
+        return self.ctc_compressor(encoder_out, encoder_out_lens, self.ctc)
+
     def _extract_feats(
-        self, speech: torch.Tensor, speech_lengths: torch.Tensor
+        self,
+        speech: torch.Tensor,
+        speech_lengths: torch.Tensor,
+        utt_id: Optional[List[str]] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         assert speech_lengths.dim() == 1, speech_lengths.shape
 
@@ -481,7 +567,15 @@ class ESPnetASRModel(AbsESPnetModel):
             #  e.g. STFT and Feature extract
             #       data_loader may send time-domain signal in this case
             # speech (Batch, NSamples) -> feats: (Batch, NFrames, Dim)
-            feats, feats_lengths = self.frontend(speech, speech_lengths)
+            if (
+                utt_id is not None
+                and getattr(self.frontend, "feats_cache", None) is not None
+            ):
+                feats, feats_lengths = self.frontend(
+                    speech, speech_lengths, utt_id=utt_id
+                )
+            else:
+                feats, feats_lengths = self.frontend(speech, speech_lengths)
         else:
             # No frontend and no feature extract
             feats, feats_lengths = speech, speech_lengths
@@ -506,6 +600,9 @@ class ESPnetASRModel(AbsESPnetModel):
         """
         ys_in_pad, ys_out_pad = add_sos_eos(ys_pad, self.sos, self.eos, self.ignore_id)
         ys_in_lens = ys_pad_lens + 1
+        encoder_out, encoder_out_lens = self.compress_encoder_out(
+            encoder_out, encoder_out_lens
+        )
 
         # 1. Forward decoder
         decoder_out, _ = self.decoder(
@@ -593,6 +690,10 @@ class ESPnetASRModel(AbsESPnetModel):
         ys_in_pad, ys_out_pad = add_sos_eos(ys_pad, self.sos, self.eos, self.ignore_id)
         ys_in_lens = ys_pad_lens + 1
 
+        decoder_kwargs = {}
+        if self.att_loss_chunk_size > 0:
+            decoder_kwargs["return_hidden"] = True
+
         # 1. Forward decoder
         if "decoder_prefix" in forward_kwargs and "decoder_postfix" in forward_kwargs:
             forward_kwargs["decoder_prefix"][
@@ -611,25 +712,37 @@ class ESPnetASRModel(AbsESPnetModel):
                 prefix_lengths=forward_kwargs["decoder_prefix_lengths"],
                 postfix=forward_kwargs["decoder_postfix"],
                 postfix_lengths=forward_kwargs["decoder_postfix_lengths"],
+                **decoder_kwargs,
             )
         else:
             decoder_out, _ = self.decoder(
-                encoder_out, encoder_out_lens, ys_in_pad, ys_in_lens
+                encoder_out, encoder_out_lens, ys_in_pad, ys_in_lens, **decoder_kwargs
             )
 
         # 2. Compute attention loss
-        loss_att = self.criterion_att(decoder_out, ys_out_pad)
-        acc_att = th_accuracy(
-            decoder_out.view(-1, self.vocab_size),
-            ys_out_pad,
-            ignore_label=self.ignore_id,
-        )
+        if self.att_loss_chunk_size > 0:
+            # decoder_out are the hidden states before lm_head
+            loss_att, ys_hat = self.criterion_att(
+                decoder_out, self.decoder.lm_head, ys_out_pad
+            )
+            mask = ys_out_pad != self.ignore_id
+            acc_att = float(
+                torch.sum(ys_hat.masked_select(mask) == ys_out_pad.masked_select(mask))
+            ) / float(torch.sum(mask))
+        else:
+            loss_att = self.criterion_att(decoder_out, ys_out_pad)
+            acc_att = th_accuracy(
+                decoder_out.view(-1, self.vocab_size),
+                ys_out_pad,
+                ignore_label=self.ignore_id,
+            )
 
         # Compute cer/wer using attention-decoder
         if self.training or self.error_calculator is None:
             cer_att, wer_att = None, None
         else:
-            ys_hat = decoder_out.argmax(dim=-1)
+            if self.att_loss_chunk_size == 0:
+                ys_hat = decoder_out.argmax(dim=-1)
             cer_att, wer_att = self.error_calculator(ys_hat.cpu(), ys_pad.cpu())
 
         return loss_att, acc_att, cer_att, wer_att
@@ -1,18 +1,59 @@
+import argparse
 import copy
+import inspect
 import logging
-from typing import Optional, Tuple, Union
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple, Union
 
 import humanfriendly
+import numpy as np
 import torch
+import torch.nn.functional as F
+import yaml
 from typeguard import check_argument_types
 
 from espnet2.asr.frontend.abs_frontend import AbsFrontend
+from espnet2.fileio.feats_cache import FeatsCache
 from espnet2.utils.get_default_kwargs import get_default_kwargs
 from espnet.nets.pytorch_backend.frontends.frontend import Frontend
 
 
+class _UpstreamExit(Exception):
+    """Raised from a hook to stop the upstream after the last used layer."""
+
+
 class S3prlFrontend(AbsFrontend):
-    """Speech Pretrained Representation frontend structure for ASR."""
+    """Speech Pretrained Representation frontend structure for ASR.
+
+    If cache_dir is given, the upstream hidden states consumed by the Featurizer
+    are stored in a FeatsCache keyed by utterance id, and utterances found in
+    the cache skip the upstream. The cache is only valid for a frozen upstream.
+
+    If truncate_upstream is True, the upstream forward stops after the highest
+    hidden state which is actually used: the one given by layer, or the last one
+    whose Featurizer weight (after softmax) is at least prune_threshold. The
+    hidden states below prune_threshold are also left out of the weighted sum.
+    The pruning only applies in eval mode, so that all the Featurizer weights
+    keep their gradients during training.
+
+    If streaming_featurizer is True, the weighted sum of multilayer_feature is
+    accumulated while the upstream runs, so at most one hidden state is alive
+    at a time instead of all of them. During training, autograd still keeps one
+    normalized hidden state per layer for the gradient of the Featurizer weights.
+
+    If chunk_size is positive, inputs longer than chunk_size samples are split
+    into chunks of chunk_size samples, each extended by chunk_overlap samples of
+    context on both sides. The chunks are forwarded separately and only the
+    frames of their non-overlapping parts are kept, which bounds the upstream
+    memory for arbitrarily long inputs. Both values must be multiples of the
+    upstream hop length, e.g. 480000 (30 s) and 16000 (1 s) at 16 kHz.
+
+    If upstream_dtype is "bfloat16" or "float16", the upstream and the Featurizer
+    run under autocast in that precision, even inside the autocast(False) region
+    of ESPnetASRModel.encode. The features are cast back to the input dtype,
+    so everything from the preencoder on is unchanged. Use
+    espnet2.bin.s3prl_check_dtype to measure the drift against float32.
+    """
 
     def __init__(
         self,
@@ -21,6 +62,13 @@ class S3prlFrontend(AbsFrontend):
         download_dir: str = None,
         multilayer_feature: bool = False,
         layer: int = -1,
+        cache_dir: Optional[str] = None,
+        truncate_upstream: bool = False,
+        prune_threshold: float = 0.0,
+        streaming_featurizer: bool = False,
+        chunk_size: int = 0,
+        chunk_overlap: int = 0,
+        upstream_dtype: str = "float32",
     ):
         try:
             import s3prl
@@ -71,6 +119,40 @@ class S3prlFrontend(AbsFrontend):
         self.frontend_type = "s3prl"
         self.hop_length = self.featurizer.downsample_rate
         self.tile_factor = frontend_conf.get("tile_factor", 1)
+        self.upstream_normalize = frontend_conf.get("normalize", False)
+
+        self.truncate_upstream = truncate_upstream
+        self.prune_threshold = prune_threshold
+        self.streaming_featurizer = streaming_featurizer
+        if truncate_upstream or streaming_featurizer:
+            if self._encoder_layers() is None:
+                raise ValueError(
+                    "truncate_upstream and streaming_featurizer are not supported "
+                    f"for the upstream {frontend_conf.get('upstream')}"
+                )
+        assert (
+            not streaming_featurizer or multilayer_feature
+        ), "streaming_featurizer requires multilayer_feature"
+
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        if chunk_size > 0:
+            assert (
+                chunk_size % self.hop_length == 0
+                and chunk_overlap % self.hop_length == 0
+            ), f"chunk_size and chunk_overlap must be multiples of {self.hop_length}"
+
+        assert upstream_dtype in (
+            "float32",
+            "bfloat16",
+            "float16",
+        ), f"Unsupported upstream_dtype: {upstream_dtype}"
+        self.upstream_dtype = upstream_dtype
+
+        if cache_dir is not None:
+            self.feats_cache = FeatsCache(cache_dir)
+        else:
+            self.feats_cache = None
 
     def _tile_representations(self, feature):
         """Tile up the representations by `tile_factor`.
@@ -93,17 +175,233 @@ class S3prlFrontend(AbsFrontend):
     def output_size(self) -> int:
         return self.featurizer.output_size
 
-    def forward(
-        self, input: torch.Tensor, input_lengths: torch.Tensor
-    ) -> Tuple[torch.Tensor, torch.Tensor]:
+    def _selected_layers(self) -> List[int]:
+        """Indices of the upstream hidden states consumed by the Featurizer."""
+        num_layers = self.upstream.num_layers
+        if self.layer != -1:
+            return [self.layer % num_layers]
+        if self.multilayer_feature:
+            return list(range(num_layers))
+        return [num_layers - 1]
+
+    def _used_layers(self) -> List[int]:
+        """Indices of the selected hidden states which are not pruned."""
+        layers = self._selected_layers()
+        if (
+            self.multilayer_feature
+            and self.prune_threshold > 0.0
+            and not self.training
+        ):
+            weights = F.softmax(self.featurizer.weights.detach(), dim=-1).tolist()
+            used = [i for i in layers if weights[i] >= self.prune_threshold]
+            if len(used) == 0:
+                used = [max(layers, key=lambda i: weights[i])]
+            layers = used
+        return layers
+
+    def _encoder_layers(self) -> Optional[torch.nn.ModuleList]:
+        """Transformer layers of the upstream, e.g. wav2vec2 and HuBERT."""
+        model = getattr(self.upstream.upstream, "model", None)
+        encoder = getattr(model, "encoder", None)
+        return getattr(encoder, "layers", None)
+
+    def _match_length(self, h: torch.Tensor, num_frames: int) -> torch.Tensor:
+        # Same as S3PRLUpstream: repeat the last frame or trim to num_frames
+        if h.size(1) < num_frames:
+            h = torch.cat(
+                [h, h[:, -1:].expand(-1, num_frames - h.size(1), -1)], dim=1
+            )
+        return h[:, :num_frames]
+
+    def _truncated_upstream_forward(
+        self, input: torch.Tensor, input_lengths: torch.Tensor, layers: List[int]
+    ) -> Tuple[List[torch.Tensor], List[torch.Tensor]]:
+        """Forward the upstream up to the input of the layer max(layers).
+
+        The i-th hidden state of the upstream is the input of its i-th
+        transformer layer, so the forward is stopped by a pre-hook of that layer.
+        """
+        encoder_layers = self._encoder_layers()
+        last = max(layers)
+        hiddens = {}
+
+        def tap(i):
+            def hook(module, args):
+                # (Length, Batch, Dim) -> (Batch, Length, Dim)
+                hiddens[i] = args[0].transpose(0, 1)
+                if i == last:
+                    raise _UpstreamExit()
+
+            return hook
+
+        handles = [encoder_layers[i].register_forward_pre_hook(tap(i)) for i in layers]
+        try:
+            self.upstream(input, input_lengths)
+        except _UpstreamExit:
+            pass
+        finally:
+            for handle in handles:
+                handle.remove()
+            # Drop the hidden states collected by the S3PRL hooks before the exit
+            getattr(self.upstream.upstream, "_hook_hiddens", []).clear()
+
+        feats_lens = (
+            torch.div(input_lengths - 1, self.hop_length, rounding_mode="floor") + 1
+        )
+        feats = []
+        for i in layers:
+            h = self._match_length(hiddens[i], int(feats_lens.max()))
+            if self.upstream_normalize:
+                h = F.layer_norm(h, h.shape[-1:])
+            feats.append(h)
+        return feats, [feats_lens] * len(layers)
+
+    def _upstream_forward(
+        self, input: torch.Tensor, input_lengths: torch.Tensor, layers: List[int]
+    ) -> Tuple[List[torch.Tensor], List[torch.Tensor]]:
+        if self.truncate_upstream and max(layers) < self.upstream.num_layers - 1:
+            return self._truncated_upstream_forward(input, input_lengths, layers)
+
         feats, feats_lens = self.upstream(input, input_lengths)
+        return [feats[i] for i in layers], [feats_lens[i] for i in layers]
+
+    def _weighted_sum(
+        self,
+        feats: List[torch.Tensor],
+        feats_lens: List[torch.Tensor],
+        layers: List[int],
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Featurizer weighted sum restricted to the given hidden states."""
+        weights = F.softmax(self.featurizer.weights[layers], dim=-1)
+        hs = torch.stack(feats)
+        if getattr(self.featurizer, "normalize", True):
+            hs = F.layer_norm(hs, hs.shape[-1:])
+        return (weights.view(-1, 1, 1, 1) * hs).sum(dim=0), feats_lens[0]
+
+    def _streaming_featurize(
+        self, input: torch.Tensor, input_lengths: torch.Tensor, layers: List[int]
+    ) -> Tuple[List[torch.Tensor], List[torch.Tensor]]:
+        """Featurizer weighted sum accumulated inside the upstream forward.
+
+        Every hidden state is normalized, weighted and added to a running sum
+        by a hook as soon as it is produced. The forward is stopped after the
+        last used hidden state, so that the S3PRL hooks never gather all of them.
+        """
+        encoder = self.upstream.upstream.model.encoder
+        hook_hiddens = getattr(self.upstream.upstream, "_hook_hiddens", [])
+        num_layers = self.upstream.num_layers
+        feats_lens = (
+            torch.div(input_lengths - 1, self.hop_length, rounding_mode="floor") + 1
+        )
+        num_frames = int(feats_lens.max())
+        weights = F.softmax(self.featurizer.weights[layers], dim=-1)
+        last = max(layers)
+        acc = {}
+
+        def accumulate(i, h):
+            h = self._match_length(h, num_frames)
+            if self.upstream_normalize:
+                h = F.layer_norm(h, h.shape[-1:])
+            if getattr(self.featurizer, "normalize", True):
+                h = F.layer_norm(h, h.shape[-1:])
+            h = weights[layers.index(i)] * h
+            acc["feats"] = acc["feats"] + h if "feats" in acc else h
+            # Release the references kept by the S3PRL hooks
+            hook_hiddens.clear()
+            if i == last:
+                raise _UpstreamExit()
+
+        def layer_hook(i):
+            def hook(module, args):
+                # (Length, Batch, Dim) -> (Batch, Length, Dim)
+                accumulate(i, args[0].transpose(0, 1))
+
+            return hook
+
+        def encoder_hook(module, args, output):
+            # The last hidden state is the encoder output (Batch, Length, Dim)
+            accumulate(num_layers - 1, output[0])
+
+        encoder_layers = self._encoder_layers()
+        handles = [
+            encoder_layers[i].register_forward_pre_hook(layer_hook(i))
+            for i in layers
+            if i < num_layers - 1
+        ]
+        if last == num_layers - 1:
+            handles.append(encoder.register_forward_hook(encoder_hook))
+        try:
+            self.upstream(input, input_lengths)
+        except _UpstreamExit:
+            pass
+        finally:
+            for handle in handles:
+                handle.remove()
+            hook_hiddens.clear()
+
+        return [acc["feats"]], [feats_lens]
+
+    def _chunked_forward(
+        self,
+        forward_fn: Callable,
+        input: torch.Tensor,
+        input_lengths: torch.Tensor,
+        layers: List[int],
+    ) -> Tuple[List[torch.Tensor], List[torch.Tensor]]:
+        """Apply forward_fn to overlapping chunks of the input and stitch them.
+
+        Args:
+            forward_fn: Either _upstream_forward or _streaming_featurize
+            input: (Batch, NSamples)
+            input_lengths: (Batch,)
+            layers: Indices of the used hidden states
+        Returns:
+            Outputs of forward_fn for the whole input.
+        """
+        if self.chunk_size <= 0 or input.size(1) <= self.chunk_size:
+            return forward_fn(input, input_lengths, layers)
+
+        hop = self.hop_length
+        feats_lens = torch.div(input_lengths - 1, hop, rounding_mode="floor") + 1
+        num_frames = int(feats_lens.max())
+        feats = None
+        for start in range(0, input.size(1), self.chunk_size):
+            # Only the utterances which are not finished before this chunk
+            active = torch.nonzero(input_lengths > start).squeeze(1)
+            begin = max(start - self.chunk_overlap, 0)
+            end = min(start + self.chunk_size + self.chunk_overlap, input.size(1))
+            lengths = (input_lengths[active] - begin).clamp(max=end - begin)
+            hs, _ = forward_fn(
+                input[active, begin : begin + int(lengths.max())], lengths, layers
+            )
+
+            # Keep the frames of [start, start + chunk_size) only
+            first = (start - begin) // hop
+            count = min(self.chunk_size // hop, num_frames - start // hop)
+            if feats is None:
+                feats = [
+                    h.new_zeros(input.size(0), num_frames, h.size(2)) for h in hs
+                ]
+            for f, h in zip(feats, hs):
+                h = h[:, first : first + count]
+                f[active, start // hop : start // hop + h.size(1)] = h
+
+        return feats, [feats_lens] * len(feats)
+
+    def _featurize(
+        self,
+        feats: List[torch.Tensor],
+        feats_lens: List[torch.Tensor],
+        layers: List[int],
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
         if self.layer != -1:
-            layer = self.layer
-            feats, feats_lens = feats[layer], feats_lens[layer]
-            return feats, feats_lens
+            return feats[0], feats_lens[0]
 
         if self.multilayer_feature:
-            feats, feats_lens = self.featurizer(feats, feats_lens)
+            if len(layers) == self.upstream.num_layers:
+                feats, feats_lens = self.featurizer(feats, feats_lens)
+            else:
+                feats, feats_lens = self._weighted_sum(feats, feats_lens, layers)
         else:
             feats, feats_lens = self.featurizer(feats[-1:], feats_lens[-1:])
 
@@ -112,6 +410,191 @@ class S3prlFrontend(AbsFrontend):
 
         return feats, feats_lens
 
+    def cache_upstream(
+        self, input: torch.Tensor, input_lengths: torch.Tensor, utt_id: List[str]
+    ) -> Tuple[List[torch.Tensor], List[torch.Tensor]]:
+        """Get the selected upstream hidden states through the feature cache.
+
+        The utterances missing from the cache are forwarded through the upstream
+        in eval mode and written to the cache first.
+
+        Args:
+            input: (Batch, NSamples)
+            input_lengths: (Batch,)
+            utt_id: Utterance ids used as cache keys, e.g. "sp0.9-utt1".
+        Returns:
+            List of hidden states (Batch, NFrames, Dim) and their lengths.
+        """
+        missing = [i for i, key in enumerate(utt_id) if key not in self.feats_cache]
+        if len(missing) > 0:
+            index = torch.tensor(missing, device=input.device)
+            lengths = input_lengths[index]
+            training = self.upstream.training
+            self.upstream.eval()
+            with torch.no_grad():
+                hs, hs_lens = self._chunked_forward(
+                    self._upstream_forward,
+                    input[index, : lengths.max()],
+                    lengths,
+                    self._selected_layers(),
+                )
+            self.upstream.train(training)
+
+            # (NLayers, Batch', NFrames, Dim) -> (Batch', NLayers, NFrames, Dim)
+            hs = torch.stack(hs).transpose(0, 1).float().cpu().numpy()
+            for j, i in enumerate(missing):
+                self.feats_cache[utt_id[i]] = hs[j, :, : hs_lens[0][j]]
+
+        entries = [self.feats_cache[key] for key in utt_id]
+        feats_lens = torch.tensor(
+            [e.shape[1] for e in entries], dtype=torch.long, device=input.device
+        )
+        num_layers, _, dim = entries[0].shape
+        feats = input.new_zeros(num_layers, len(entries), feats_lens.max(), dim)
+        for i, e in enumerate(entries):
+            feats[:, i, : e.shape[1]] = torch.from_numpy(np.array(e)).to(feats)
+
+        return list(feats.unbind(0)), [feats_lens] * num_layers
+
+    def forward(
+        self,
+        input: torch.Tensor,
+        input_lengths: torch.Tensor,
+        utt_id: Optional[List[str]] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        if self.upstream_dtype == "float32":
+            return self._forward(input, input_lengths, utt_id)
+
+        with torch.autocast(
+            device_type=input.device.type, dtype=getattr(torch, self.upstream_dtype)
+        ):
+            feats, feats_lens = self._forward(input, input_lengths, utt_id)
+        return feats.to(input.dtype), feats_lens
+
+    def _forward(
+        self,
+        input: torch.Tensor,
+        input_lengths: torch.Tensor,
+        utt_id: Optional[List[str]] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        layers = self._used_layers()
+        if self.feats_cache is not None and utt_id is not None:
+            feats, feats_lens = self.cache_upstream(input, input_lengths, utt_id)
+            selected = self._selected_layers()
+            feats = [feats[selected.index(i)] for i in layers]
+            feats_lens = [feats_lens[selected.index(i)] for i in layers]
+        elif self.streaming_featurizer and len(layers) > 1:
+            feats, feats_lens = self._chunked_forward(
+                self._streaming_featurize, input, input_lengths, layers
+            )
+            feats, feats_lens = feats[0], feats_lens[0]
+            if self.tile_factor != 1:
+                feats = self._tile_representations(feats)
+            return feats, feats_lens
+        else:
+            feats, feats_lens = self._chunked_forward(
+                self._upstream_forward, input, input_lengths, layers
+            )
+
+        return self._featurize(feats, feats_lens, layers)
+
+    def forward_streaming(
+        self,
+        input: torch.Tensor,
+        prev_states: Optional[Tuple[int, torch.Tensor]] = None,
+        is_final: bool = False,
+        context: int = 16000,
+    ) -> Tuple[torch.Tensor, Optional[Tuple[int, torch.Tensor]]]:
+        """Features of the next samples of a stream of a single utterance.
+
+        Like the chunks of _chunked_forward, the new samples are forwarded with
+        up to context samples on both sides and only their frames are kept. The
+        samples are buffered until a whole number of hops followed by context
+        samples of right context is available, so that the frames at the chunk
+        edges see their whole receptive field, e.g. 400 samples for wav2vec2,
+        if context is at least its width minus the hop length.
+
+        Args:
+            input: Next samples of the stream (1, NSamples)
+            prev_states: States returned by the previous call, or None at the
+                start of the stream
+            is_final: Forward all the remaining samples
+            context: Samples of left and right context, a multiple of the hop
+                length
+        Returns:
+            Features of the completed frames (1, NFrames, Dim) and the states of
+                the stream, None after the final call
+        """
+        hop = self.hop_length
+        assert context % hop == 0, f"context must be a multiple of {hop}"
+        assert self.tile_factor == 1, "tile_factor is not supported in streaming"
+        if prev_states is None:
+            left, buffer = 0, input
+        else:
+            left, buffer = prev_states
+            buffer = torch.cat([buffer, input], dim=1)
+
+        # Same number of frames as the offline forward, (NSamples - 1) // hop + 1
+        pending = buffer.size(1) - left
+        if is_final:
+            count = (pending - 1) // hop + 1 if pending > 0 else 0
+        else:
+            count = max(pending - context, 0) // hop
+
+        if count > 0:
+            end = min(left + count * hop + context, buffer.size(1))
+            lengths = buffer.new_full([1], end, dtype=torch.long)
+            feats, _ = self(buffer[:, :end], lengths)
+            feats = feats[:, left // hop : left // hop + count]
+        else:
+            feats = buffer.new_zeros(1, 0, self.output_size())
+
+        if is_final:
+            return feats, None
+        # Keep up to context samples before the next frame as left context
+        done = left + count * hop
+        left = min(context, done)
+        return feats, (left, buffer[:, done - left :])
+
     def reload_pretrained_parameters(self):
         self.upstream.load_state_dict(self.pretrained_params)
         logging.info("Pretrained S3PRL frontend model parameters reloaded!")
+
+
+def build_frontend(
+    asr_train_config: Union[Path, str],
+    asr_model_file: Optional[Union[Path, str]] = None,
+) -> Tuple[S3prlFrontend, argparse.Namespace]:
+    """Build only the S3PRL frontend of an ASR model, without its cache.
+
+    Args:
+        asr_train_config: ASR training configuration
+        asr_model_file: If given, the trained frontend weights are loaded from it
+    Returns:
+        the frontend and the training arguments
+    """
+    assert check_argument_types()
+    with Path(asr_train_config).open("r", encoding="utf-8") as f:
+        train_args = argparse.Namespace(**yaml.safe_load(f))
+    if train_args.frontend != "s3prl":
+        raise RuntimeError(
+            f"Only the s3prl frontend is supported: {train_args.frontend}"
+        )
+    frontend_conf = dict(train_args.frontend_conf)
+    frontend_conf.pop("cache_dir", None)
+    frontend = S3prlFrontend(**frontend_conf)
+
+    if asr_model_file is not None:
+        # Memory-map the checkpoint when possible, so that only the frontend
+        # tensors are read and not those of the whole model
+        kwargs = {}
+        if "mmap" in inspect.signature(torch.load).parameters:
+            kwargs["mmap"] = True
+        state_dict = torch.load(asr_model_file, map_location="cpu", **kwargs)
+        state_dict = {
+            k[len("frontend.") :]: v.clone()
+            for k, v in state_dict.items()
+            if k.startswith("frontend.")
+        }
+        frontend.load_state_dict(state_dict)
+    return frontend, train_args
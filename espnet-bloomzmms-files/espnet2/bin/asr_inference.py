@@ -1,17 +1,31 @@
 #!/usr/bin/env python3
 import argparse
 import logging
+import math
+import queue
 import sys
+import threading
+import time
 from distutils.version import LooseVersion
-from itertools import groupby
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 
 import numpy as np
 import torch
 import torch.quantization
 from typeguard import check_argument_types, check_return_type
 
+from espnet2.asr.ctc_prefix_beam_search import CTCPrefixBeamSearch
 from espnet2.asr.decoder.s4_decoder import S4Decoder
 from espnet2.asr.transducer.beam_search_transducer import BeamSearchTransducer
 from espnet2.asr.transducer.beam_search_transducer import (
@@ -19,6 +33,8 @@ from espnet2.asr.transducer.beam_search_transducer import (
 )
 from espnet2.asr.transducer.beam_search_transducer import Hypothesis as TransHypothesis
 from espnet2.fileio.datadir_writer import DatadirWriter
+from espnet2.layers.global_mvn import GlobalMVN
+from espnet2.layers.utterance_mvn import UtteranceMVN
 from espnet2.tasks.asr import ASRTask
 from espnet2.tasks.enh_s2t import EnhS2TTask
 from espnet2.tasks.lm import LMTask
@@ -34,6 +50,7 @@ from espnet.nets.batch_beam_search import BatchBeamSearch
 from espnet.nets.batch_beam_search_online_sim import BatchBeamSearchOnlineSim
 from espnet.nets.beam_search import BeamSearch, Hypothesis
 from espnet.nets.beam_search_timesync import BeamSearchTimeSync
+from espnet.nets.pytorch_backend.nets_utils import make_non_pad_mask, pad_list
 from espnet.nets.pytorch_backend.transformer.add_sos_eos import add_sos_eos
 from espnet.nets.pytorch_backend.transformer.subsampling import TooShortUttError
 from espnet.nets.scorer_interface import BatchScorerInterface
@@ -42,7 +59,7 @@ from espnet.nets.scorers.length_bonus import LengthBonus
 from espnet.utils.cli_utils import get_commandline_args
 
 try:
-    from transformers import AutoModelForSeq2SeqLM, AutoModelForCausalLM
+    from transformers import AutoModelForSeq2SeqLM
     from transformers.file_utils import ModelOutput
 
     is_transformers_available = True
@@ -104,6 +121,15 @@ class Speech2Text:
         hugging_face_decoder_conf: Dict[str, Any] = {},
         time_sync: bool = False,
         multi_asr: bool = False,
+        ctc_greedy: bool = False,
+        ctc_prefix_beam_search: bool = False,
+        ctc_topk: int = 0,
+        ctc_blank_threshold: float = 0.999,
+        ctc_vocab_file: Union[Path, str] = None,
+        streaming_chunk_size: int = 16,
+        streaming_left_context: int = 64,
+        streaming_lookahead: int = 4,
+        streaming_frontend_context: int = 16000,
     ):
         assert check_argument_types()
 
@@ -141,6 +167,14 @@ class Speech2Text:
             )
         asr_model.to(dtype=getattr(torch, dtype)).eval()
 
+        if ctc_vocab_file is not None:
+            if asr_model.ctc is None:
+                raise ValueError("ctc_vocab_file requires a CTC model")
+            with open(ctc_vocab_file, encoding="utf-8") as f:
+                ctc_vocab = [int(line) for line in f if line.strip()]
+            asr_model.ctc.prune_vocabulary(ctc_vocab)
+            logging.info(f"CTC vocabulary pruned to {len(ctc_vocab)} tokens")
+
         if quantize_asr_model:
             logging.info("Use quantized asr model for decoding.")
 
@@ -188,7 +222,28 @@ class Speech2Text:
         scorers["ngram"] = ngram
 
         # 4. Build BeamSearch object
-        if asr_model.use_transducer_decoder:
+        ctc_search = None
+        if ctc_greedy or ctc_prefix_beam_search:
+            if asr_model.ctc is None:
+                raise ValueError("CTC-only decoding requires a CTC model")
+            if lm_train_config is not None or ngram_file is not None:
+                raise NotImplementedError("CTC-only decoding ignores the LMs")
+            if ctc_prefix_beam_search:
+                logging.info("CTC prefix beam search is selected.")
+                # torch.nn.CTCLoss is trained with the blank at index 0
+                ctc_search = CTCPrefixBeamSearch(
+                    beam_size=beam_size,
+                    topk=ctc_topk,
+                    blank_id=0,
+                    blank_threshold=ctc_blank_threshold,
+                )
+            else:
+                logging.info("Greedy CTC decoding is selected.")
+            beam_search = None
+            beam_search_transducer = None
+            hugging_face_model = None
+            hugging_face_linear_in = None
+        elif asr_model.use_transducer_decoder:
             # In multi-blank RNNT, we assume all big blanks are
             # just before the standard blank in token_list
             multi_blank_durations = getattr(
@@ -233,26 +288,8 @@ class Speech2Text:
                     decoder._init_args["map_device"] = torch.device(device)
                     decoder._init()
 
-                if torch.cuda.device_count() > 1:
-                    device_map = "balanced_low_0"
-                else:
-                    device_map = "auto"
-
-                hugging_face_model = AutoModelForCausalLM.from_pretrained(
-                    decoder.model_name_or_path,
-                    load_in_8bit=decoder._init_args["load_in_8bit"],
-                    device_map=device_map,
-                )
-
-                hugging_face_model.resize_token_embeddings(decoder.lm_head.out_features)
-
-                if not decoder._init_args["load_in_8bit"]:
-                    hugging_face_model.transformer.load_state_dict(
-                        decoder.decoder.state_dict()
-                    )
-                    hugging_face_model.lm_head.load_state_dict(
-                        decoder.lm_head.state_dict()
-                    )
+                # Generate with the transformer and lm_head of the decoder
+                hugging_face_model = decoder.causal_lm_for_generation()
             else:
                 hugging_face_model = AutoModelForSeq2SeqLM.from_pretrained(
                     decoder.model_name_or_path
@@ -271,12 +308,7 @@ class Speech2Text:
                     )
                     del hugging_face_model.encoder
 
-            del asr_model.decoder.lm_head
-            del asr_model.decoder.decoder.h
-
-            decoder.decoder.word_embeddings = (
-                hugging_face_model.transformer.word_embeddings
-            )
+                del asr_model.decoder.lm_head
 
             hugging_face_linear_in = decoder.linear_in
             hugging_face_model.eval()
@@ -409,6 +441,13 @@ class Speech2Text:
         self.nbest = nbest
         self.enh_s2t_task = enh_s2t_task
         self.multi_asr = multi_asr
+        self.ctc_only = ctc_greedy or ctc_prefix_beam_search
+        self.ctc_search = ctc_search
+        self.streaming_chunk_size = streaming_chunk_size
+        self.streaming_left_context = streaming_left_context
+        self.streaming_lookahead = streaming_lookahead
+        self.streaming_frontend_context = streaming_frontend_context
+        self.reset_streaming()
 
     @torch.no_grad()
     def __call__(
@@ -477,35 +516,549 @@ class Speech2Text:
             assert len(enc) == 1, len(enc)
 
             # c. Passed the encoder result and the beam search
+            if not self.ctc_only:
+                enc, enc_olens = self._compress(enc, enc_olens)
             results = self._decode_single_sample(enc[0])
 
             # Encoder intermediate CTC predictions
-            if intermediate_outs is not None and self.beam_search is not None:
+            if intermediate_outs is not None and (
+                self.beam_search is not None or self.ctc_only
+            ):
                 encoder_interctc_res = self._decode_interctc(intermediate_outs)
                 results = (results, encoder_interctc_res)
             assert check_return_type(results)
 
         return results
 
+    def reset_streaming(self):
+        """Forget the stream decoded by streaming_step."""
+        self._frontend_states = None
+        # Sums of the features, of their squares and number of frames
+        self._feats_stats = None
+        self._encoder_states = None
+        # Frames waiting for a complete length adaptor window
+        self._postencoder_buffer = None
+        self._ctc_buffer = None
+        self._stream_ids = []
+        self._stream_score = 0.0
+
+    def _stream_frames(
+        self, buffer: Optional[torch.Tensor], xs: torch.Tensor, ratio: int
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        # Split the frames into a multiple of ratio and the rest
+        if buffer is not None:
+            xs = torch.cat([buffer, xs], dim=1)
+        length = xs.size(1) // ratio * ratio
+        return xs[:, :length], xs[:, length:]
+
+    def _stream_normalize(self, feats: torch.Tensor) -> torch.Tensor:
+        normalize = self.asr_model.normalize
+        if normalize is None or feats.size(1) == 0:
+            return feats
+        if isinstance(normalize, GlobalMVN):
+            return normalize(feats)[0]
+
+        # UtteranceMVN with the statistics of the frames of the stream so far
+        x = feats.double()
+        stats = (x.sum(dim=1), x.pow(2).sum(dim=1), x.size(1))
+        if self._feats_stats is not None:
+            stats = tuple(a + b for a, b in zip(self._feats_stats, stats))
+        self._feats_stats = stats
+        mean = stats[0] / stats[2]
+        std = (stats[1] / stats[2] - mean.pow(2)).clamp(min=0.0).sqrt()
+        std = std.clamp(min=normalize.eps)
+        if normalize.norm_means:
+            x = x - mean
+        if normalize.norm_vars:
+            x = x / std
+        return x.to(feats.dtype)
+
+    @torch.no_grad()
+    def streaming_step(
+        self, speech: Union[torch.Tensor, np.ndarray], is_final: bool = False
+    ) -> ListOfHypothesis:
+        """Decode the next chunk of a stream with greedy CTC.
+
+        The frontend forwards the speech with streaming_frontend_context samples
+        of left and right context, and the encoder encodes the features block by
+        block, with the streaming_chunk_size, streaming_left_context and
+        streaming_lookahead of the constructor. The stream is reset after the
+        final chunk.
+
+        Unlike offline decoding, the frontend and the encoder see only a limited
+        context, and UtteranceMVN normalizes with the mean and variance of the
+        frames of the stream so far instead of those of the whole utterance.
+
+        Args:
+            speech: Next chunk of the input speech (Nsamples,)
+            is_final: Whether it is the last chunk of the stream
+        Returns:
+            text, token, token_int, hyp of the partial result of the stream
+
+        """
+        assert check_argument_types()
+        asr_model = self.asr_model
+        if asr_model.ctc is None:
+            raise ValueError("Streaming decoding requires a CTC model")
+        if not hasattr(asr_model.encoder, "forward_streaming"):
+            raise NotImplementedError(
+                f"{type(asr_model.encoder).__name__} does not support streaming"
+            )
+        postencoder = asr_model.postencoder
+        if getattr(postencoder, "transformer", None) is not None:
+            raise NotImplementedError("The post-encoder transformer is not causal")
+        if not hasattr(asr_model.frontend, "forward_streaming"):
+            raise NotImplementedError(
+                f"{type(asr_model.frontend).__name__} does not support streaming"
+            )
+        if asr_model.normalize is not None and not isinstance(
+            asr_model.normalize, (GlobalMVN, UtteranceMVN)
+        ):
+            raise NotImplementedError(
+                f"{type(asr_model.normalize).__name__} does not support streaming"
+            )
+
+        if isinstance(speech, np.ndarray):
+            speech = torch.tensor(speech)
+        speech = speech.unsqueeze(0).to(getattr(torch, self.dtype))
+        speech = to_device(speech, device=self.device)
+
+        # a. Frontend of the completed frames, as in ESPnetASRModel.encode
+        feats, self._frontend_states = asr_model.frontend.forward_streaming(
+            speech,
+            self._frontend_states,
+            is_final=is_final,
+            context=self.streaming_frontend_context,
+        )
+        feats = self._stream_normalize(feats)
+        if asr_model.preencoder is not None:
+            feats_lengths = feats.new_full([1], feats.size(1), dtype=torch.long)
+            feats, _ = asr_model.preencoder(feats, feats_lengths)
+
+        # b. Encoder blocks completed by the chunk
+        enc, self._encoder_states = asr_model.encoder.forward_streaming(
+            feats,
+            self._encoder_states,
+            is_final=is_final,
+            chunk_size=self.streaming_chunk_size,
+            left_context=self.streaming_left_context,
+            lookahead=self.streaming_lookahead,
+        )
+        if postencoder is not None:
+            enc, self._postencoder_buffer = self._stream_frames(
+                self._postencoder_buffer,
+                enc,
+                getattr(postencoder, "length_adaptor_ratio", 1),
+            )
+            if enc.size(1) > 0:
+                enc_lens = enc.new_full([1], enc.size(1), dtype=torch.long)
+                enc, _ = postencoder(enc, enc_lens)
+
+        # c. Greedy CTC over all the frames of the stream
+        ctc = asr_model.ctc
+        enc, self._ctc_buffer = self._stream_frames(
+            self._ctc_buffer, enc, ctc.length_adaptor_ratio
+        )
+        if enc.size(1) > 0:
+            logits = ctc.ctc_lo(ctc._map_hs(enc))
+            max_logits, ids = logits.max(dim=2)
+            self._stream_ids.append(ctc.full_ids(ids))
+            self._stream_score += float((max_logits - logits.logsumexp(dim=2)).sum())
+
+        if len(self._stream_ids) > 0:
+            ids = torch.cat(self._stream_ids, dim=1)
+            valid = torch.ones_like(ids, dtype=torch.bool)
+            token_int = self._collapse_ctc_ids(ids, valid)[0]
+        else:
+            token_int = []
+        sos, eos = asr_model.sos, asr_model.eos
+        results = self._hyps_to_results(
+            [
+                Hypothesis(
+                    yseq=torch.tensor([sos] + token_int + [eos]),
+                    score=self._stream_score,
+                )
+            ]
+        )
+        if is_final:
+            self.reset_streaming()
+        return results
+
     def _decode_interctc(
         self, intermediate_outs: List[Tuple[int, torch.Tensor]]
     ) -> Dict[int, List[str]]:
         assert check_argument_types()
 
-        exclude_ids = [self.asr_model.blank_id, self.asr_model.sos, self.asr_model.eos]
-        res = {}
-        token_list = self.beam_search.token_list
+        encoder_out = intermediate_outs[0][1]
+        # batch_size = 1
+        return self._decode_interctc_batch(
+            intermediate_outs,
+            encoder_out.new_full([1], encoder_out.size(1), dtype=torch.long),
+        )[0]
 
+    def _decode_interctc_batch(
+        self,
+        intermediate_outs: List[Tuple[int, torch.Tensor]],
+        enc_olens: torch.Tensor,
+    ) -> List[Dict[int, List[str]]]:
+        """Intermediate CTC predictions of every utterance of a batch.
+
+        Like in the training, the intermediate outputs are assumed to have the
+        lengths of the encoder output.
+        """
+        token_list = self.asr_model.token_list
+        res = [{} for _ in range(len(enc_olens))]
         for layer_idx, encoder_out in intermediate_outs:
-            y = self.asr_model.ctc.argmax(encoder_out)[0]  # batch_size = 1
-            y = [x[0] for x in groupby(y) if x[0] not in exclude_ids]
-            y = [token_list[x] for x in y]
+            token_int, _ = self._ctc_greedy_search(encoder_out, enc_olens)
+            for r, ids in zip(res, token_int):
+                r[layer_idx] = [token_list[x] for x in ids]
+        return res
 
-            res[layer_idx] = y
+    def _ctc_greedy_search(
+        self, enc: torch.Tensor, enc_lens: torch.Tensor
+    ) -> Tuple[List[List[int]], torch.Tensor]:
+        """Greedy CTC search for a batch.
 
-        return res
+        The argmax, the collapse of repeated ids and the removal of blank, sos
+        and eos are tensor operations over the whole batch.
+
+        Args:
+            enc: Encoder output (Batch, Length, Dim)
+            enc_lens: (Batch,)
+        Returns:
+            Token ids of every utterance and the log probabilities of the
+                best paths (Batch,)
+        """
+        ctc = self.asr_model.ctc
+        logits = ctc.ctc_lo(ctc._map_hs(enc))
+        enc_lens = torch.div(enc_lens, ctc.length_adaptor_ratio, rounding_mode="floor")
+        max_logits, ids = logits.max(dim=2)
+        ids = ctc.full_ids(ids)
+        valid = make_non_pad_mask(enc_lens, ids, 1)
+        scores = (
+            (max_logits - logits.logsumexp(dim=2)).float().masked_fill(~valid, 0.0)
+        ).sum(dim=1)
+        return self._collapse_ctc_ids(ids, valid), scores
+
+    def _collapse_ctc_ids(
+        self, ids: torch.Tensor, valid: torch.Tensor
+    ) -> List[List[int]]:
+        """Token ids of the CTC frame ids (Batch, Length) of valid frames."""
+        # Keep the first frame of every run of the same id
+        keep = torch.ones_like(valid)
+        keep[:, 1:] = ids[:, 1:] != ids[:, :-1]
+        keep &= valid
+        # The CTC blank is index 0 whatever sym_blank is
+        for exclude_id in (
+            0,
+            self.asr_model.blank_id,
+            self.asr_model.sos,
+            self.asr_model.eos,
+        ):
+            keep &= ids != exclude_id
+
+        flat_ids = ids[keep].tolist()
+        token_int = []
+        start = 0
+        for length in keep.sum(dim=1).tolist():
+            token_int.append(flat_ids[start : start + length])
+            start += length
+        return token_int
+
+    def _ctc_prefix_beam_search(
+        self, enc: torch.Tensor, enc_lens: torch.Tensor, chunk_size: int = 256
+    ) -> List[List[Tuple[List[int], float]]]:
+        """CTC prefix beam search for a batch.
+
+        The CTC log probabilities are computed and pruned for chunk_size frames
+        at a time, so that those of the whole vocabulary are not stored for all
+        frames.
+
+        Args:
+            enc: Encoder output (Batch, Length, Dim)
+            enc_lens: (Batch,)
+        Returns:
+            (token ids, log probability) of the n-best sequences of every
+                utterance
+        """
+        asr_model = self.asr_model
+        ctc = asr_model.ctc
+        hs = ctc._map_hs(enc)
+        enc_lens = torch.div(enc_lens, ctc.length_adaptor_ratio, rounding_mode="floor")
+
+        # The columns of the ids which _collapse_ctc_ids removes besides 0
+        excluded = {asr_model.blank_id, asr_model.sos, asr_model.eos} - {0}
+        output_ids = ctc.full_ids(
+            torch.arange(ctc.ctc_lo.out_features, device=hs.device)
+        )
+        columns = torch.nonzero(
+            torch.isin(output_ids, output_ids.new_tensor(sorted(excluded)))
+        ).squeeze(1)
+
+        pruned = []
+        for start in range(0, hs.size(1), chunk_size):
+            log_probs = ctc.ctc_lo(hs[:, start : start + chunk_size]).log_softmax(dim=2)
+            if len(columns) > 0:
+                # Like in the greedy search, these tokens are never output and
+                # separate repeated tokens, as the blank does
+                log_probs[:, :, 0] = torch.logsumexp(
+                    torch.cat([log_probs[:, :, :1], log_probs[:, :, columns]], dim=2),
+                    dim=2,
+                )
+                log_probs[:, :, columns] = -math.inf
+            pruned.append(self.ctc_search.prune(log_probs))
+        blank_lp, token_lp, token_ids = (torch.cat(x, dim=1) for x in zip(*pruned))
+        token_ids = ctc.full_ids(token_ids)
+        return self.ctc_search.search(blank_lp, token_lp, token_ids, enc_lens)
+
+    def _ctc_results(
+        self, enc: torch.Tensor, enc_lens: torch.Tensor
+    ) -> List[ListOfHypothesis]:
+        if self.ctc_search is not None:
+            nbest = self._ctc_prefix_beam_search(enc, enc_lens)
+        else:
+            token_int, scores = self._ctc_greedy_search(enc, enc_lens)
+            nbest = [[x] for x in zip(token_int, scores.tolist())]
+
+        sos, eos = self.asr_model.sos, self.asr_model.eos
+        return [
+            self._hyps_to_results(
+                [
+                    Hypothesis(yseq=torch.tensor([sos] + y + [eos]), score=score)
+                    for y, score in hyps
+                ]
+            )
+            for hyps in nbest
+        ]
+
+    def _generate_from_prefix_cache(self, forward_args: Dict[str, Any]):
+        """Generate from inputs whose prefix keys and values are cached.
+
+        The inputs except the last one are forwarded on top of the prefix cache
+        and generate continues from the last input, which is the last postfix
+        token. The returned sequences have placeholder ids for the inputs.
+        """
+        decoder = self.asr_model.decoder
+        attention_mask = forward_args["attention_mask"]
+        past_key_values = self.hugging_face_model.transformer(
+            inputs_embeds=forward_args["inputs_embeds"][:, :-1],
+            past_key_values=forward_args["past_key_values"],
+            attention_mask=attention_mask[:, :-1],
+            use_cache=True,
+            return_dict=True,
+        ).past_key_values
+
+        # generate expands the inputs for the beams but not past_key_values,
+        # whose leading dimension is the batch (possibly merged with the heads)
+        batch_size = attention_mask.shape[0]
+        num_beams = self.hugging_face_decoder_conf["num_beams"]
+        past_key_values = tuple(
+            tuple(
+                t.view(batch_size, -1, *t.shape[1:])
+                .repeat_interleave(num_beams, dim=0)
+                .view(-1, *t.shape[1:])
+                for t in layer
+            )
+            for layer in past_key_values
+        )
+
+        input_ids = torch.ones_like(attention_mask, dtype=torch.long)
+        input_ids[:, -1] = decoder.postfix_tokens[0, -1]
+        return self.hugging_face_model.generate(
+            input_ids,
+            attention_mask=attention_mask,
+            past_key_values=past_key_values,
+            **self.hugging_face_decoder_conf,
+        )
+
+    def _generate_causal_lm(
+        self, enc: torch.Tensor, enc_lens: torch.Tensor
+    ) -> List[torch.Tensor]:
+        """Generate with the Hugging Face causal LM for a batch.
+
+        Args:
+            enc: Encoder output (Batch, Length, Dim)
+            enc_lens: (Batch,)
+        Returns:
+            Token ids of every utterance, which start with a placeholder for the
+                inputs and end with <eos> if it was generated
+        """
+        decoder = self.asr_model.decoder
+        enc = self.hugging_face_linear_in(enc)
+        batch_size = enc.shape[0]
+        # The last input must be a token to continue from the cached prefix
+        cache_prefix = decoder.cache_prefix and decoder.postfix_tokens.shape[1] > 0
+        forward_args, _ = decoder.add_prefix_postfix(
+            enc,
+            enc_lens,
+            torch.ones([batch_size, 1], dtype=int, device=enc.device),
+            torch.ones([batch_size], dtype=int, device=enc.device),
+            cache_prefix=cache_prefix,
+        )
+
+        if cache_prefix:
+            yseq = self._generate_from_prefix_cache(forward_args)
+            num_inputs = forward_args["attention_mask"].shape[1]
+        else:
+            input_ids = torch.ones(
+                [batch_size, forward_args["inputs_embeds"].shape[1]],
+                dtype=int,
+                device=enc.device,
+            )
+
+            yseq = self.hugging_face_model.generate(
+                input_ids,
+                inputs_embeds=forward_args["inputs_embeds"],
+                attention_mask=forward_args["attention_mask"],
+                **self.hugging_face_decoder_conf,
+            )
+            num_inputs = input_ids.shape[1]
+
+        yseq = yseq[:, num_inputs - 1 :]
+
+        # Remove the padding after <eos> of the sequences which ended earlier
+        eos = self.hugging_face_model.config.eos_token_id
+        results = []
+        for y in yseq:
+            ends = torch.nonzero(y[1:] == eos)
+            if len(ends) > 0:
+                y = y[: int(ends[0]) + 2]
+            results.append(y)
+        return results
+
+    @torch.no_grad()
+    def batch_decode(
+        self, speech: torch.Tensor, speech_lengths: torch.Tensor
+    ) -> List[Union[ListOfHypothesis, Tuple[ListOfHypothesis, Dict]]]:
+        """Inference for a batch of utterances
+
+        The encoder runs on the whole batch. The Hugging Face causal LM
+        decoder generates for the whole batch from left-padded inputs, the
+        other decoders decode the utterances one by one.
+
+        Args:
+            speech: Input speech data (Batch, Nsamples)
+            speech_lengths: (Batch,)
+        Returns:
+            text, token, token_int, hyp of every utterance, together with the
+                intermediate CTC predictions like __call__ if the encoder has
+                intermediate outputs
+
+        """
+        assert check_argument_types()
+        return self.decode_batch(*self.encode_batch(speech, speech_lengths))
+
+    @torch.no_grad()
+    def encode_batch(
+        self, speech: torch.Tensor, speech_lengths: torch.Tensor
+    ) -> Tuple[
+        torch.Tensor, torch.Tensor, Optional[List[Tuple[int, torch.Tensor]]]
+    ]:
+        """Encoder part of batch_decode
+
+        Args:
+            speech: Input speech data (Batch, Nsamples)
+            speech_lengths: (Batch,)
+        Returns:
+            encoder output (Batch, Length, Dim), its lengths (Batch,) and the
+                intermediate outputs (layer index, (Batch, Length, Dim)) or None
+
+        """
+        if self.enh_s2t_task or self.multi_asr:
+            raise NotImplementedError("batch decoding is not implemented")
+
+        batch = {
+            "speech": speech.to(getattr(torch, self.dtype)),
+            "speech_lengths": speech_lengths,
+        }
+        logging.info(f"speech lengths: {speech_lengths.tolist()}")
+
+        # a. To device
+        batch = to_device(batch, device=self.device)
+
+        # b. Forward Encoder
+        enc, enc_olens = self.asr_model.encode(**batch)
+        intermediate_outs = None
+        if isinstance(enc, tuple):
+            intermediate_outs = enc[1]
+            enc = enc[0]
+        return enc, enc_olens, intermediate_outs
+
+    @torch.no_grad()
+    def decode_batch(
+        self,
+        enc: torch.Tensor,
+        enc_olens: torch.Tensor,
+        intermediate_outs: Optional[List[Tuple[int, torch.Tensor]]] = None,
+    ) -> List[Union[ListOfHypothesis, Tuple[ListOfHypothesis, Dict]]]:
+        """Decoder part of batch_decode
+
+        Args:
+            enc: encoder output (Batch, Length, Dim)
+            enc_olens: (Batch,)
+            intermediate_outs: intermediate encoder outputs, see encode_batch
+        Returns:
+            text, token, token_int, hyp of every utterance, together with the
+                intermediate CTC predictions like __call__ if intermediate_outs
+                is given
+
+        """
+        results = self._decode_batch(enc, enc_olens)
+
+        # Encoder intermediate CTC predictions
+        if intermediate_outs is not None and (
+            self.beam_search is not None or self.ctc_only
+        ):
+            encoder_interctc_res = self._decode_interctc_batch(
+                intermediate_outs, enc_olens
+            )
+            results = list(zip(results, encoder_interctc_res))
+        return results
+
+    def _decode_batch(
+        self, enc: torch.Tensor, enc_olens: torch.Tensor
+    ) -> List[ListOfHypothesis]:
+        # c. Passed the encoder result and the decoder
+        if self.ctc_only:
+            return self._ctc_results(enc, enc_olens)
+
+        enc, enc_olens = self._compress(enc, enc_olens)
+        if (
+            self.hugging_face_model
+            and self.asr_model.decoder.causal_lm
+            and self.asr_model.decoder.tokenizer_padding_side == "left"
+        ):
+            results = []
+            for yseq in self._generate_causal_lm(enc, enc_olens):
+                results.append(self._hyps_to_results([Hypothesis(yseq=yseq)]))
+            return results
+
+        return [
+            self._decode_single_sample(e[:length]) for e, length in zip(enc, enc_olens)
+        ]
+
+    def _compress(
+        self, enc: torch.Tensor, enc_olens: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """CTC compression of the Hugging Face decoder inputs, if enabled."""
+        if (
+            self.hugging_face_model is None
+            or getattr(self.asr_model, "ctc_compressor", None) is None
+        ):
+            return enc, enc_olens
+        compressed, compressed_olens = self.asr_model.compress_encoder_out(
+            enc, enc_olens
+        )
+        ratio = float(enc_olens.sum() / compressed_olens.sum())
+        logging.info(f"CTC compression ratio: {ratio:.2f}")
+        return compressed, compressed_olens
 
     def _decode_single_sample(self, enc: torch.Tensor):
+        if self.ctc_only:
+            return self._ctc_results(
+                enc.unsqueeze(0), enc.new_full([1], enc.shape[0], dtype=torch.long)
+            )[0]
+
         if self.beam_search_transducer:
             logging.info("encoder output length: " + str(enc.shape[0]))
             nbest_hyps = self.beam_search_transducer(enc)
@@ -519,29 +1072,12 @@ class Speech2Text:
                 "best hypo: " + "".join(self.converter.ids2tokens(best.yseq[1:])) + "\n"
             )
         elif self.hugging_face_model:
-            enc = self.hugging_face_linear_in(enc).unsqueeze(0)
             if self.asr_model.decoder.causal_lm:
-                forward_args, _ = self.asr_model.decoder.add_prefix_postfix(
-                    enc,
-                    torch.tensor([enc.shape[1]]).to(enc.device),
-                    torch.ones([1, 1], dtype=int, device=enc.device),
-                    torch.ones([1], dtype=int, device=enc.device),
-                )
-
-                input_ids = torch.ones(
-                    [1, forward_args["inputs_embeds"].shape[1]],
-                    dtype=int,
-                    device=enc.device,
-                )
-
-                yseq = self.hugging_face_model.generate(
-                    input_ids,
-                    inputs_embeds=forward_args["inputs_embeds"],
-                    **self.hugging_face_decoder_conf,
+                yseq = self._generate_causal_lm(
+                    enc.unsqueeze(0), enc.new_full([1], enc.shape[0], dtype=torch.long)
                 )
-
-                yseq = yseq[:, input_ids.shape[1] - 1 :]
             else:
+                enc = self.hugging_face_linear_in(enc).unsqueeze(0)
                 decoder_start_token_id = (
                     self.hugging_face_model.config.decoder_start_token_id
                 )
@@ -570,6 +1106,11 @@ class Speech2Text:
                 x=enc, maxlenratio=self.maxlenratio, minlenratio=self.minlenratio
             )
 
+        return self._hyps_to_results(nbest_hyps)
+
+    def _hyps_to_results(
+        self, nbest_hyps: List[Union[Hypothesis, TransHypothesis]]
+    ) -> ListOfHypothesis:
         nbest_hyps = nbest_hyps[: self.nbest]
 
         results = []
@@ -633,6 +1174,14 @@ def inference(
     maxlenratio: float,
     minlenratio: float,
     batch_size: int,
+    sort_window: int,
+    pipeline: bool,
+    pipeline_queue_size: int,
+    ctc_greedy: bool,
+    ctc_prefix_beam_search: bool,
+    ctc_topk: int,
+    ctc_blank_threshold: float,
+    ctc_vocab_file: Optional[str],
     dtype: str,
     beam_size: int,
     ngpu: int,
@@ -670,7 +1219,7 @@ def inference(
     multi_asr: bool,
 ):
     assert check_argument_types()
-    if batch_size > 1:
+    if (batch_size > 1 or pipeline) and (enh_s2t_task or multi_asr or streaming):
         raise NotImplementedError("batch decoding is not implemented")
     if word_lm_train_config is not None:
         raise NotImplementedError("Word LM is not implemented")
@@ -720,6 +1269,11 @@ def inference(
         hugging_face_decoder=hugging_face_decoder,
         hugging_face_decoder_conf=hugging_face_decoder_conf,
         time_sync=time_sync,
+        ctc_greedy=ctc_greedy,
+        ctc_prefix_beam_search=ctc_prefix_beam_search,
+        ctc_topk=ctc_topk,
+        ctc_blank_threshold=ctc_blank_threshold,
+        ctc_vocab_file=ctc_vocab_file,
     )
     speech2text = Speech2Text.from_pretrained(
         model_tag=model_tag,
@@ -727,10 +1281,11 @@ def inference(
     )
 
     # 3. Build data-iterator
+    # The batches are formed after sorting the utterances by length
     loader = ASRTask.build_streaming_iterator(
         data_path_and_name_and_type,
         dtype=dtype,
-        batch_size=batch_size,
+        batch_size=1,
         key_file=key_file,
         num_workers=num_workers,
         preprocess_fn=ASRTask.build_preprocess_fn(speech2text.asr_train_args, False),
@@ -739,9 +1294,43 @@ def inference(
         inference=True,
     )
 
+    def decode(key: str, **kwargs):
+        # N-best list of (text, token, token_int, hyp_object)
+        try:
+            return speech2text(**kwargs)
+        except TooShortUttError as e:
+            logging.warning(f"Utterance {key} {e}")
+            hyp = Hypothesis(score=0.0, scores={}, states={}, yseq=[])
+            results = [[" ", ["<space>"], [2], hyp]] * nbest
+            if enh_s2t_task:
+                num_spk = getattr(speech2text.asr_model.enh_model, "num_spk", 1)
+                results = [results for _ in range(num_spk)]
+            return results
+
     # 7 .Start for-loop
     # FIXME(kamo): The output format should be discussed about
     with DatadirWriter(output_dir) as writer:
+        if pipeline:
+            pipelined_decode(
+                speech2text,
+                loader,
+                lambda key, results: write_results(
+                    writer, key, results, nbest, enh_s2t_task, multi_asr
+                ),
+                batch_size,
+                sort_window,
+                decode,
+                queue_size=pipeline_queue_size,
+            )
+            return
+
+        if batch_size > 1:
+            for key, results in batch_decode_sorted(
+                speech2text, loader, batch_size, sort_window, decode
+            ):
+                write_results(writer, key, results, nbest, enh_s2t_task, multi_asr)
+            return
+
         for keys, batch in loader:
             assert isinstance(batch, dict), type(batch)
             assert all(isinstance(s, str) for s in keys), keys
@@ -749,66 +1338,324 @@ def inference(
             assert len(keys) == _bs, f"{len(keys)} != {_bs}"
             batch = {k: v[0] for k, v in batch.items() if not k.endswith("_lengths")}
 
-            # N-best list of (text, token, token_int, hyp_object)
-            try:
-                results = speech2text(**batch)
-            except TooShortUttError as e:
-                logging.warning(f"Utterance {keys} {e}")
-                hyp = Hypothesis(score=0.0, scores={}, states={}, yseq=[])
-                results = [[" ", ["<space>"], [2], hyp]] * nbest
-                if enh_s2t_task:
-                    num_spk = getattr(speech2text.asr_model.enh_model, "num_spk", 1)
-                    results = [results for _ in range(num_spk)]
-
             # Only supporting batch_size==1
             key = keys[0]
-            if enh_s2t_task or multi_asr:
-                # Enh+ASR joint task
-                for spk, ret in enumerate(results, 1):
-                    for n, (text, token, token_int, hyp) in zip(
-                        range(1, nbest + 1), ret
-                    ):
-                        # Create a directory: outdir/{n}best_recog_spk?
-                        ibest_writer = writer[f"{n}best_recog"]
-
-                        # Write the result to each file
-                        ibest_writer[f"token_spk{spk}"][key] = " ".join(token)
-                        ibest_writer[f"token_int_spk{spk}"][key] = " ".join(
-                            map(str, token_int)
-                        )
-                        ibest_writer[f"score_spk{spk}"][key] = str(hyp.score)
+            results = decode(key, **batch)
+            write_results(writer, key, results, nbest, enh_s2t_task, multi_asr)
+
+
+def sorted_batches(
+    loader, batch_size: int, sort_window: int
+) -> Iterator[List[Tuple[int, str, torch.Tensor]]]:
+    """Form batches of utterances having similar lengths.
+
+    Windows of batch_size * sort_window utterances are read from the loader and
+    sorted by length, so the batches of a window are out of the loader order.
+
+    Args:
+        loader: Iterator of (keys, batch) with a single utterance per batch
+        batch_size: The number of utterances per batch
+        sort_window: The number of batches sorted together
+    Returns:
+        Iterator of lists of (index in the loader, key, speech)
+    """
+    window = []
+    for index, (keys, batch) in enumerate(loader):
+        assert len(keys) == 1, len(keys)
+        speech = batch["speech"][0, : batch["speech_lengths"][0]]
+        window.append((index, keys[0], speech))
+        if len(window) == batch_size * sort_window:
+            window.sort(key=lambda x: len(x[2]), reverse=True)
+            for start in range(0, len(window), batch_size):
+                yield window[start : start + batch_size]
+            window = []
+    window.sort(key=lambda x: len(x[2]), reverse=True)
+    for start in range(0, len(window), batch_size):
+        yield window[start : start + batch_size]
+
+
+def pad_batch(
+    items: List[Tuple[int, str, torch.Tensor]]
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    speech = pad_list([x[2] for x in items], 0.0)
+    lengths = torch.tensor([len(x[2]) for x in items], dtype=torch.long)
+    return speech, lengths
+
+
+class InOrder:
+    """Release the results of the utterances in the order of the loader."""
+
+    def __init__(self):
+        self.pending = {}
+        self.next_index = 0
+
+    def push(self, index: int, key: str, results: Any) -> List[Tuple[str, Any]]:
+        self.pending[index] = (key, results)
+        released = []
+        while self.next_index in self.pending:
+            released.append(self.pending.pop(self.next_index))
+            self.next_index += 1
+        return released
+
+
+def batch_decode_sorted(
+    speech2text: Speech2Text,
+    loader,
+    batch_size: int,
+    sort_window: int,
+    decode: Callable,
+) -> Iterator[Tuple[str, Any]]:
+    """Decode the utterances in batches of similar lengths.
+
+    Args:
+        speech2text: Speech2Text instance
+        loader: Iterator of (keys, batch) with a single utterance per batch
+        batch_size: The number of utterances per decoding batch
+        sort_window: The number of batches sorted together
+        decode: Function decoding a single utterance by key and speech, used if
+            the batch fails
+    Returns:
+        Iterator of (key, results) in the order of the loader
+    """
+    in_order = InOrder()
+    for items in sorted_batches(loader, batch_size, sort_window):
+        try:
+            batch_results = speech2text.batch_decode(*pad_batch(items))
+        except TooShortUttError:
+            # Find the utterances which are too short
+            batch_results = [decode(key, speech=speech) for _, key, speech in items]
+        for (index, key, _), ret in zip(items, batch_results):
+            yield from in_order.push(index, key, ret)
+
+
+class _PipelineStopped(Exception):
+    """Raised in a pipeline stage when another stage has failed."""
 
-                        if text is not None:
-                            ibest_writer[f"text_spk{spk}"][key] = text
 
+def pipelined_decode(
+    speech2text: Speech2Text,
+    loader,
+    write: Callable,
+    batch_size: int,
+    sort_window: int,
+    decode: Callable,
+    queue_size: int = 2,
+):
+    """Decode with the loading, encoding, decoding and writing overlapped.
+
+    The loading, encoding and writing stages run in background threads and
+    the decoding runs in the calling thread. The stages are connected by
+    bounded queues. On GPU, the encoder uses its own CUDA stream. The busy
+    time of every stage is reported at the end.
+
+    Args:
+        speech2text: Speech2Text instance
+        loader: Iterator of (keys, batch) with a single utterance per batch
+        write: Function writing the results of an utterance by key
+        batch_size: The number of utterances per decoding batch
+        sort_window: The number of batches sorted together
+        decode: Function decoding a single utterance by key and speech, used if
+            the batch fails
+        queue_size: The maximum number of batches waiting between two stages
+    """
+    stop = threading.Event()
+    errors = []
+    busy = {"load": 0.0, "encode": 0.0, "decode": 0.0, "write": 0.0}
+    encode_queue = queue.Queue(maxsize=queue_size)
+    decode_queue = queue.Queue(maxsize=queue_size)
+    write_queue = queue.Queue(maxsize=queue_size)
+
+    def put(q: queue.Queue, item):
+        while True:
+            if stop.is_set():
+                raise _PipelineStopped()
+            try:
+                return q.put(item, timeout=0.1)
+            except queue.Full:
+                pass
+
+    def get(q: queue.Queue):
+        while True:
+            if stop.is_set():
+                raise _PipelineStopped()
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    def run(name: str, fn: Callable):
+        def target():
+            try:
+                fn()
+            except _PipelineStopped:
+                pass
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+
+        return threading.Thread(target=target, name=name, daemon=True)
+
+    def load():
+        batches = sorted_batches(loader, batch_size, sort_window)
+        while True:
+            start = time.perf_counter()
+            items = next(batches, None)
+            if items is not None:
+                items = (items, pad_batch(items))
+            busy["load"] += time.perf_counter() - start
+            put(encode_queue, items)
+            if items is None:
+                return
+
+    def encode():
+        if torch.device(speech2text.device).type == "cuda":
+            stream = torch.cuda.Stream(device=speech2text.device)
+        else:
+            stream = None
+        while True:
+            item = get(encode_queue)
+            if item is None:
+                put(decode_queue, None)
+                return
+            items, (speech, lengths) = item
+
+            start = time.perf_counter()
+            encoded = None
+            try:
+                if stream is None:
+                    encoded = speech2text.encode_batch(speech, lengths) + (None,)
+                else:
+                    with torch.cuda.stream(stream):
+                        encoded = speech2text.encode_batch(speech, lengths)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                    # Wait here, so that the busy time is the encoding time
+                    event.synchronize()
+                    encoded = encoded + (event,)
+            except TooShortUttError:
+                # The utterances are decoded one by one in the decoding stage
+                pass
+            busy["encode"] += time.perf_counter() - start
+            put(decode_queue, (items, encoded))
+
+    def write_all():
+        in_order = InOrder()
+        while True:
+            item = get(write_queue)
+            if item is None:
+                return
+            start = time.perf_counter()
+            for (index, key, _), ret in item:
+                for key, ret in in_order.push(index, key, ret):
+                    write(key, ret)
+            busy["write"] += time.perf_counter() - start
+
+    threads = [
+        run("load", load),
+        run("encode", encode),
+        run("write", write_all),
+    ]
+    start_time = time.perf_counter()
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            item = get(decode_queue)
+            if item is None:
+                put(write_queue, None)
+                break
+            items, encoded = item
+
+            start = time.perf_counter()
+            if encoded is None:
+                batch_results = [decode(key, speech=speech) for _, key, speech in items]
             else:
-                # Normal ASR
-                encoder_interctc_res = None
-                if isinstance(results, tuple):
-                    results, encoder_interctc_res = results
-
-                for n, (text, token, token_int, hyp) in zip(
-                    range(1, nbest + 1), results
-                ):
-                    # Create a directory: outdir/{n}best_recog
-                    ibest_writer = writer[f"{n}best_recog"]
-
-                    # Write the result to each file
-                    ibest_writer["token"][key] = " ".join(token)
-                    ibest_writer["token_int"][key] = " ".join(map(str, token_int))
-                    ibest_writer["score"][key] = str(hyp.score)
-
-                    if text is not None:
-                        ibest_writer["text"][key] = text
-
-                # Write intermediate predictions to
-                # encoder_interctc_layer<layer_idx>.txt
-                ibest_writer = writer[f"1best_recog"]
-                if encoder_interctc_res is not None:
-                    for idx, text in encoder_interctc_res.items():
-                        ibest_writer[f"encoder_interctc_layer{idx}.txt"][
-                            key
-                        ] = " ".join(text)
+                enc, enc_olens, intermediate_outs, event = encoded
+                if event is not None:
+                    current = torch.cuda.current_stream(enc.device)
+                    current.wait_event(event)
+                    # The memory of the encoder stream must not be reused early
+                    enc.record_stream(current)
+                    enc_olens.record_stream(current)
+                    for _, intermediate_out in intermediate_outs or []:
+                        intermediate_out.record_stream(current)
+                batch_results = speech2text.decode_batch(
+                    enc, enc_olens, intermediate_outs
+                )
+            busy["decode"] += time.perf_counter() - start
+            put(write_queue, list(zip(items, batch_results)))
+    except _PipelineStopped:
+        pass
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+
+    if len(errors) > 0:
+        raise errors[0]
+
+    elapsed = time.perf_counter() - start_time
+    for name, seconds in busy.items():
+        logging.info(
+            f"Pipeline stage {name}: busy for {seconds:.1f} s of {elapsed:.1f} s "
+            f"({100 * seconds / max(elapsed, 1e-9):.1f}%)"
+        )
+
+
+def write_results(
+    writer: DatadirWriter,
+    key: str,
+    results: Any,
+    nbest: int,
+    enh_s2t_task: bool,
+    multi_asr: bool,
+):
+    if enh_s2t_task or multi_asr:
+        # Enh+ASR joint task
+        for spk, ret in enumerate(results, 1):
+            for n, (text, token, token_int, hyp) in zip(range(1, nbest + 1), ret):
+                # Create a directory: outdir/{n}best_recog_spk?
+                ibest_writer = writer[f"{n}best_recog"]
+
+                # Write the result to each file
+                ibest_writer[f"token_spk{spk}"][key] = " ".join(token)
+                ibest_writer[f"token_int_spk{spk}"][key] = " ".join(
+                    map(str, token_int)
+                )
+                ibest_writer[f"score_spk{spk}"][key] = str(hyp.score)
+
+                if text is not None:
+                    ibest_writer[f"text_spk{spk}"][key] = text
+
+    else:
+        # Normal ASR
+        encoder_interctc_res = None
+        if isinstance(results, tuple):
+            results, encoder_interctc_res = results
+
+        for n, (text, token, token_int, hyp) in zip(range(1, nbest + 1), results):
+            # Create a directory: outdir/{n}best_recog
+            ibest_writer = writer[f"{n}best_recog"]
+
+            # Write the result to each file
+            ibest_writer["token"][key] = " ".join(token)
+            ibest_writer["token_int"][key] = " ".join(map(str, token_int))
+            ibest_writer["score"][key] = str(hyp.score)
+
+            if text is not None:
+                ibest_writer["text"][key] = text
+
+        # Write intermediate predictions to
+        # encoder_interctc_layer<layer_idx>.txt
+        ibest_writer = writer[f"1best_recog"]
+        if encoder_interctc_res is not None:
+            for idx, text in encoder_interctc_res.items():
+                ibest_writer[f"encoder_interctc_layer{idx}.txt"][key] = " ".join(
+                    text
+                )
 
 
 def get_parser():
@@ -952,6 +1799,60 @@ def get_parser():
         default=1,
         help="The batch size for inference",
     )
+    group.add_argument(
+        "--sort_window",
+        type=int,
+        default=16,
+        help="The number of batches whose utterances are sorted by length "
+        "together if batch_size > 1",
+    )
+    group.add_argument(
+        "--pipeline",
+        type=str2bool,
+        default=False,
+        help="Overlap the data loading, encoding, decoding and writing "
+        "in separate threads",
+    )
+    group.add_argument(
+        "--pipeline_queue_size",
+        type=int,
+        default=2,
+        help="The maximum number of batches waiting between two pipeline stages",
+    )
+    group.add_argument(
+        "--ctc_greedy",
+        type=str2bool,
+        default=False,
+        help="Greedy CTC decoding for a batch, without the beam search",
+    )
+    group.add_argument(
+        "--ctc_prefix_beam_search",
+        type=str2bool,
+        default=False,
+        help="CTC prefix beam search with beam_size prefixes for a batch, "
+        "without the attention decoder",
+    )
+    group.add_argument(
+        "--ctc_topk",
+        type=int,
+        default=0,
+        help="The number of tokens per frame in the CTC prefix beam search, "
+        "beam_size if 0",
+    )
+    group.add_argument(
+        "--ctc_blank_threshold",
+        type=float,
+        default=0.999,
+        help="The CTC prefix beam search does not extend the prefixes in the "
+        "frames with a larger blank probability. 1.0 disables the skipping",
+    )
+    group.add_argument(
+        "--ctc_vocab_file",
+        type=str_or_none,
+        default=None,
+        help="Token ids kept in the CTC output layer, one per line, "
+        "e.g. written by espnet2.bin.build_ctc_vocab",
+    )
     group.add_argument("--nbest", type=int, default=1, help="Output N-best hypotheses")
     group.add_argument("--beam_size", type=int, default=20, help="Beam size")
     group.add_argument("--penalty", type=float, default=0.0, help="Insertion penalty")
@@ -0,0 +1,569 @@
+#!/usr/bin/env python3
+import argparse
+import http.server
+import io
+import json
+import logging
+import math
+import os
+import queue
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional, Sequence, Union
+
+import numpy as np
+import soundfile
+import torch
+from typeguard import check_argument_types
+
+from espnet2.bin.asr_inference import Speech2Text
+from espnet2.torch_utils.set_all_random_seed import set_all_random_seed
+from espnet2.utils import config_argparse
+from espnet2.utils.nested_dict_action import NestedDictAction
+from espnet2.utils.types import str2bool, str_or_none
+from espnet.nets.pytorch_backend.nets_utils import pad_list
+from espnet.nets.pytorch_backend.transformer.subsampling import TooShortUttError
+from espnet.utils.cli_utils import get_commandline_args
+
+
+class Histogram:
+    """Cumulative histogram with fixed upper bounds, e.g. of latencies in ms.
+
+    Args:
+        bounds: upper bounds of the buckets, an infinite bucket is added
+    """
+
+    def __init__(self, bounds: Sequence[float]):
+        self.bounds = list(bounds) + [math.inf]
+        self.counts = [0] * len(self.bounds)
+        self.total = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self.lock:
+            for i, bound in enumerate(self.bounds):
+                if value <= bound:
+                    self.counts[i] += 1
+            self.total += value
+            self.count += 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "buckets": {
+                    str(bound): count for bound, count in zip(self.bounds, self.counts)
+                },
+                "sum": self.total,
+                "count": self.count,
+            }
+
+
+LATENCY_BOUNDS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+
+class _Request:
+    def __init__(self, speech: np.ndarray):
+        self.speech = speech
+        self.arrival = time.perf_counter()
+        self.future = Future()
+
+
+class DynamicBatcher:
+    """Decode the queued utterances of concurrent requests in batches.
+
+    A batch is decoded as soon as max_batch_size utterances are waiting or the
+    oldest waiting utterance has waited max_wait_ms. A single worker thread
+    runs Speech2Text, so the loaded model is shared by all requests.
+
+    Args:
+        speech2text: Speech2Text instance
+        max_batch_size: The maximum number of utterances per batch
+        max_wait_ms: The maximum time an utterance waits for a batch to fill
+        max_queue_size: The maximum number of waiting utterances, 0 for no limit
+
+    Examples:
+        >>> batcher = DynamicBatcher(speech2text, 8, 50.0)
+        >>> results = batcher.submit(np.zeros(16000, dtype=np.float32)).result()
+        >>> text, token, token_int, hyp = results[0]
+
+    """
+
+    def __init__(
+        self,
+        speech2text: Speech2Text,
+        max_batch_size: int = 8,
+        max_wait_ms: float = 50.0,
+        max_queue_size: int = 0,
+    ):
+        assert check_argument_types()
+        self.speech2text = speech2text
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue(maxsize=max_queue_size)
+
+        self.num_requests = 0
+        self.num_batches = 0
+        self.num_errors = 0
+        self.batch_sizes = Histogram(
+            [2**i for i in range(int(math.log2(max_batch_size)) + 1)]
+        )
+        self.queue_latency = Histogram(LATENCY_BOUNDS_MS)
+        self.decode_latency = Histogram(LATENCY_BOUNDS_MS)
+        self.total_latency = Histogram(LATENCY_BOUNDS_MS)
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="decode", daemon=True)
+        self._thread.start()
+
+    def submit(self, speech: np.ndarray) -> Future:
+        """Queue an utterance, raises queue.Full if too many are waiting.
+
+        Returns:
+            Future of the n-best list of (text, token, token_int, hyp)
+        """
+        request = _Request(speech)
+        self.queue.put_nowait(request)
+        return request.future
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _next_batch(self) -> List[_Request]:
+        try:
+            batch = [self.queue.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        deadline = batch[0].arrival + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                if timeout > 0:
+                    batch.append(self.queue.get(timeout=timeout))
+                else:
+                    # Take the utterances which are already waiting
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._next_batch()
+            if len(batch) > 0:
+                self._decode(batch)
+
+    def _decode(self, batch: List[_Request]):
+        start = time.perf_counter()
+        for request in batch:
+            self.queue_latency.observe(1000 * (start - request.arrival))
+
+        try:
+            speech = pad_list([torch.from_numpy(r.speech) for r in batch], 0.0)
+            lengths = torch.tensor([len(r.speech) for r in batch], dtype=torch.long)
+            try:
+                results = self.speech2text.batch_decode(speech, lengths)
+            except TooShortUttError:
+                # Find the utterances which are too short
+                results = []
+                for request in batch:
+                    try:
+                        results.append(self.speech2text(request.speech))
+                    except TooShortUttError as e:
+                        results.append(e)
+        except Exception as e:
+            logging.exception("Decoding failed")
+            results = [e] * len(batch)
+        # Speech2Text gives (n-best, interctc) if the encoder has intermediate CTC
+        results = [ret[0] if isinstance(ret, tuple) else ret for ret in results]
+
+        end = time.perf_counter()
+        self.decode_latency.observe(1000 * (end - start))
+        self.batch_sizes.observe(len(batch))
+        self.num_batches += 1
+        for request, ret in zip(batch, results):
+            self.num_requests += 1
+            self.total_latency.observe(1000 * (end - request.arrival))
+            if isinstance(ret, Exception):
+                self.num_errors += 1
+                request.future.set_exception(ret)
+            else:
+                request.future.set_result(ret)
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "queue_depth": self.queue.qsize(),
+            "requests": self.num_requests,
+            "batches": self.num_batches,
+            "errors": self.num_errors,
+            "batch_size": self.batch_sizes.to_dict(),
+            "queue_latency_ms": self.queue_latency.to_dict(),
+            "decode_latency_ms": self.decode_latency.to_dict(),
+            "total_latency_ms": self.total_latency.to_dict(),
+        }
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    """POST /recognize with an audio file, GET /metrics and GET /health."""
+
+    batcher: DynamicBatcher
+    fs: int
+    request_timeout: float
+
+    def _send_json(self, status: int, obj: Dict[str, Any]):
+        body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self._send_json(200, self.batcher.metrics())
+        elif self.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        else:
+            self._send_json(404, {"error": f"Unknown path: {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/recognize":
+            self._send_json(404, {"error": f"Unknown path: {self.path}"})
+            return
+
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            speech, rate = soundfile.read(
+                io.BytesIO(self.rfile.read(length)), dtype="float32"
+            )
+        except Exception as e:
+            self._send_json(400, {"error": f"Cannot read the audio: {e}"})
+            return
+        if speech.ndim != 1:
+            self._send_json(400, {"error": "Only single channel audio is supported"})
+            return
+        if rate != self.fs:
+            self._send_json(
+                400, {"error": f"The sampling rate must be {self.fs}: {rate}"}
+            )
+            return
+
+        try:
+            future = self.batcher.submit(speech)
+        except queue.Full:
+            self._send_json(503, {"error": "Too many requests are waiting"})
+            return
+        try:
+            results = future.result(timeout=self.request_timeout)
+        except TooShortUttError as e:
+            self._send_json(400, {"error": f"The utterance is too short: {e}"})
+            return
+        except Exception as e:
+            self._send_json(500, {"error": str(e)})
+            return
+
+        self._send_json(
+            200,
+            {
+                "results": [
+                    {
+                        "text": text,
+                        "token": token,
+                        "token_int": [int(t) for t in token_int],
+                        "score": float(hyp.score),
+                    }
+                    for text, token, token_int, hyp in results
+                ]
+            },
+        )
+
+    def address_string(self) -> str:
+        # The client address of a Unix socket is not a (host, port) pair
+        if isinstance(self.client_address, tuple):
+            return super().address_string()
+        return "unix"
+
+    def log_message(self, format, *args):
+        logging.debug(f"{self.address_string()} {format % args}")
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(
+    batcher: DynamicBatcher,
+    host: str,
+    port: int,
+    unix_socket: Optional[str],
+    fs: int,
+    request_timeout: float,
+) -> socketserver.BaseServer:
+    """HTTP server of the requests to the batcher, on a TCP port or a Unix socket."""
+    handler = type(
+        "Handler",
+        (_Handler,),
+        dict(batcher=batcher, fs=fs, request_timeout=request_timeout),
+    )
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = _UnixHTTPServer(unix_socket, handler)
+        logging.info(f"Serving on {unix_socket}")
+    else:
+        server = http.server.ThreadingHTTPServer((host, port), handler)
+        logging.info(f"Serving on http://{host}:{server.server_address[1]}")
+    return server
+
+
+def serve(
+    host: str,
+    port: int,
+    unix_socket: Optional[str],
+    max_batch_size: int,
+    max_wait_ms: float,
+    max_queue_size: int,
+    request_timeout: float,
+    fs: int,
+    ngpu: int,
+    seed: int,
+    dtype: str,
+    log_level: Union[int, str],
+    asr_train_config: Optional[str],
+    asr_model_file: Optional[str],
+    lm_train_config: Optional[str],
+    lm_file: Optional[str],
+    model_tag: Optional[str],
+    token_type: Optional[str],
+    bpemodel: Optional[str],
+    beam_size: int,
+    penalty: float,
+    maxlenratio: float,
+    minlenratio: float,
+    ctc_weight: float,
+    lm_weight: float,
+    nbest: int,
+    hugging_face_decoder: bool,
+    hugging_face_decoder_conf: Dict[str, Any],
+):
+    """Serve Speech2Text over HTTP on a TCP port or a Unix socket.
+
+    Without asr_model_file, the model is randomly initialized, e.g. to test the
+    server with a tiny configuration.
+    """
+    assert check_argument_types()
+    if ngpu > 1:
+        raise NotImplementedError("only single GPU decoding is supported")
+
+    logging.basicConfig(
+        level=log_level,
+        format="%(asctime)s (%(module)s:%(lineno)d) %(levelname)s: %(message)s",
+    )
+
+    if ngpu >= 1:
+        device = "cuda"
+    else:
+        device = "cpu"
+
+    # 1. Set random-seed
+    set_all_random_seed(seed)
+
+    # 2. Build speech2text
+    speech2text = Speech2Text.from_pretrained(
+        model_tag=model_tag,
+        asr_train_config=asr_train_config,
+        asr_model_file=asr_model_file,
+        lm_train_config=lm_train_config,
+        lm_file=lm_file,
+        token_type=token_type,
+        bpemodel=bpemodel,
+        device=device,
+        maxlenratio=maxlenratio,
+        minlenratio=minlenratio,
+        dtype=dtype,
+        beam_size=beam_size,
+        ctc_weight=ctc_weight,
+        lm_weight=lm_weight,
+        penalty=penalty,
+        nbest=nbest,
+        hugging_face_decoder=hugging_face_decoder,
+        hugging_face_decoder_conf=hugging_face_decoder_conf,
+    )
+
+    # 3. Start the batcher and the server
+    batcher = DynamicBatcher(speech2text, max_batch_size, max_wait_ms, max_queue_size)
+    server = make_server(batcher, host, port, unix_socket, fs, request_timeout)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+        if unix_socket is not None and os.path.exists(unix_socket):
+            os.remove(unix_socket)
+
+
+def get_parser():
+    parser = config_argparse.ArgumentParser(
+        description="ASR server with dynamic batching",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    # Note(kamo): Use '_' instead of '-' as separator.
+    # '-' is confusing if written in yaml.
+    parser.add_argument(
+        "--log_level",
+        type=lambda x: x.upper(),
+        default="INFO",
+        choices=("CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG", "NOTSET"),
+        help="The verbose level of logging",
+    )
+
+    parser.add_argument(
+        "--ngpu",
+        type=int,
+        default=0,
+        help="The number of gpus. 0 indicates CPU mode",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument(
+        "--dtype",
+        default="float32",
+        choices=["float16", "float32", "float64"],
+        help="Data type",
+    )
+
+    group = parser.add_argument_group("Server related")
+    group.add_argument("--host", type=str, default="127.0.0.1")
+    group.add_argument(
+        "--port", type=int, default=8000, help="TCP port, 0 for a free one"
+    )
+    group.add_argument(
+        "--unix_socket",
+        type=str_or_none,
+        default=None,
+        help="If given, listen on this Unix socket instead of the TCP port",
+    )
+    group.add_argument(
+        "--max_batch_size",
+        type=int,
+        default=8,
+        help="The maximum number of utterances decoded together",
+    )
+    group.add_argument(
+        "--max_wait_ms",
+        type=float,
+        default=50.0,
+        help="The maximum time an utterance waits for its batch to fill",
+    )
+    group.add_argument(
+        "--max_queue_size",
+        type=int,
+        default=0,
+        help="The maximum number of waiting utterances, more are rejected "
+        "with 503. 0 indicates no limit",
+    )
+    group.add_argument(
+        "--request_timeout",
+        type=float,
+        default=600.0,
+        help="The maximum time in seconds to wait for the result of a request",
+    )
+    group.add_argument(
+        "--fs", type=int, default=16000, help="The sampling rate of the audio"
+    )
+
+    group = parser.add_argument_group("The model configuration related")
+    group.add_argument(
+        "--asr_train_config",
+        type=str,
+        help="ASR training configuration",
+    )
+    group.add_argument(
+        "--asr_model_file",
+        type=str,
+        help="ASR model parameter file. If not given, the model is randomly "
+        "initialized",
+    )
+    group.add_argument(
+        "--lm_train_config",
+        type=str,
+        help="LM training configuration",
+    )
+    group.add_argument(
+        "--lm_file",
+        type=str,
+        help="LM parameter file",
+    )
+    group.add_argument(
+        "--model_tag",
+        type=str,
+        help="Pretrained model tag. If specify this option, *_train_config and "
+        "*_file will be overwritten",
+    )
+
+    group = parser.add_argument_group("Beam-search related")
+    group.add_argument("--nbest", type=int, default=1, help="Output N-best hypotheses")
+    group.add_argument("--beam_size", type=int, default=20, help="Beam size")
+    group.add_argument("--penalty", type=float, default=0.0, help="Insertion penalty")
+    group.add_argument(
+        "--maxlenratio",
+        type=float,
+        default=0.0,
+        help="Input length ratio to obtain max output length",
+    )
+    group.add_argument(
+        "--minlenratio",
+        type=float,
+        default=0.0,
+        help="Input length ratio to obtain min output length",
+    )
+    group.add_argument(
+        "--ctc_weight",
+        type=float,
+        default=0.5,
+        help="CTC weight in joint decoding",
+    )
+    group.add_argument("--lm_weight", type=float, default=1.0, help="RNNLM weight")
+    group.add_argument("--hugging_face_decoder", type=str2bool, default=False)
+    group.add_argument(
+        "--hugging_face_decoder_conf", type=NestedDictAction, default=dict()
+    )
+
+    group = parser.add_argument_group("Text converter related")
+    group.add_argument(
+        "--token_type",
+        type=str_or_none,
+        default=None,
+        choices=["char", "bpe", None],
+        help="The token type for ASR model. "
+        "If not given, refers from the training args",
+    )
+    group.add_argument(
+        "--bpemodel",
+        type=str_or_none,
+        default=None,
+        help="The model path of sentencepiece. "
+        "If not given, refers from the training args",
+    )
+
+    return parser
+
+
+def main(cmd=None):
+    print(get_commandline_args(), file=sys.stderr)
+    parser = get_parser()
+    args = parser.parse_args(cmd)
+    kwargs = vars(args)
+    kwargs.pop("config", None)
+    serve(**kwargs)
+
+
+if __name__ == "__main__":
+    main()
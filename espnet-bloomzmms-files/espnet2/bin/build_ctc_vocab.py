@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+import argparse
+import logging
+import sys
+from pathlib import Path
+from typing import List, Optional, Sequence, Union
+
+import yaml
+from typeguard import check_argument_types
+
+from espnet2.tasks.asr import ASRTask
+from espnet2.utils import config_argparse
+from espnet.utils.cli_utils import get_commandline_args
+
+
+def build_ctc_vocab(
+    output: str,
+    text: Optional[Sequence[str]],
+    text_int: Optional[Sequence[str]],
+    asr_train_config: str,
+    keep_ids: Optional[List[int]],
+    log_level: Union[int, str],
+):
+    """Write the token ids occurring in the training texts, one per line.
+
+    The blank (0) and the id of sym_blank are always kept. The ids are those
+    of the token_list of the ASR model, i.e. of the whole vocabulary.
+    """
+    assert check_argument_types()
+    logging.basicConfig(
+        level=log_level,
+        format="%(asctime)s (%(module)s:%(lineno)d) %(levelname)s: %(message)s",
+    )
+
+    with Path(asr_train_config).open("r", encoding="utf-8") as f:
+        train_args = yaml.safe_load(f)
+
+    token_list = train_args["token_list"]
+    if isinstance(token_list, str):
+        with open(token_list, encoding="utf-8") as f:
+            token_list = [line.rstrip() for line in f]
+
+    ids = {0}
+    sym_blank = train_args.get("model_conf", {}).get("sym_blank", "<blank>")
+    if sym_blank in token_list:
+        ids.add(token_list.index(sym_blank))
+    if keep_ids is not None:
+        ids.update(keep_ids)
+
+    # 1. Tokenize the texts with the preprocessor of the training, i.e. with
+    # its text cleaner and non-linguistic symbols. The noise and RIR data are
+    # not needed for the texts, so the preprocessor of the inference is used.
+    if text is not None:
+        preprocess_fn = ASRTask.build_preprocess_fn(
+            argparse.Namespace(**train_args), False
+        )
+        if preprocess_fn is None:
+            raise RuntimeError(
+                "The texts cannot be tokenized without use_preprocessor, "
+                "give --text_int instead"
+            )
+        for path in text:
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    fields = line.rstrip("\n").split(maxsplit=1)
+                    if len(fields) < 2:
+                        continue
+                    data = preprocess_fn(fields[0], {"text": fields[1]})
+                    ids.update(data["text"].tolist())
+
+    # 2. Take the already tokenized texts as they are
+    if text_int is not None:
+        for path in text_int:
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    ids.update(int(x) for x in line.split()[1:])
+
+    if max(ids) >= len(token_list):
+        raise RuntimeError(f"Token id {max(ids)} is not in the token_list")
+
+    with open(output, "w", encoding="utf-8") as f:
+        for i in sorted(ids):
+            f.write(f"{i}\n")
+    logging.info(
+        f"Kept {len(ids)} of {len(token_list)} tokens "
+        f"({100 * len(ids) / len(token_list):.2f}%) in {output}"
+    )
+
+
+def get_parser():
+    parser = config_argparse.ArgumentParser(
+        description="Build the reduced vocabulary of a pruned CTC output layer",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    parser.add_argument(
+        "--log_level",
+        type=lambda x: x.upper(),
+        default="INFO",
+        choices=("CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG", "NOTSET"),
+        help="The verbose level of logging",
+    )
+
+    parser.add_argument(
+        "--output",
+        type=str,
+        required=True,
+        help="The output file of the kept token ids",
+    )
+    parser.add_argument(
+        "--text",
+        type=str,
+        action="append",
+        help="Kaldi-style text file, cleaned and tokenized like in the training",
+    )
+    parser.add_argument(
+        "--text_int",
+        type=str,
+        action="append",
+        help="Kaldi-style file of the token ids of every utterance",
+    )
+    parser.add_argument(
+        "--asr_train_config",
+        type=str,
+        required=True,
+        help="ASR training configuration, giving the token_list and tokenizer",
+    )
+    parser.add_argument(
+        "--keep_ids",
+        type=int,
+        nargs="*",
+        help="Token ids kept in addition to those of the texts",
+    )
+    return parser
+
+
+def main(cmd=None):
+    print(get_commandline_args(), file=sys.stderr)
+    parser = get_parser()
+    args = parser.parse_args(cmd)
+    kwargs = vars(args)
+    kwargs.pop("config", None)
+    build_ctc_vocab(**kwargs)
+
+
+if __name__ == "__main__":
+    main()
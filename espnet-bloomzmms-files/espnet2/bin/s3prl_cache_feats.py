@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+import argparse
+import logging
+import sys
+from typing import Optional, Sequence, Tuple, Union
+
+import torch
+from typeguard import check_argument_types
+
+from espnet2.asr.frontend.s3prl import build_frontend
+from espnet2.fileio.feats_cache import FeatsCache
+from espnet2.tasks.asr import ASRTask
+from espnet2.torch_utils.device_funcs import to_device
+from espnet2.utils import config_argparse
+from espnet2.utils.types import str2bool, str2triple_str, str_or_none
+from espnet.utils.cli_utils import get_commandline_args
+
+
+@torch.no_grad()
+def cache_feats(
+    cache_dir: str,
+    shard: Optional[str],
+    batch_size: int,
+    dtype: str,
+    ngpu: int,
+    num_workers: int,
+    log_level: Union[int, str],
+    data_path_and_name_and_type: Sequence[Tuple[str, str, str]],
+    key_file: Optional[str],
+    asr_train_config: str,
+    allow_variable_data_keys: bool,
+):
+    assert check_argument_types()
+    if ngpu > 1:
+        raise NotImplementedError("only single GPU caching is supported")
+
+    logging.basicConfig(
+        level=log_level,
+        format="%(asctime)s (%(module)s:%(lineno)d) %(levelname)s: %(message)s",
+    )
+
+    if ngpu >= 1:
+        device = "cuda:0"
+    else:
+        device = "cpu"
+
+    # 1. Build the frontend only, the rest of the model is not needed
+    frontend, train_args = build_frontend(asr_train_config)
+    frontend.feats_cache = FeatsCache(cache_dir, shard=shard)
+    frontend.to(device=device).eval()
+
+    # 2. Build data-iterator
+    loader = ASRTask.build_streaming_iterator(
+        data_path_and_name_and_type,
+        dtype=dtype,
+        batch_size=batch_size,
+        key_file=key_file,
+        num_workers=num_workers,
+        preprocess_fn=None,
+        collate_fn=ASRTask.build_collate_fn(train_args, False),
+        allow_variable_data_keys=allow_variable_data_keys,
+        inference=True,
+    )
+
+    # 3. Forward the upstream for the utterances missing from the cache
+    num_cached = 0
+    for keys, batch in loader:
+        assert all(isinstance(s, str) for s in keys), keys
+        missing = [i for i, k in enumerate(keys) if k not in frontend.feats_cache]
+        if len(missing) == 0:
+            continue
+
+        batch = to_device(batch, device=device)
+        speech, speech_lengths = batch["speech"], batch["speech_lengths"]
+        index = torch.tensor(missing, device=speech.device)
+        speech, speech_lengths = speech[index], speech_lengths[index]
+        frontend.cache_upstream(
+            speech[:, : speech_lengths.max()],
+            speech_lengths,
+            [keys[i] for i in missing],
+        )
+        num_cached += len(missing)
+
+    frontend.feats_cache.close()
+    logging.info(f"Cached {num_cached} utterances in {cache_dir}")
+
+
+def get_parser():
+    parser = config_argparse.ArgumentParser(
+        description="Cache the frozen S3PRL upstream features of the ASR frontend",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    # Note(kamo): Use '_' instead of '-' as separator.
+    # '-' is confusing if written in yaml.
+    parser.add_argument(
+        "--log_level",
+        type=lambda x: x.upper(),
+        default="INFO",
+        choices=("CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG", "NOTSET"),
+        help="The verbose level of logging",
+    )
+
+    parser.add_argument("--cache_dir", type=str, required=True)
+    parser.add_argument(
+        "--shard",
+        type=str_or_none,
+        default=None,
+        help="The name of the cache shard written by this job. "
+        "Parallel jobs must use different shards",
+    )
+    parser.add_argument(
+        "--ngpu",
+        type=int,
+        default=0,
+        help="The number of gpus. 0 indicates CPU mode",
+    )
+    parser.add_argument(
+        "--dtype",
+        default="float32",
+        choices=["float16", "float32", "float64"],
+        help="Data type",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=1,
+        help="The number of workers used for DataLoader",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=1,
+        help="The batch size for the upstream forward",
+    )
+
+    group = parser.add_argument_group("Input data related")
+    group.add_argument(
+        "--data_path_and_name_and_type",
+        type=str2triple_str,
+        required=True,
+        action="append",
+    )
+    group.add_argument("--key_file", type=str_or_none)
+    group.add_argument("--allow_variable_data_keys", type=str2bool, default=False)
+
+    group = parser.add_argument_group("The model configuration related")
+    group.add_argument(
+        "--asr_train_config",
+        type=str,
+        required=True,
+        help="ASR training configuration",
+    )
+
+    return parser
+
+
+def main(cmd=None):
+    print(get_commandline_args(), file=sys.stderr)
+    parser = get_parser()
+    args = parser.parse_args(cmd)
+    kwargs = vars(args)
+    kwargs.pop("config", None)
+    cache_feats(**kwargs)
+
+
+if __name__ == "__main__":
+    main()
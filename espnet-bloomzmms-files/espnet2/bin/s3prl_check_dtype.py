@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+import argparse
+import logging
+import sys
+from pathlib import Path
+from typing import Optional, Sequence, Tuple, Union
+
+import torch
+from typeguard import check_argument_types
+
+from espnet2.asr.frontend.s3prl import build_frontend
+from espnet2.tasks.asr import ASRTask
+from espnet2.torch_utils.device_funcs import to_device
+from espnet2.utils import config_argparse
+from espnet2.utils.types import float_or_none, str2bool, str2triple_str, str_or_none
+from espnet.utils.cli_utils import get_commandline_args
+
+
+@torch.no_grad()
+def check_dtype(
+    output_file: Optional[str],
+    upstream_dtype: str,
+    num_utts: int,
+    batch_size: int,
+    max_rel_error: Optional[float],
+    ngpu: int,
+    num_workers: int,
+    log_level: Union[int, str],
+    data_path_and_name_and_type: Sequence[Tuple[str, str, str]],
+    key_file: Optional[str],
+    asr_train_config: str,
+    asr_model_file: Optional[str],
+    allow_variable_data_keys: bool,
+):
+    """Compare the reduced-precision frontend output with the float32 one.
+
+    For each utterance, the maximum absolute error, the relative L2 error and
+    the cosine similarity of the features are computed over the valid frames.
+    """
+    assert check_argument_types()
+    if ngpu > 1:
+        raise NotImplementedError("only single GPU is supported")
+
+    logging.basicConfig(
+        level=log_level,
+        format="%(asctime)s (%(module)s:%(lineno)d) %(levelname)s: %(message)s",
+    )
+
+    if ngpu >= 1:
+        device = "cuda:0"
+    else:
+        device = "cpu"
+
+    # 1. Build the frontend only, the rest of the model is not needed
+    frontend, train_args = build_frontend(asr_train_config, asr_model_file)
+    frontend.to(device=device).eval()
+
+    # 2. Build data-iterator
+    loader = ASRTask.build_streaming_iterator(
+        data_path_and_name_and_type,
+        dtype="float32",
+        batch_size=batch_size,
+        key_file=key_file,
+        num_workers=num_workers,
+        preprocess_fn=None,
+        collate_fn=ASRTask.build_collate_fn(train_args, False),
+        allow_variable_data_keys=allow_variable_data_keys,
+        inference=True,
+    )
+
+    # 3. Forward the same utterances in float32 and in upstream_dtype
+    results = []
+    for keys, batch in loader:
+        batch = to_device(batch, device=device)
+        speech, speech_lengths = batch["speech"], batch["speech_lengths"]
+
+        frontend.upstream_dtype = "float32"
+        ref, ref_lens = frontend(speech, speech_lengths)
+        frontend.upstream_dtype = upstream_dtype
+        hyp, _ = frontend(speech, speech_lengths)
+
+        for i, key in enumerate(keys):
+            r = ref[i, : ref_lens[i]].double()
+            h = hyp[i, : ref_lens[i]].double()
+            max_abs_error = (r - h).abs().max().item()
+            rel_error = ((r - h).norm() / r.norm().clamp(min=1e-12)).item()
+            cosine = torch.nn.functional.cosine_similarity(
+                r.flatten(), h.flatten(), dim=0
+            ).item()
+            results.append((key, max_abs_error, rel_error, cosine))
+            logging.info(
+                f"{key}: max_abs_error={max_abs_error:.4g}, "
+                f"rel_error={rel_error:.4g}, cosine={cosine:.6f}"
+            )
+
+        if len(results) >= num_utts:
+            break
+
+    if len(results) == 0:
+        raise RuntimeError("No utterances were read")
+
+    # 4. Report the drift
+    if output_file is not None:
+        with Path(output_file).open("w", encoding="utf-8") as f:
+            for key, max_abs_error, rel_error, cosine in results:
+                f.write(f"{key} {max_abs_error:.6g} {rel_error:.6g} {cosine:.8f}\n")
+
+    worst_rel_error = max(r[2] for r in results)
+    logging.info(
+        f"{upstream_dtype} vs float32 on {len(results)} utterances: "
+        f"max_abs_error={max(r[1] for r in results):.4g}, "
+        f"mean_rel_error={sum(r[2] for r in results) / len(results):.4g}, "
+        f"max_rel_error={worst_rel_error:.4g}, "
+        f"min_cosine={min(r[3] for r in results):.6f}"
+    )
+    if max_rel_error is not None and worst_rel_error > max_rel_error:
+        raise RuntimeError(
+            f"The relative error {worst_rel_error:.4g} exceeds {max_rel_error}"
+        )
+
+
+def get_parser():
+    parser = config_argparse.ArgumentParser(
+        description="Check the numerical drift of the reduced-precision "
+        "S3PRL frontend against float32",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+
+    # Note(kamo): Use '_' instead of '-' as separator.
+    # '-' is confusing if written in yaml.
+    parser.add_argument(
+        "--log_level",
+        type=lambda x: x.upper(),
+        default="INFO",
+        choices=("CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG", "NOTSET"),
+        help="The verbose level of logging",
+    )
+
+    parser.add_argument(
+        "--output_file",
+        type=str_or_none,
+        default=None,
+        help="If given, write '<key> <max_abs_error> <rel_error> <cosine>' lines",
+    )
+    parser.add_argument(
+        "--upstream_dtype",
+        default="bfloat16",
+        choices=["bfloat16", "float16"],
+        help="The reduced precision compared with float32",
+    )
+    parser.add_argument(
+        "--num_utts",
+        type=int,
+        default=100,
+        help="The number of utterances to compare, taken in the order of the data",
+    )
+    parser.add_argument(
+        "--max_rel_error",
+        type=float_or_none,
+        default=None,
+        help="If given, fail when the relative error of an utterance exceeds it",
+    )
+    parser.add_argument(
+        "--ngpu",
+        type=int,
+        default=0,
+        help="The number of gpus. 0 indicates CPU mode",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=1,
+        help="The number of workers used for DataLoader",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=1,
+        help="The batch size for the frontend forward",
+    )
+
+    group = parser.add_argument_group("Input data related")
+    group.add_argument(
+        "--data_path_and_name_and_type",
+        type=str2triple_str,
+        required=True,
+        action="append",
+    )
+    group.add_argument("--key_file", type=str_or_none)
+    group.add_argument("--allow_variable_data_keys", type=str2bool, default=False)
+
+    group = parser.add_argument_group("The model configuration related")
+    group.add_argument(
+        "--asr_train_config",
+        type=str,
+        required=True,
+        help="ASR training configuration",
+    )
+    group.add_argument(
+        "--asr_model_file",
+        type=str_or_none,
+        default=None,
+        help="If given, the trained Featurizer weights are loaded from it",
+    )
+
+    return parser
+
+
+def main(cmd=None):
+    print(get_commandline_args(), file=sys.stderr)
+    parser = get_parser()
+    args = parser.parse_args(cmd)
+    kwargs = vars(args)
+    kwargs.pop("config", None)
+    check_dtype(**kwargs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+import collections.abc
+import os
+import socket
+import time
+from pathlib import Path
+from typing import Dict, Optional, Tuple, Union
+
+import numpy as np
+from typeguard import check_argument_types
+
+
+class FeatsCache(collections.abc.MutableMapping):
+    """Append-only feature store backed by memory-mapped shards.
+
+    Every writing process appends to its own shard, which consists of a raw
+    data file "<shard>.bin" and an index "<shard>.idx" having one
+    "<key> <byte_offset> <dtype> <comma separated shape>" line per entry.
+    All shards found in the directory are readable, including the ones
+    which are still being written by other processes. The lookups of missing
+    keys re-read the indices at most once every refresh_interval seconds,
+    and only the indices which have grown since they were last read.
+
+    Examples:
+        >>> cache = FeatsCache("dump/feats_cache", shard="job1")
+        >>> cache["sp0.9-utt1"] = np.zeros((49, 120, 1280), dtype=np.float32)
+        >>> cache["sp0.9-utt1"].shape
+        (49, 120, 1280)
+        >>> "sp0.9-utt1" in FeatsCache("dump/feats_cache")
+        True
+
+    """
+
+    def __init__(
+        self,
+        cache_dir: Union[Path, str],
+        shard: Optional[str] = None,
+        dtype: str = "float16",
+        refresh_interval: float = 10.0,
+    ):
+        assert check_argument_types()
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        if shard is None:
+            shard = f"{socket.gethostname()}.{os.getpid()}"
+        self.shard = shard
+        self.dtype = np.dtype(dtype)
+        self.refresh_interval = refresh_interval
+        self._last_refresh = -float("inf")
+
+        # key -> (shard, byte offset, dtype, shape)
+        self._index: Dict[str, Tuple[str, int, np.dtype, Tuple[int, ...]]] = {}
+        # shard -> position up to which its index file has been parsed
+        self._index_pos: Dict[str, int] = {}
+        self._maps: Dict[str, np.memmap] = {}
+        self._data_file = None
+        self._index_file = None
+
+        self.refresh()
+
+    def refresh(self):
+        """Parse the entries appended to the shard indices since the last call."""
+        self._last_refresh = time.monotonic()
+        for index_path in sorted(self.cache_dir.glob("*.idx")):
+            shard = index_path.stem
+            if index_path.stat().st_size <= self._index_pos.get(shard, 0):
+                continue
+            with index_path.open("rb") as f:
+                f.seek(self._index_pos.get(shard, 0))
+                for line in f:
+                    # Skip the line which is still being written
+                    if not line.endswith(b"\n"):
+                        break
+                    key, offset, dtype, shape = line.decode("utf-8").split()
+                    self._index[key] = (
+                        shard,
+                        int(offset),
+                        np.dtype(dtype),
+                        tuple(int(s) for s in shape.split(",")),
+                    )
+                    self._index_pos[shard] = (
+                        self._index_pos.get(shard, 0) + len(line)
+                    )
+
+    def _get_map(self, shard: str, end: int) -> np.memmap:
+        mm = self._maps.get(shard)
+        if mm is None or mm.size < end:
+            # (Re-)map the shard, it has grown since it was mapped
+            mm = np.memmap(self.cache_dir / f"{shard}.bin", dtype=np.uint8, mode="r")
+            self._maps[shard] = mm
+        return mm
+
+    def _refresh_on_miss(self):
+        if time.monotonic() - self._last_refresh >= self.refresh_interval:
+            self.refresh()
+
+    def __getitem__(self, key: str) -> np.ndarray:
+        if key not in self._index:
+            self._refresh_on_miss()
+        shard, offset, dtype, shape = self._index[key]
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        mm = self._get_map(shard, offset + nbytes)
+        return mm[offset : offset + nbytes].view(dtype).reshape(shape)
+
+    def __setitem__(self, key: str, value: np.ndarray):
+        if " " in key:
+            raise RuntimeError(f"Keys must not contain spaces: '{key}'")
+        if self._data_file is None:
+            self._data_file = (self.cache_dir / f"{self.shard}.bin").open("ab")
+            self._index_file = (self.cache_dir / f"{self.shard}.idx").open(
+                "a", encoding="utf-8"
+            )
+
+        value = np.ascontiguousarray(value, dtype=self.dtype)
+        self._data_file.seek(0, os.SEEK_END)
+        offset = self._data_file.tell()
+        self._data_file.write(value.tobytes())
+        self._data_file.flush()
+
+        # The index line is written after the data, so that readers never
+        # see an entry whose data is incomplete
+        shape = ",".join(str(s) for s in value.shape)
+        self._index_file.write(f"{key} {offset} {self.dtype.name} {shape}\n")
+        self._index_file.flush()
+        self._index[key] = (self.shard, offset, self.dtype, value.shape)
+
+    def __delitem__(self, key: str):
+        raise RuntimeError(f"{self.__class__.__name__} is append-only")
+
+    def __contains__(self, key) -> bool:
+        if key not in self._index:
+            self._refresh_on_miss()
+        return key in self._index
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def close(self):
+        if self._data_file is not None:
+            self._data_file.close()
+            self._index_file.close()
+            self._data_file = None
+            self._index_file = None
+
+    def __getstate__(self):
+        # Open file handles and memory maps are not picklable
+        state = self.__dict__.copy()
+        state["_maps"] = {}
+        state["_data_file"] = None
+        state["_index_file"] = None
+        return state
@@ -0,0 +1,108 @@
+"""Label smoothing loss fused with the output layer."""
+
+import math
+from typing import Callable, Tuple
+
+import torch
+from torch.utils.checkpoint import checkpoint
+from typeguard import check_argument_types
+
+
+class ChunkedLabelSmoothingLoss(torch.nn.Module):
+    """Label-smoothing loss computed together with the output layer.
+
+    Gives the same value as LabelSmoothingLoss applied to output_layer(hs_pad),
+    but the logits are only computed for chunk_size target tokens at a time and
+    recomputed in the backward, so the logits of the whole batch are never
+    materialized. The padded target tokens are skipped.
+
+    Args:
+        size: the number of classes
+        padding_idx: ignored class id
+        smoothing: smoothing rate (0.0 means the conventional CE)
+        normalize_length: normalize loss by sequence length if True
+        chunk_size: the number of target tokens per chunk
+    """
+
+    def __init__(
+        self,
+        size: int,
+        padding_idx: int,
+        smoothing: float,
+        normalize_length: bool = False,
+        chunk_size: int = 1024,
+    ):
+        assert check_argument_types()
+        super().__init__()
+        self.size = size
+        self.padding_idx = padding_idx
+        self.smoothing = smoothing
+        self.confidence = 1.0 - smoothing
+        self.normalize_length = normalize_length
+        self.chunk_size = chunk_size
+
+        # Probability of every non-target class in the smoothed distribution
+        self.eps = smoothing / (size - 1)
+        # Negative entropy of the smoothed distribution, the constant of the KL
+        self.neg_entropy = 0.0
+        if self.confidence > 0.0:
+            self.neg_entropy += self.confidence * math.log(self.confidence)
+        if self.eps > 0.0:
+            self.neg_entropy += (size - 1) * self.eps * math.log(self.eps)
+
+    def _chunk_loss(
+        self, hs: torch.Tensor, target: torch.Tensor, output_layer: Callable
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        logits = output_layer(hs).float()
+        assert logits.size(1) == self.size
+        log_norm = torch.logsumexp(logits, dim=1)
+        logp_target = logits.gather(1, target.unsqueeze(1)).squeeze(1) - log_norm
+        sum_logp = logits.sum(dim=1) - self.size * log_norm
+        # KL(smoothed || softmax(logits)) of every token
+        kl = (
+            self.neg_entropy
+            - self.eps * sum_logp
+            - (self.confidence - self.eps) * logp_target
+        )
+        return kl.sum(), logits.argmax(dim=1)
+
+    def forward(
+        self, hs_pad: torch.Tensor, output_layer: Callable, target: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Compute loss between output_layer(hs_pad) and target.
+
+        Args:
+            hs_pad: hidden states before the output layer (batch, seqlen, hidden)
+            output_layer: maps (n, hidden) to logits (n, size)
+            target: target signal masked with self.padding_idx (batch, seqlen)
+        Returns:
+            loss: scalar
+            pred: predicted class ids, padding_idx for ignored tokens
+                (batch, seqlen)
+        """
+        batch_size = hs_pad.size(0)
+        mask = target != self.padding_idx
+        hs = hs_pad[mask]
+        ys = target[mask]
+
+        loss = hs.new_zeros((), dtype=torch.float32)
+        preds = []
+        for start in range(0, ys.size(0), self.chunk_size):
+            args = (
+                hs[start : start + self.chunk_size],
+                ys[start : start + self.chunk_size],
+                output_layer,
+            )
+            if torch.is_grad_enabled() and hs.requires_grad:
+                chunk_loss, chunk_pred = checkpoint(self._chunk_loss, *args)
+            else:
+                chunk_loss, chunk_pred = self._chunk_loss(*args)
+            loss = loss + chunk_loss
+            preds.append(chunk_pred)
+
+        pred = target.new_full(target.shape, self.padding_idx)
+        if len(preds) > 0:
+            pred[mask] = torch.cat(preds)
+
+        denom = ys.size(0) if self.normalize_length else batch_size
+        return loss / denom, pred
@@ -0,0 +1,41 @@
+import pytest
+import torch
+
+from espnet2.asr.ctc import CTC
+
+
+@pytest.mark.parametrize("loss_chunk_size", [1, 3, 4])
+@pytest.mark.parametrize("bias", [True, False])
+@pytest.mark.parametrize("reduce", [True, False])
+def test_CTC_loss_chunk_size(loss_chunk_size, bias, reduce):
+    torch.manual_seed(0)
+    ctc = CTC(odim=50, encoder_output_size=8, bias=bias, reduce=reduce).double()
+    chunked = CTC(
+        odim=50,
+        encoder_output_size=8,
+        bias=bias,
+        reduce=reduce,
+        loss_chunk_size=loss_chunk_size,
+    ).double()
+    chunked.load_state_dict(ctc.state_dict())
+
+    hs_pad = torch.randn(2, 10, 8, dtype=torch.double)
+    hlens = torch.tensor([10, 7])
+    ys_pad = torch.tensor([[5, 17, 17, 42], [3, 49, -1, -1]])
+    ys_lens = torch.tensor([4, 2])
+
+    losses, grads = [], []
+    for model in (ctc, chunked):
+        hs = hs_pad.clone().requires_grad_(True)
+        loss = model(hs, hlens, ys_pad, ys_lens)
+        loss.sum().backward()
+        losses.append(loss.detach())
+        grads.append(
+            [hs.grad] + [p.grad for p in model.parameters() if p.grad is not None]
+        )
+
+    # The loss and the gradients are the same as with the whole vocabulary
+    torch.testing.assert_close(losses[0], losses[1])
+    assert len(grads[0]) == len(grads[1])
+    for g0, g1 in zip(*grads):
+        torch.testing.assert_close(g0, g1)
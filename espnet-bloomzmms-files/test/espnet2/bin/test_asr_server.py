@@ -0,0 +1,234 @@
+import io
+import json
+import queue
+import string
+import threading
+import time
+import urllib.request
+from argparse import ArgumentParser
+from pathlib import Path
+
+import numpy as np
+import pytest
+import soundfile
+import torch
+
+from espnet2.bin.asr_inference import Speech2Text
+from espnet2.bin.asr_server import DynamicBatcher, Histogram, get_parser, make_server
+from espnet2.tasks.asr import ASRTask
+from espnet.nets.beam_search import Hypothesis
+from espnet.nets.pytorch_backend.transformer.subsampling import TooShortUttError
+
+
+class StubSpeech2Text(Speech2Text):
+    """Return the length of every utterance as its text, without any model."""
+
+    def __init__(self, min_length=0, interctc=False, block=None):
+        self.min_length = min_length
+        self.interctc = interctc
+        self.block = block
+        self.batch_sizes = []
+
+    def _result(self, length):
+        hyp = Hypothesis(score=-1.0, yseq=torch.tensor([1, 2, 1]))
+        nbest = [(str(length), ["a"], [2], hyp)]
+        if self.interctc:
+            return nbest, {3: ["a"]}
+        return nbest
+
+    def __call__(self, speech):
+        if len(speech) < self.min_length:
+            raise TooShortUttError("too short", len(speech), self.min_length)
+        return self._result(len(speech))
+
+    def batch_decode(self, speech, speech_lengths):
+        if self.block is not None:
+            self.block.wait()
+        self.batch_sizes.append(len(speech_lengths))
+        if int(speech_lengths.min()) < self.min_length:
+            raise TooShortUttError("too short", 0, self.min_length)
+        return [self._result(int(length)) for length in speech_lengths]
+
+
+def test_get_parser():
+    assert isinstance(get_parser(), ArgumentParser)
+
+
+def test_Histogram():
+    histogram = Histogram([1, 10])
+    for value in (0.5, 5, 5, 100):
+        histogram.observe(value)
+    d = histogram.to_dict()
+    assert d["buckets"] == {"1": 1, "10": 3, "inf": 4}
+    assert d["sum"] == 110.5
+    assert d["count"] == 4
+
+
+@pytest.mark.parametrize("interctc", [False, True])
+def test_DynamicBatcher_full_batch(interctc):
+    block = threading.Event()
+    speech2text = StubSpeech2Text(interctc=interctc, block=block)
+    batcher = DynamicBatcher(speech2text, max_batch_size=4, max_wait_ms=10000.0)
+    try:
+        futures = [batcher.submit(np.zeros(n, dtype=np.float32)) for n in range(1, 9)]
+        block.set()
+        results = [f.result(timeout=10) for f in futures]
+    finally:
+        batcher.close()
+
+    # Full batches are decoded without waiting for max_wait_ms
+    assert speech2text.batch_sizes == [4, 4]
+    assert [r[0][0] for r in results] == [str(n) for n in range(1, 9)]
+    metrics = batcher.metrics()
+    assert metrics["requests"] == 8
+    assert metrics["batches"] == 2
+    assert metrics["errors"] == 0
+    assert metrics["batch_size"]["count"] == 2
+
+
+def test_DynamicBatcher_timeout():
+    speech2text = StubSpeech2Text()
+    batcher = DynamicBatcher(speech2text, max_batch_size=8, max_wait_ms=100.0)
+    try:
+        start = time.perf_counter()
+        futures = [batcher.submit(np.zeros(16, dtype=np.float32)) for _ in range(2)]
+        for f in futures:
+            f.result(timeout=10)
+        elapsed = time.perf_counter() - start
+    finally:
+        batcher.close()
+
+    # The partial batch is decoded once the first utterance has waited enough
+    assert speech2text.batch_sizes == [2]
+    assert elapsed >= 0.09
+
+
+@pytest.mark.parametrize("interctc", [False, True])
+def test_DynamicBatcher_too_short(interctc):
+    block = threading.Event()
+    speech2text = StubSpeech2Text(min_length=10, interctc=interctc, block=block)
+    batcher = DynamicBatcher(speech2text, max_batch_size=2, max_wait_ms=10000.0)
+    try:
+        short = batcher.submit(np.zeros(5, dtype=np.float32))
+        long = batcher.submit(np.zeros(20, dtype=np.float32))
+        block.set()
+        with pytest.raises(TooShortUttError):
+            short.result(timeout=10)
+        text, token, token_int, hyp = long.result(timeout=10)[0]
+    finally:
+        batcher.close()
+
+    # The utterances of the failed batch are decoded one by one
+    assert text == "20"
+    assert batcher.metrics()["errors"] == 1
+
+
+def test_DynamicBatcher_queue_full():
+    block = threading.Event()
+    speech2text = StubSpeech2Text(block=block)
+    batcher = DynamicBatcher(
+        speech2text, max_batch_size=1, max_wait_ms=0.0, max_queue_size=1
+    )
+    try:
+        first = batcher.submit(np.zeros(16, dtype=np.float32))
+        # Wait until the worker is blocked on the first utterance
+        while batcher.queue.qsize() > 0:
+            time.sleep(0.01)
+        batcher.submit(np.zeros(16, dtype=np.float32))
+        with pytest.raises(queue.Full):
+            batcher.submit(np.zeros(16, dtype=np.float32))
+        block.set()
+        first.result(timeout=10)
+    finally:
+        block.set()
+        batcher.close()
+
+
+@pytest.fixture()
+def token_list(tmp_path: Path):
+    with (tmp_path / "tokens.txt").open("w") as f:
+        f.write("<blank>\n")
+        for c in string.ascii_letters:
+            f.write(f"{c}\n")
+        f.write("<unk>\n")
+        f.write("<sos/eos>\n")
+    return tmp_path / "tokens.txt"
+
+
+@pytest.fixture()
+def asr_config_file(tmp_path: Path, token_list):
+    # Write a tiny configuration file, the model is randomly initialized
+    ASRTask.main(
+        cmd=[
+            "--dry_run",
+            "true",
+            "--output_dir",
+            str(tmp_path / "asr"),
+            "--token_list",
+            str(token_list),
+            "--token_type",
+            "char",
+            "--encoder_conf",
+            "num_layers=1",
+            "--encoder_conf",
+            "hidden_size=16",
+            "--encoder_conf",
+            "output_size=16",
+            "--decoder",
+            "rnn",
+            "--decoder_conf",
+            "hidden_size=16",
+        ]
+    )
+    return tmp_path / "asr" / "config.yaml"
+
+
+@pytest.fixture()
+def speech2text(asr_config_file):
+    return Speech2Text(asr_train_config=asr_config_file, beam_size=1)
+
+
+def test_DynamicBatcher_Speech2Text(speech2text):
+    batcher = DynamicBatcher(speech2text, max_batch_size=2, max_wait_ms=1000.0)
+    try:
+        futures = [
+            batcher.submit(np.random.randn(n).astype(np.float32))
+            for n in (8000, 12000, 16000)
+        ]
+        results = [f.result(timeout=60) for f in futures]
+    finally:
+        batcher.close()
+
+    for nbest in results:
+        text, token, token_int, hyp = nbest[0]
+        assert isinstance(text, str)
+        assert isinstance(token, list)
+    assert batcher.metrics()["requests"] == 3
+
+
+def test_recognize(speech2text):
+    batcher = DynamicBatcher(speech2text, max_batch_size=2, max_wait_ms=10.0)
+    server = make_server(batcher, "127.0.0.1", 0, None, 16000, 60.0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        audio = io.BytesIO()
+        soundfile.write(audio, np.random.randn(16000) * 0.1, 16000, format="WAV")
+        request = urllib.request.Request(
+            f"{url}/recognize", data=audio.getvalue(), method="POST"
+        )
+        with urllib.request.urlopen(request, timeout=60) as response:
+            assert response.status == 200
+            results = json.loads(response.read())["results"]
+        with urllib.request.urlopen(f"{url}/metrics", timeout=60) as response:
+            metrics = json.loads(response.read())
+    finally:
+        server.shutdown()
+        server.server_close()
+        batcher.close()
+
+    assert len(results) == 1
+    assert isinstance(results[0]["text"], str)
+    assert isinstance(results[0]["score"], float)
+    assert metrics["requests"] == 1
@@ -0,0 +1,46 @@
+import pytest
+import torch
+
+from espnet2.layers.chunked_label_smoothing_loss import ChunkedLabelSmoothingLoss
+from espnet.nets.pytorch_backend.nets_utils import th_accuracy
+from espnet.nets.pytorch_backend.transformer.label_smoothing_loss import (
+    LabelSmoothingLoss,
+)
+
+
+@pytest.mark.parametrize("chunk_size", [3, 4, 100])
+@pytest.mark.parametrize("normalize_length", [False, True])
+@pytest.mark.parametrize("smoothing", [0.0, 0.1])
+def test_ChunkedLabelSmoothingLoss(chunk_size, normalize_length, smoothing):
+    torch.manual_seed(0)
+    size, padding_idx = 20, -1
+    lm_head = torch.nn.Linear(8, size, bias=False)
+    hs_pad = torch.randn(2, 5, 8)
+    # 7 target tokens, not a multiple of chunk_size
+    target = torch.tensor([[1, 4, 4, 19, 0], [7, 2, -1, -1, -1]])
+
+    hs = hs_pad.clone().requires_grad_(True)
+    criterion = LabelSmoothingLoss(size, padding_idx, smoothing, normalize_length)
+    logits = lm_head(hs)
+    loss = criterion(logits, target)
+    acc = th_accuracy(logits.view(-1, size), target, ignore_label=padding_idx)
+    loss.backward()
+    grads = (hs.grad.clone(), lm_head.weight.grad.clone())
+
+    lm_head.zero_grad()
+    hs = hs_pad.clone().requires_grad_(True)
+    chunked = ChunkedLabelSmoothingLoss(
+        size, padding_idx, smoothing, normalize_length, chunk_size=chunk_size
+    )
+    chunked_loss, pred = chunked(hs, lm_head, target)
+    mask = target != padding_idx
+    chunked_acc = float(
+        torch.sum(pred.masked_select(mask) == target.masked_select(mask))
+    ) / float(torch.sum(mask))
+    chunked_loss.backward()
+
+    torch.testing.assert_close(chunked_loss, loss, rtol=1e-5, atol=1e-5)
+    assert chunked_acc == acc
+    assert torch.all(pred[~mask] == padding_idx)
+    torch.testing.assert_close(hs.grad, grads[0], rtol=1e-5, atol=1e-5)
+    torch.testing.assert_close(lm_head.weight.grad, grads[1], rtol=1e-5, atol=1e-5)